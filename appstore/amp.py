@@ -0,0 +1,179 @@
+from datetime import datetime, timezone
+import json
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def split_apps(body):
+    '''
+    Split the body of an amp response with multiple apps into (app id, json, app) per app.
+    The json of every app is {"data": [app]}, the same as a response for a single app.
+
+    orjson is used if it is installed, it is about 1.5x faster than the json module.
+    Without it the json of every app is cut out of the body instead of serializing the app again.
+    '''
+    if orjson is not None:
+        for app in orjson.loads(body)['data']:
+            yield app['id'], b'{"data":[' + orjson.dumps(app) + b']}', app
+    else:
+        text = body.decode() if isinstance(body, bytes) else body
+        for app, start, end in _scan_data(text):
+            yield app['id'], b'{"data":[' + text[start:end].encode() + b']}', app
+
+
+def _scan_data(text):
+    '''
+    (app, start, end) of the apps in the data list of a response, text[start:end] is the json of the app
+    '''
+    decode = _decoder.raw_decode
+    pos = _expect(text, 0, '{')
+    while text[pos : pos + 1] != '}':
+        key, pos = decode(text, pos)
+        pos = _expect(text, pos, ':')
+        if key == 'data' and text[pos : pos + 1] == '[':
+            pos = _skip(text, pos + 1)
+            while text[pos : pos + 1] != ']':
+                app, end = decode(text, pos)
+                yield app, pos, end
+                pos = _next(text, end, ']')
+            pos += 1
+        else:
+            _, pos = decode(text, pos)
+        pos = _next(text, pos, '}')
+
+
+def _skip(text, pos):
+    return _WHITESPACE.match(text, pos).end()
+
+
+def _expect(text, pos, char):
+    pos = _skip(text, pos)
+    if text[pos : pos + 1] != char:
+        raise json.JSONDecodeError(f'Expecting {char!r}', text, pos)
+    return _skip(text, pos + 1)
+
+
+def _next(text, pos, close):
+    '''
+    Position of the next element of an object or list after a comma, or of its closing bracket
+    '''
+    pos = _skip(text, pos)
+    if text[pos : pos + 1] == close:
+        return pos
+    return _expect(text, pos, ',')
+
+
+def last_modified(app):
+    '''
+    Release date of the latest version of an app (of all platforms) as unix time, None if it is unknown
+    '''
+    dates = [
+        version['releaseDate'][:10]
+        for platform in app.get('attributes', {}).get('platformAttributes', {}).values()
+        for version in platform.get('versionHistory', [])
+        if 'releaseDate' in version
+    ]
+    if len(dates) == 0:
+        return None
+    try:
+        return datetime.strptime(max(dates), '%Y-%m-%d').replace(tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        return None
+
+
+class AmpBatcher:
+    '''
+    Groups app ids into batches for amp api requests with multiple ids.
+
+    The batch size adapts while crawling: it gets halved when a response is slow or very big
+    and grows again with every good response (apps that are missing in a response do not make it smaller).
+    A batch is never bigger than max_size (the api allows 100 ids) and its url never longer than max_url_length.
+    Apps that are missing in a response are added to one of the next batches again
+    until they were requested max_attempts times.
+    '''
+
+    def __init__(
+        self,
+        make_url,
+        max_size=100,
+        min_size=10,
+        step=10,
+        max_url_length=4000,
+        max_latency=10,
+        max_response_size=16 * 1024 * 1024,
+        max_attempts=2,
+    ):
+        self.make_url = make_url
+        self.max_size = max_size
+        self.min_size = min_size
+        self.step = step
+        self.max_url_length = max_url_length
+        self.max_latency = max_latency
+        self.max_response_size = max_response_size
+        self.max_attempts = max_attempts
+        self.size = max_size
+        self._batch = []
+        self._retry = []
+        # number of requests for every app id that was missing in a response
+        self._attempts = {}
+
+    def add(self, app_id):
+        '''
+        Add an id, returns (url, ids) when a batch is full
+        '''
+        self._batch.append(str(app_id))
+        if len(self._batch) + len(self._retry) >= self.size:
+            return self._pop()
+        return None
+
+    def flush(self):
+        '''
+        Get all remaining batches as (url, ids)
+        '''
+        while len(self._batch) + len(self._retry) > 0:
+            yield self._pop()
+
+    def _pop(self):
+        ids = (self._retry + self._batch)[: self.size]
+        url = self.make_url(ids)
+        while len(url) > self.max_url_length and len(ids) > 1:
+            ids = ids[: max(len(ids) * self.max_url_length // len(url), 1)]
+            url = self.make_url(ids)
+        num_retry = min(len(self._retry), len(ids))
+        self._retry = self._retry[num_retry:]
+        self._batch = self._batch[len(ids) - num_retry :]
+        return url, ids
+
+    def response(self, ids_req, ids_res, latency, size):
+        '''
+        Adapt the batch size to a response and add missing ids to the next batches.
+        Returns the ids that were missing too often.
+        '''
+        missing = [app_id for app_id in ids_req if app_id not in ids_res]
+        if latency > self.max_latency or size > self.max_response_size:
+            self.shrink()
+        else:
+            self.size = min(self.size + self.step, self.max_size)
+
+        gave_up = []
+        for app_id in missing:
+            attempts = self._attempts.get(app_id, 0) + 1
+            if attempts >= self.max_attempts:
+                self._attempts.pop(app_id, None)
+                gave_up.append(app_id)
+            else:
+                self._attempts[app_id] = attempts
+                self._retry.append(app_id)
+        for app_id in ids_res:
+            self._attempts.pop(app_id, None)
+        return gave_up
+
+    def shrink(self):
+        self.size = max(self.size // 2, self.min_size)
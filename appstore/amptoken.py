@@ -0,0 +1,71 @@
+'''
+Bearer token of the amp api: expiry (of the JWT) and disk cache
+'''
+
+import base64
+import json
+import os
+from time import time
+
+
+def decode_claims(token):
+    '''
+    The claims (payload) of a JWT, e.g. {"iss": ..., "iat": 1700000000, "exp": 1715000000}
+    Returns {} if the token is no JWT.
+    '''
+    try:
+        payload = token.split('.')[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+    except (IndexError, ValueError):
+        return {}
+    return claims if isinstance(claims, dict) else {}
+
+
+class Token:
+    '''
+    A token and when it expires (None if that is unknown, e.g. no JWT)
+    '''
+
+    def __init__(self, value, fetched=None):
+        self.value = value
+        claims = decode_claims(value)
+        self.fetched = fetched if fetched is not None else time()
+        self.issued = claims.get('iat', self.fetched)
+        self.expires = claims.get('exp')
+
+    def expired(self, now=None):
+        return self.expires is not None and (now or time()) >= self.expires
+
+    def refresh_at(self, before):
+        '''
+        When to get a new token: before seconds before it expires, but not before half of its lifetime
+        '''
+        if self.expires is None:
+            return None
+        return self.expires - min(before, (self.expires - self.issued) / 2)
+
+    def __str__(self):
+        return self.value
+
+
+def load_token(filename):
+    '''
+    The cached token or None
+    '''
+    try:
+        with open(filename) as f:
+            cached = json.load(f)
+        return Token(cached['token'], cached.get('fetched'))
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def save_token(filename, token):
+    dirname = os.path.dirname(filename)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    # replaced at once, another crawler may read it at the same time
+    tmp = f'{filename}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'token': token.value, 'fetched': token.fetched, 'expires': token.expires}, f)
+    os.replace(tmp, filename)
@@ -0,0 +1,277 @@
+'''
+Collects the ids of the jl files (or ids files) of the appstore_ids spider (used by collect.py)
+
+The input files are split into chunks that are parsed by a pool of processes.
+Every chunk results in sorted runs of ids (temporary files) per country,
+which get merged into the output files by the main process.
+'''
+
+from array import array
+from heapq import merge
+from itertools import groupby, islice
+import json
+import os
+import tempfile
+
+from appstore import idfile
+from appstore.idset import BLOCK_SIZE, ExternalSorter, IDSet, TYPECODE, unique
+
+# (category id, app id) pairs are sorted as one int: category id << CATEGORY_SHIFT | app id
+CATEGORY_SHIFT = 40
+APP_ID_MASK = (1 << CATEGORY_SHIFT) - 1
+# bytes of an id in a jl file (a chunk of an ids file has about as many ids as a chunk of a jl file)
+JL_ID_SIZE = 12
+
+
+def app_ids(apps):
+    # apps are ids or {'id': ..., 'url': ...} (saveurls=True) or an array (ids file)
+    if isinstance(apps, array):
+        return apps
+    return [app['id'] if isinstance(app, dict) else app for app in apps]
+
+
+def file_country(filename):
+    '''
+    Country of the items of a file that have no country: the name of the file without extension
+    '''
+    return os.path.basename(filename).split('.')[0]
+
+
+def split_files(filenames, chunk_size):
+    '''
+    Split the files into (filename, start, end) chunks of about chunk_size bytes (of a jl file)
+    '''
+    for filename in filenames:
+        if idfile.is_idfile(filename):
+            yield from idfile.split(filename, max(chunk_size // JL_ID_SIZE, 1))
+            continue
+        size = os.path.getsize(filename)
+        for start in range(0, max(size, 1), chunk_size):
+            yield filename, start, min(start + chunk_size, size)
+
+
+def lines(filename, start, end):
+    '''
+    The lines that start in the byte range [start, end) of a file
+    '''
+    with open(filename, 'rb') as f:
+        if start > 0:
+            # skip the line that started in the previous chunk
+            f.seek(start - 1)
+            f.readline()
+        pos = f.tell()
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line
+
+
+def read_items(filename, start, end):
+    '''
+    The items of a chunk of a jl file or an ids file (-O out_us.ids)
+    '''
+    if not idfile.is_idfile(filename):
+        for line in lines(filename, start, end):
+            yield json.loads(line)
+        return
+    for country, category_id, kind, ids in idfile.read_blocks(filename, start, end):
+        item = {'category_id': category_id, idfile.KINDS[kind]: ids}
+        if country:
+            item['country'] = country
+        yield item
+
+
+def write_run(ids, tmpdir):
+    '''
+    Sort ids into a temporary file, returns its name
+    '''
+    fd, filename = tempfile.mkstemp(prefix='collect-', suffix='.ids', dir=tmpdir)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(array(TYPECODE, unique(sorted(ids))))
+    return filename
+
+
+def collect_chunk(task):
+    '''
+    Parse a chunk of a file, runs in a worker process.
+
+    Returns the categories, the popular apps per category and country
+    and the runs (file names) of all apps per country and of (category id, app id) pairs.
+    '''
+    filename, start, end, country, with_categories, tmpdir = task
+    default_country = file_country(filename)
+    categories = set()
+    popular = {}
+    apps = {}
+    category_apps = array(TYPECODE)
+
+    for jl in read_items(filename, start, end):
+        item_country = jl.get('country', default_country)
+        if country is not None and item_country != country:
+            continue
+        category_id = int(jl['category_id'])
+        categories.add(category_id)
+
+        if 'apps' in jl:
+            ids = app_ids(jl['apps'])
+        elif 'popular-apps' in jl:
+            ids = app_ids(jl['popular-apps'])
+            popular.setdefault((item_country, category_id), set()).update(ids)
+        else:
+            print('Unknown data:', jl)
+            continue
+
+        # popular apps are also added to all apps
+        apps.setdefault(item_country, array(TYPECODE)).extend(ids)
+        if with_categories:
+            key = category_id << CATEGORY_SHIFT
+            category_apps.extend(key | app_id for app_id in ids)
+
+    runs = {c: write_run(ids, tmpdir) for c, ids in apps.items()}
+    category_run = write_run(category_apps, tmpdir) if len(category_apps) > 0 else None
+    popular = {key: sorted(ids) for key, ids in popular.items()}
+    return categories, popular, runs, category_run
+
+
+def tagged(ids, bit):
+    for app_id in ids:
+        yield app_id, bit
+
+
+def open_run(filename):
+    # the file is deleted when it gets closed
+    f = open(filename, 'rb')
+    os.unlink(filename)
+    return f
+
+
+class Collector:
+    '''
+    Merges the results of collect_chunk
+    '''
+
+    def __init__(self, tmpdir=None):
+        self.tmpdir = tmpdir
+        self.categories = set()
+        # category id: IDSet
+        self.popular = {}
+        self.all_popular = IDSet()
+        # country: ExternalSorter of its apps
+        self.apps = {}
+        self.category_apps = ExternalSorter(tmpdir=tmpdir)
+
+    def add(self, result):
+        categories, popular, runs, category_run = result
+        self.categories.update(categories)
+        for (_, category_id), ids in popular.items():
+            if category_id not in self.popular:
+                self.popular[category_id] = IDSet()
+            self.popular[category_id].update(ids)
+            self.all_popular.update(ids)
+        for country, run in runs.items():
+            if country not in self.apps:
+                self.apps[country] = ExternalSorter(tmpdir=self.tmpdir)
+            self.apps[country].add_run(open_run(run))
+        if category_run is not None:
+            self.category_apps.add_run(open_run(category_run))
+
+    @property
+    def countries(self):
+        return sorted(self.apps)
+
+    def memberships(self):
+        '''
+        K-way merge of the apps of all countries: yields (app id, bitmask of the countries (see countries))
+        '''
+        streams = [tagged(self.apps[c], 1 << i) for i, c in enumerate(self.countries)]
+        for app_id, group in groupby(merge(*streams), key=lambda x: x[0]):
+            mask = 0
+            for _, bit in group:
+                mask |= bit
+            yield app_id, mask
+
+    def write(self, output, all_ids=True, popular_ids=True, save_json=True, matrix=True):
+        '''
+        Write the output files {output}_all_ids, {output}_popular_ids, {output}.json and {output}_countries.csv
+        '''
+        if save_json:
+            write_json(output + '.json', self.categories, self.popular, self.category_apps)
+        self.category_apps.close()
+        if popular_ids:
+            self.all_popular.write_text(output + '_popular_ids')
+
+        countries = self.countries
+        f_all = open(output + '_all_ids', 'w') if all_ids else None
+        f_matrix = open(output + '_countries.csv', 'w') if matrix else None
+        if f_matrix is not None:
+            f_matrix.write(','.join(['id'] + countries) + '\n')
+        # one row per country combination
+        rows = {}
+        memberships = self.memberships()
+        while all_ids or matrix:
+            block = list(islice(memberships, BLOCK_SIZE))
+            if len(block) == 0:
+                break
+            if f_all is not None:
+                f_all.write(''.join(f'{app_id}\n' for app_id, _ in block))
+            if f_matrix is not None:
+                for _, mask in block:
+                    if mask not in rows:
+                        rows[mask] = ','.join('1' if mask >> i & 1 else '0' for i in range(len(countries)))
+                f_matrix.write(''.join(f'{app_id},{rows[mask]}\n' for app_id, mask in block))
+        for f in [f_all, f_matrix]:
+            if f is not None:
+                f.close()
+        for sorter in self.apps.values():
+            sorter.close()
+
+
+def json_list(f, ids, indent):
+    '''
+    Write a list of ids like json.dump(indent=2)
+    '''
+    it = iter(ids)
+    block = list(islice(it, BLOCK_SIZE))
+    if len(block) == 0:
+        f.write('[]')
+        return
+    f.write('[')
+    sep = ',\n' + ' ' * (indent + 2)
+    while len(block) > 0:
+        f.write(sep[1:] + sep.join(str(app_id) for app_id in block))
+        block = list(islice(it, BLOCK_SIZE))
+        if len(block) > 0:
+            f.write(',')
+    f.write('\n' + ' ' * indent + ']')
+
+
+def write_json(filename, categories, popular, category_apps):
+    '''
+    Write {category id: {"popular-apps": [...], "apps": [...]}} one category after the other
+    '''
+    grouped = groupby(category_apps, key=lambda key: key >> CATEGORY_SHIFT)
+    current = next(grouped, None)
+    with open(filename, 'w') as f:
+        f.write('{')
+        for i, category_id in enumerate(sorted(categories)):
+            f.write(',\n' if i > 0 else '\n')
+            f.write(f'  {json.dumps(str(category_id))}: ')
+            fields = []
+            if category_id in popular:
+                fields.append(('popular-apps', popular[category_id]))
+            if current is not None and current[0] == category_id:
+                fields.append(('apps', (key & APP_ID_MASK for key in current[1])))
+            if len(fields) == 0:
+                f.write('{}')
+            else:
+                f.write('{')
+                for j, (name, ids) in enumerate(fields):
+                    f.write(',\n' if j > 0 else '\n')
+                    f.write(f'    "{name}": ')
+                    json_list(f, ids, 4)
+                f.write('\n  }')
+            if current is not None and current[0] == category_id:
+                current = next(grouped, None)
+        f.write('\n}' if len(categories) > 0 else '}')
@@ -0,0 +1,201 @@
+# Define here the extensions of the crawler
+#
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/extensions.html
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import task
+from time import time
+
+from appstore.metrics import crawler_metrics, num_fmt
+from appstore.middlewares import slot_endpoint
+
+
+class AdaptiveThrottle:
+    '''
+    Adjusts the delay of every endpoint download slot (amp, amp_single, ua, genre) on its own,
+    with an egress pool the delay of every exit of an endpoint (amp@0, amp@1, ...).
+
+    The request rate of a slot (1 / delay) grows additively with every clean response, by a fraction of the rate
+    the slot started with (the configured delay of the endpoint), and gets cut multiplicatively on a 429
+    or when a Retry-After header is sent.
+    Slots that are configured with a delay below ADAPTIVE_THROTTLE_MIN_DELAY (e.g. 0) get back to it once the rate
+    has recovered up to the minimum delay.
+    Works the same way as scrapy's AutoThrottle, but is driven by the rate limits of Apple
+    instead of the latency.
+    '''
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        settings = crawler.settings
+        if not settings.getbool('ADAPTIVE_THROTTLE_ENABLED'):
+            raise NotConfigured
+
+        self.debug = settings.getbool('ADAPTIVE_THROTTLE_DEBUG')
+        self.endpoints = settings.getdict('APPSTORE_DOWNLOAD_SLOTS')
+        self.min_delay = settings.getfloat('ADAPTIVE_THROTTLE_MIN_DELAY')
+        self.max_delay = settings.getfloat('ADAPTIVE_THROTTLE_MAX_DELAY')
+        self.increase = settings.getfloat('ADAPTIVE_THROTTLE_RATE_INCREASE')
+        self.decrease = settings.getfloat('ADAPTIVE_THROTTLE_RATE_DECREASE')
+        # time of the last rate cut, current slot object, delay, configured rate and lowest delay per endpoint
+        self._last_cut = {}
+        self._slots = {}
+        self._delays = {}
+        self._rates = {}
+        self._floors = {}
+
+        crawler.signals.connect(self.request_reached_downloader, signal=signals.request_reached_downloader)
+        crawler.signals.connect(self.response_downloaded, signal=signals.response_downloaded)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def request_reached_downloader(self, request, spider):
+        key, slot = self._get_slot(request)
+        if slot is None or self._slots.get(key) is slot:
+            return
+        # new or recreated slot, continue with the adapted delay
+        self._slots[key] = slot
+        if key not in self._rates:
+            self._rates[key] = 1 / max(slot.delay, self.min_delay)
+            self._floors[key] = min(slot.delay, self.min_delay)
+        if key in self._delays:
+            slot.delay = self._delays[key]
+
+    def response_downloaded(self, response, request, spider):
+        key, slot = self._get_slot(request)
+        if slot is None:
+            return
+
+        olddelay = slot.delay
+        if response.status == 429 or 'Retry-After' in response.headers:
+            # requests that were sent before the last cut belong to the same burst
+            sent = time() - request.meta.get('download_latency', 0)
+            if sent < self._last_cut.get(key, 0):
+                return
+            slot.delay = min(max(olddelay, self.min_delay, 0.01) / self.decrease, self.max_delay)
+            self._delays[key] = slot.delay
+            self._last_cut[key] = time()
+            spider.logger.info(f'Adaptive throttle: {key} got rate limited, delay {olddelay:.3f} -> {slot.delay:.3f}')
+        elif response.status < 400 and olddelay > self._floors.get(key, self.min_delay):
+            increase = self.increase * self._rates.get(key, 1 / max(olddelay, self.min_delay))
+            slot.delay = 1 / (1 / olddelay + increase)
+            if slot.delay <= self.min_delay:
+                slot.delay = self._floors.get(key, self.min_delay)
+            self._delays[key] = slot.delay
+            if self.debug:
+                spider.logger.info(f'Adaptive throttle: {key} delay {olddelay:.3f} -> {slot.delay:.3f}')
+
+    def _get_slot(self, request):
+        key = request.meta.get('download_slot')
+        if slot_endpoint(key) not in self.endpoints:
+            return None, None
+        return key, self.crawler.engine.downloader.slots.get(key)
+
+
+class CrawlMetrics:
+    '''
+    Counts the downloaded responses of every endpoint (download slot) in the metrics of the crawl (appstore/metrics.py).
+
+    Every APPSTORE_METRICS_INTERVAL seconds a summary is logged and the metrics are written to APPSTORE_METRICS_FILE
+    (Prometheus text format or JSON if it ends with .json, e.g. for the textfile collector of the node exporter).
+    '''
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        settings = crawler.settings
+        self.interval = settings.getfloat('APPSTORE_METRICS_INTERVAL')
+        self.filename = settings.get('APPSTORE_METRICS_FILE')
+        self.endpoints = settings.getdict('APPSTORE_DOWNLOAD_SLOTS')
+        self.metrics = crawler_metrics(crawler)
+        # time, responses and apps per endpoint of the last summary
+        self._last = (self.metrics.started, {}, {})
+        self._loop = None
+
+        crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(self.response_downloaded, signal=signals.response_downloaded)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def spider_opened(self, spider):
+        self.metrics.track('appstore_scheduler_queue', (), self.scheduler_queue)
+        self.metrics.track('appstore_downloader_active', (), lambda: len(self.crawler.engine.downloader.active))
+        if self.interval > 0:
+            self._loop = task.LoopingCall(self.export, spider)
+            self._loop.start(self.interval, now=False)
+
+    def spider_closed(self, spider):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        # totals of the whole crawl
+        self._last = (self.metrics.started, {}, {})
+        self.export(spider)
+
+    def response_downloaded(self, response, request, spider):
+        endpoint = request.meta.get('download_slot') or 'other'
+        self.metrics.inc('appstore_responses_total', (endpoint, response.status))
+        self.metrics.inc('appstore_response_bytes_total', (endpoint,), len(response.body))
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            self.metrics.observe('appstore_response_seconds', (endpoint,), latency)
+
+    def scheduler_queue(self):
+        slot = self.crawler.engine.slot
+        return 0 if slot is None else len(slot.scheduler)
+
+    def export(self, spider):
+        for key, slot in list(self.crawler.engine.downloader.slots.items()):
+            if slot_endpoint(key) in self.endpoints:
+                self.metrics.set('appstore_download_delay_seconds', (key,), slot.delay)
+        self.metrics.collect()
+        spider.logger.info(self.summary())
+        if self.filename:
+            try:
+                self.metrics.write(self.filename)
+            except OSError as e:
+                spider.logger.error(f'Could not write the metrics to {self.filename}: {e}')
+
+    def summary(self):
+        '''
+        Requests and apps per second of every endpoint since the last summary
+        '''
+        metrics = self.metrics
+        now = time()
+        responses = metrics.totals('appstore_responses_total')
+        apps = metrics.totals('appstore_apps_total')
+        last_time, last_responses, last_apps = self._last
+        self._last = (now, responses, apps)
+        elapsed = max(now - last_time, 0.001)
+
+        parts = []
+        rate_limited = metrics.totals('appstore_responses_total', where=429)
+        delays = metrics.values['appstore_download_delay_seconds']
+        for endpoint, count in sorted(responses.items()):
+            rate = (count - last_responses.get(endpoint, 0)) / elapsed
+            part = f'{endpoint}: {rate:.1f} req/s, {rate_limited.get(endpoint, 0)} 429s'
+            if (endpoint,) in delays:
+                part += f', delay {delays[(endpoint,)]:.2f}s'
+            parts.append(part)
+        done = metrics.values['appstore_apps_done']
+        total = metrics.values['appstore_apps_input']
+        for (endpoint,) in sorted(set(done) | {(endpoint,) for endpoint in apps}):
+            rate = (apps.get(endpoint, 0) - last_apps.get(endpoint, 0)) / elapsed
+            if (endpoint,) in total:
+                count = f'{num_fmt(done.get((endpoint,), 0))}/{num_fmt(total[(endpoint,)])}'
+            else:
+                count = num_fmt(apps.get(endpoint, 0))
+            parts.append(f'{endpoint} apps: {count} ({rate:.1f}/s)')
+        cache = metrics.values['appstore_page_cache_total']
+        if cache:
+            results = [f'{num_fmt(count)} {result}' for (result,), count in sorted(cache.items())]
+            parts.append('page cache: ' + ', '.join(results))
+        queues = f'scheduler: {num_fmt(metrics.values["appstore_scheduler_queue"].get((), 0))}'
+        if () in metrics.values['appstore_write_queue']:
+            queues += f', write queue: {metrics.values["appstore_write_queue"][()]}'
+        parts.append(queues)
+        return 'Metrics: ' + '; '.join(parts)
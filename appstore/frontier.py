@@ -0,0 +1,69 @@
+'''
+Pagination of the letters of the categories (used by the appstore_ids spider)
+'''
+
+# highest requested page, highest linked page, last page (None until it is known)
+REQUESTED, LINKED, LAST = range(3)
+
+
+class Frontier:
+    '''
+    Tracks the pages of every (country, category, letter), so that every page is requested once
+
+    The pages that are linked from a page get requested, plus prefetch pages after the highest linked page
+    (speculatively, so that the next page is already downloading when a page is parsed).
+    The last page is known from a page without links to later pages or a page after the last one (no apps).
+    '''
+
+    def __init__(self, prefetch=1):
+        self.prefetch = prefetch
+        self._letters = {}
+
+    def _advance(self, state, target):
+        # pages up to target that were not requested yet
+        if state[LAST] is not None:
+            target = min(target, state[LAST])
+        pages = range(state[REQUESTED] + 1, target + 1)
+        state[REQUESTED] = max(state[REQUESTED], target)
+        return pages
+
+    def start(self, key):
+        '''
+        The first pages of a letter (none if the letter was started before)
+        '''
+        if key in self._letters:
+            return range(0)
+        state = self._letters[key] = [0, 1, None]
+        return self._advance(state, 1 + self.prefetch)
+
+    def parsed(self, key, page, linked, empty):
+        '''
+        Record a parsed page with the numbers of the pages it links to and whether it has no apps.
+        Returns the pages to request next and whether the page is after the last page.
+        '''
+        state = self._letters.setdefault(key, [page, page, None])
+        highest = max(linked, default=0)
+        state[LINKED] = max(state[LINKED], highest)
+        after_last = empty and page > highest
+        if after_last:
+            last = page - 1
+        elif highest <= page:
+            last = page
+        else:
+            last = None
+        if last is not None:
+            state[LAST] = last if state[LAST] is None else min(state[LAST], last)
+        return self._advance(state, max(state[LINKED], page) + self.prefetch), after_last
+
+    def failed(self, key, page):
+        '''
+        Record a page that could not be downloaded, returns the pages to request instead.
+        Only a linked page continues the pagination (a page after the last one may fail as well).
+        '''
+        state = self._letters.get(key)
+        if state is None or page > state[LINKED]:
+            return range(0)
+        return self._advance(state, page + 1 + self.prefetch)
+
+    def __len__(self):
+        return len(self._letters)
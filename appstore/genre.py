@@ -0,0 +1,115 @@
+'''
+Link extraction of the genre pages (used by the appstore_ids spider)
+
+The pages are scanned with regular expressions over the raw bytes instead of building a DOM,
+which is about 20 times faster than the css selectors that were used before:
+- app links: '.grid3-column a::attr(href)' (links to app pages only)
+- pages: 'ul.paginate a::attr(href)' (or only their numbers)
+- letters: 'ul.alpha li a::attr(href)'
+'''
+
+import html
+import re
+
+# start of the element with the app list
+APP_LIST = re.compile(rb'''class\s*=\s*["']?[^"'>]*\bgrid3-column\b''', re.IGNORECASE)
+TAG_NAME = re.compile(rb'''<([a-z][a-z0-9]*)''', re.IGNORECASE)
+LINK = re.compile(rb'''<a\s[^>]*?\bhref\s*=\s*["']([^"']*)["']''', re.IGNORECASE)
+# id of a link to an app page (.../app/name/id310633997?mt=8), anchored at "/app/" which is fast to find
+APP_ID = re.compile(rb'''/app/(?:[^/"'<>\s]*/)?id(\d+)(?=[?#"'])''')
+# (url, app id) of a link to an app page
+APP_LINK = re.compile(rb'''\bhref\s*=\s*["']([^"'<>\s]*/app/(?:[^/"'<>\s]*/)?id(\d+)(?:[?#][^"'<>\s]*)?)["']''')
+
+
+def list_pattern(name):
+    # content of the <ul> elements with the class name
+    return re.compile(rb'''<ul\s[^>]*?\bclass\s*=\s*["'][^"']*\b''' + name + rb'''\b[^>]*>(.*?)</ul>''', re.I | re.S)
+
+
+PAGINATE = list_pattern(b'paginate')
+ALPHA = list_pattern(b'alpha')
+PAGE_NUMBER = re.compile(rb'''[?&](?:amp;)?page=(\d+)''')
+
+
+def decode(href, encoding):
+    href = href.decode(encoding, 'replace')
+    return html.unescape(href) if '&' in href else href
+
+
+def tag_pattern(name):
+    # opening (group 1 empty) and closing tags (group 1 '/') of the elements with the tag name
+    return re.compile(rb'''<(/?)''' + re.escape(name) + rb'''[\s>/]''', re.IGNORECASE)
+
+
+def _app_list(response):
+    # (start, end) of the content of the element with the app list in the body, up to its closing tag
+    body = response.body
+    match = APP_LIST.search(body)
+    if match is None:
+        return None
+    start = body.find(b'>', match.end()) + 1 or len(body)
+    tag = TAG_NAME.match(body, body.rfind(b'<', 0, match.start()))
+    if tag is None:
+        return start, len(body)
+    depth = 1
+    for closing in tag_pattern(tag.group(1)).finditer(body, start):
+        depth += -1 if closing.group(1) else 1
+        if depth == 0:
+            return start, closing.start()
+    return start, len(body)
+
+
+def app_ids(response):
+    '''
+    The unique app ids of a genre page in the order of the page
+    '''
+    app_list = _app_list(response)
+    if app_list is None:
+        return []
+    return [int(app_id) for app_id in dict.fromkeys(APP_ID.findall(response.body, *app_list))]
+
+
+def app_links(response):
+    '''
+    The apps of a genre page: list of (app id, url) with unique urls in the order of the page
+    '''
+    app_list = _app_list(response)
+    if app_list is None:
+        return []
+    encoding = response.encoding
+    links = dict(APP_LINK.findall(response.body, *app_list))
+    return [(int(app_id), decode(href, encoding)) for href, app_id in links.items()]
+
+
+def list_links(response, pattern):
+    # unique absolute urls of the links in the lists of pattern
+    encoding = response.encoding
+    links = {}
+    for content in pattern.findall(response.body):
+        links.update(dict.fromkeys(LINK.findall(content)))
+    urls = [decode(href, encoding) for href in links]
+    return [url if url.startswith(('https://', 'http://')) else response.urljoin(url) for url in urls]
+
+
+def page_links(response):
+    '''
+    Urls of the other pages of a letter (unique)
+    '''
+    return list_links(response, PAGINATE)
+
+
+def page_numbers(response):
+    '''
+    Numbers of the pages of a letter that are linked (unique)
+    '''
+    numbers = set()
+    for content in PAGINATE.findall(response.body):
+        numbers.update(int(number) for number in PAGE_NUMBER.findall(content))
+    return numbers
+
+
+def letter_links(response):
+    '''
+    Urls of the letters of a category (unique)
+    '''
+    return list_links(response, ALPHA)
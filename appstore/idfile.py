@@ -0,0 +1,341 @@
+'''
+Compact binary file of the ids of the appstore_ids spider (-O out_us.ids) and its reader (used by collect.py)
+
+The ids are buffered per (country, category id, kind) and appended in blocks of sorted,
+delta and varint encoded ids (about 2-3 bytes per id instead of ~12 in json).
+The urls (saveurls=True), letters and pages are not saved.
+
+Format (all numbers are varints):
+- MAGIC
+- blocks: BLOCK, country (length + utf-8), category id, kind, number of ids, length of the ids, ids (deltas)
+- index: INDEX, number of entries, per block: offset, country, category id, kind, number of ids
+- trailer: offset of the index (8 bytes, little endian) and END
+
+Appending to a file (-o out_us.ids) adds another segment of MAGIC, blocks, index and trailer,
+the offsets are positions in the whole file.
+A file without index (e.g. of an aborted crawl) is read block by block.
+'''
+
+from array import array
+from itertools import accumulate
+import os
+import struct
+
+from scrapy.exporters import BaseItemExporter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from appstore.idset import TYPECODE, unique
+
+MAGIC = b'APPIDS\x01\n'
+END = b'APPIDX\x01\n'
+BLOCK = 1
+INDEX = 2
+# kinds of ids (the keys of the items)
+KINDS = ('apps', 'popular-apps')
+# ids per block
+BLOCK_IDS = 1 << 16
+TRAILER = struct.Struct('<Q')
+
+
+def encode_varint(num, out):
+    while num >= 0x80:
+        out.append(num & 0x7F | 0x80)
+        num >>= 7
+    out.append(num)
+
+
+def encode_ids(sorted_ids):
+    '''
+    Varints of the differences of sorted ids (the first one to 0)
+    '''
+    out = bytearray()
+    prev = 0
+    # encode_varint inlined (this runs for every id)
+    for app_id in sorted_ids:
+        num = app_id - prev
+        prev = app_id
+        while num >= 0x80:
+            out.append(num & 0x7F | 0x80)
+            num >>= 7
+        out.append(num)
+    return out
+
+
+def decode_ids(data):
+    '''
+    The ids of encode_ids as array
+    numpy is used if it is installed, it decodes a full country in milliseconds instead of ~0.3 seconds.
+    '''
+    if numpy is not None:
+        return decode_ids_numpy(data)
+    deltas = []
+    append = deltas.append
+    num = 0
+    shift = 0
+    for byte in data:
+        if byte & 0x80:
+            num |= (byte & 0x7F) << shift
+            shift += 7
+        else:
+            append(num | byte << shift)
+            num = 0
+            shift = 0
+    return array(TYPECODE, accumulate(deltas))
+
+
+def decode_ids_numpy(data):
+    ids = array(TYPECODE)
+    if len(data) == 0:
+        return ids
+    b = numpy.frombuffer(bytes(data), dtype=numpy.uint8)
+    # the last byte of every varint has no continuation bit
+    ends = numpy.flatnonzero(b < 0x80)
+    starts = numpy.concatenate(([0], ends[:-1] + 1))
+    # position of every byte in its varint
+    position = numpy.arange(len(b)) - numpy.repeat(starts, ends - starts + 1)
+    values = (b & 0x7F).astype(numpy.uint64) << (position * 7).astype(numpy.uint64)
+    deltas = numpy.add.reduceat(values, starts)
+    ids.frombytes(numpy.cumsum(deltas, dtype=numpy.uint64).tobytes())
+    return ids
+
+
+def read_varint(f):
+    num = 0
+    shift = 0
+    while True:
+        byte = f.read(1)
+        if len(byte) == 0:
+            raise EOFError
+        num |= (byte[0] & 0x7F) << shift
+        if byte[0] < 0x80:
+            return num
+        shift += 7
+
+
+def read_str(f):
+    return f.read(read_varint(f)).decode()
+
+
+def encode_str(s, out):
+    data = s.encode()
+    encode_varint(len(data), out)
+    out += data
+
+
+class IDFileWriter:
+    '''
+    Writes the ids to a binary file object (that only needs write())
+    The offsets start at tell() of the file object (if it has one), so a file opened for appending gets another segment.
+    '''
+
+    def __init__(self, f, block_ids=BLOCK_IDS):
+        self.f = f
+        self.block_ids = block_ids
+        # (country, category id, kind): array of ids
+        self._buffers = {}
+        self._index = []
+        try:
+            self._offset = f.tell()
+        except (AttributeError, OSError):
+            self._offset = 0
+        self._write(MAGIC)
+
+    def _write(self, data):
+        self.f.write(data)
+        self._offset += len(data)
+
+    def add(self, country, category_id, kind, ids):
+        key = (country, int(category_id), kind)
+        if key not in self._buffers:
+            self._buffers[key] = array(TYPECODE)
+        buffer = self._buffers[key]
+        buffer.extend(ids)
+        if len(buffer) >= self.block_ids:
+            self._write_block(key, buffer)
+            del self._buffers[key]
+
+    def _write_block(self, key, ids):
+        country, category_id, kind = key
+        ids = array(TYPECODE, unique(sorted(ids)))
+        data = encode_ids(ids)
+        ids_count = len(ids)
+        header = bytearray([BLOCK])
+        encode_str(country, header)
+        encode_varint(category_id, header)
+        encode_varint(kind, header)
+        encode_varint(ids_count, header)
+        encode_varint(len(data), header)
+        self._index.append((self._offset, country, category_id, kind, ids_count))
+        self._write(header)
+        self._write(data)
+
+    def close(self):
+        '''
+        Write the buffered ids and the index (the file object is not closed)
+        '''
+        for key, buffer in sorted(self._buffers.items()):
+            self._write_block(key, buffer)
+        self._buffers = {}
+        index_offset = self._offset
+        index = bytearray([INDEX])
+        encode_varint(len(self._index), index)
+        for offset, country, category_id, kind, ids_count in self._index:
+            encode_varint(offset, index)
+            encode_str(country, index)
+            encode_varint(category_id, index)
+            encode_varint(kind, index)
+            encode_varint(ids_count, index)
+        self._write(index)
+        self._write(TRAILER.pack(index_offset) + END)
+
+
+class IDFileExporter(BaseItemExporter):
+    '''
+    Feed exporter of the items of the appstore_ids spider (FEED_EXPORTERS in settings.py)
+    '''
+
+    def __init__(self, file, **kwargs):
+        super().__init__(dont_fail=True, **kwargs)
+        self.file = file
+        self.writer = None
+
+    def start_exporting(self):
+        self.writer = IDFileWriter(self.file)
+
+    def export_item(self, item):
+        for kind, name in enumerate(KINDS):
+            if name in item:
+                # apps are ids or {'id': ..., 'url': ...} (saveurls=True)
+                ids = [app['id'] if isinstance(app, dict) else app for app in item[name]]
+                self.writer.add(item.get('country', ''), item['category_id'], kind, ids)
+
+    def finish_exporting(self):
+        self.writer.close()
+
+
+def is_idfile(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def read_index(filename):
+    '''
+    The index of a file: list of (offset, country, category id, kind, number of ids) per block.
+    The indexes of the segments of an appended file are read from the last one to the first one.
+    Files without index get scanned.
+    '''
+    with open(filename, 'rb') as f:
+        size = os.path.getsize(filename)
+        segments = []
+        end = size
+        while end > 0:
+            index_offset = _read_trailer(f, end)
+            index = None if index_offset is None else _read_segment_index(f, index_offset)
+            if index is None:
+                return _scan(f, size)
+            segments.append(index)
+            # the segment starts before its first block (or its index if it has no blocks)
+            end = (index[0][0] if index else index_offset) - len(MAGIC)
+            f.seek(end)
+            if end < 0 or f.read(len(MAGIC)) != MAGIC:
+                return _scan(f, size)
+        return [entry for index in reversed(segments) for entry in index]
+
+
+def _read_trailer(f, end):
+    '''
+    The offset of the index of the segment that ends at end (None if it has no trailer)
+    '''
+    trailer_size = TRAILER.size + len(END)
+    if end < len(MAGIC) + trailer_size:
+        return None
+    f.seek(end - trailer_size)
+    trailer = f.read(trailer_size)
+    if not trailer.endswith(END):
+        return None
+    return TRAILER.unpack(trailer[: TRAILER.size])[0]
+
+
+def _read_segment_index(f, index_offset):
+    f.seek(index_offset)
+    if f.read(1) != bytes([INDEX]):
+        return None
+    index = []
+    for _ in range(read_varint(f)):
+        index.append((read_varint(f), read_str(f), read_varint(f), read_varint(f), read_varint(f)))
+    return index
+
+
+def _scan(f, size):
+    '''
+    Skip from block header to block header (and over the indexes and trailers of earlier segments)
+    '''
+    index = []
+    f.seek(0)
+    while True:
+        offset = f.tell()
+        tag = f.read(1)
+        try:
+            if tag == MAGIC[:1]:
+                if tag + f.read(len(MAGIC) - 1) != MAGIC:
+                    return index
+                continue
+            if tag == bytes([INDEX]):
+                for _ in range(read_varint(f)):
+                    read_varint(f)
+                    read_str(f)
+                    read_varint(f)
+                    read_varint(f)
+                    read_varint(f)
+                if not f.read(TRAILER.size + len(END)).endswith(END):
+                    return index
+                continue
+            if tag != bytes([BLOCK]):
+                return index
+            header = (read_str(f), read_varint(f), read_varint(f), read_varint(f))
+            length = read_varint(f)
+        except EOFError:
+            return index
+        if f.tell() + length > size:
+            # the last block of an aborted crawl may be incomplete
+            return index
+        index.append((offset,) + header)
+        f.seek(length, os.SEEK_CUR)
+
+
+def read_blocks(filename, start=0, end=None):
+    '''
+    Iterate over (country, category id, kind, ids) of the blocks that start in the byte range [start, end)
+    '''
+    with open(filename, 'rb') as f:
+        for offset, country, category_id, kind, _ in read_index(filename):
+            if offset < start or (end is not None and offset >= end):
+                continue
+            f.seek(offset + 1)
+            read_str(f)
+            read_varint(f)
+            read_varint(f)
+            read_varint(f)
+            yield country, category_id, kind, decode_ids(f.read(read_varint(f)))
+
+
+def split(filename, chunk_ids):
+    '''
+    Split a file into (filename, start, end) chunks of blocks with about chunk_ids ids
+    '''
+    start = None
+    num = 0
+    for offset, _, _, _, ids_count in read_index(filename):
+        if start is None:
+            start = offset
+        elif num >= chunk_ids:
+            yield filename, start, offset
+            start = offset
+            num = 0
+        num += ids_count
+    if start is not None:
+        yield filename, start, os.path.getsize(filename)
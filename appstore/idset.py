@@ -0,0 +1,258 @@
+from array import array
+from bisect import bisect_left
+from heapq import merge
+from itertools import islice
+import mmap
+import tempfile
+
+# app ids are stored as unsigned 64 bit ints (8 bytes per id instead of ~70 for a python set)
+TYPECODE = 'Q'
+# number of added ids that get buffered before they are sorted into the set
+CHUNK_SIZE = 1 << 20
+# number of ids that are read at once from a run of the ExternalSorter
+BLOCK_SIZE = 1 << 16
+# the runs of an ExternalSorter get merged into one when there are more (every run is an open file)
+MAX_RUNS = 256
+
+
+def unique(sorted_ids):
+    '''
+    Drop duplicates from a sorted iterable
+    '''
+    last = None
+    for app_id in sorted_ids:
+        if app_id != last:
+            yield app_id
+            last = app_id
+
+
+def difference(a, b):
+    '''
+    Items of sorted iterable a that are not in sorted iterable b
+    '''
+    b = iter(b)
+    y = next(b, None)
+    for x in a:
+        while y is not None and y < x:
+            y = next(b, None)
+        if x != y:
+            yield x
+
+
+def chunks(seq, size):
+    '''
+    Split a sequence into slices of size
+    '''
+    for i in range(0, len(seq), size):
+        yield seq[i : i + size]
+
+
+def write_text(ids, filename):
+    '''
+    Write one id per line, returns the number of ids
+    '''
+    num = 0
+    it = iter(ids)
+    with open(filename, 'w') as f:
+        while True:
+            block = list(islice(it, BLOCK_SIZE))
+            if len(block) == 0:
+                return num
+            f.write(''.join(f'{app_id}\n' for app_id in block))
+            num += len(block)
+
+
+def read_run(f):
+    '''
+    Read the ids of a binary file in blocks
+    '''
+    f.seek(0)
+    while True:
+        block = array(TYPECODE)
+        block.frombytes(f.read(BLOCK_SIZE * block.itemsize))
+        if len(block) == 0:
+            return
+        yield from block
+
+
+class ExternalSorter:
+    '''
+    Sorts and deduplicates more ids than fit in memory
+
+    Added ids are buffered, every run_size ids are sorted and written to a temporary file (a run).
+    Sorted runs can also be added directly (e.g. from other processes).
+    Iterating merges the runs, so at most run_size ids (and a block of every run) are in memory.
+    Can be iterated only once.
+    '''
+
+    def __init__(self, run_size=CHUNK_SIZE, tmpdir=None):
+        self.run_size = run_size
+        self.tmpdir = tmpdir
+        self._buffer = array(TYPECODE)
+        self._runs = []
+
+    def add(self, app_id):
+        self._buffer.append(app_id)
+        if len(self._buffer) >= self.run_size:
+            self._spill()
+
+    def update(self, ids):
+        it = iter(ids)
+        while True:
+            num = len(self._buffer)
+            self._buffer.extend(islice(it, self.run_size - num))
+            if len(self._buffer) == num:
+                break
+            if len(self._buffer) >= self.run_size:
+                self._spill()
+
+    def add_run(self, f):
+        '''
+        Add an open binary file with sorted and unique ids
+        '''
+        self._runs.append(f)
+        if len(self._runs) >= MAX_RUNS:
+            self._compact()
+
+    def _spill(self):
+        run = tempfile.TemporaryFile(dir=self.tmpdir)
+        run.write(array(TYPECODE, unique(sorted(self._buffer))))
+        self._buffer = array(TYPECODE)
+        self.add_run(run)
+
+    def _compact(self):
+        run = tempfile.TemporaryFile(dir=self.tmpdir)
+        ids = unique(merge(*(read_run(r) for r in self._runs)))
+        while True:
+            block = array(TYPECODE, islice(ids, BLOCK_SIZE))
+            if len(block) == 0:
+                break
+            run.write(block)
+        self.close()
+        self._runs = [run]
+
+    def __iter__(self):
+        buffer = array(TYPECODE, unique(sorted(self._buffer)))
+        self._buffer = array(TYPECODE)
+        try:
+            yield from unique(merge(buffer, *(read_run(run) for run in self._runs)))
+        finally:
+            self.close()
+
+    def write_text(self, filename):
+        return write_text(self, filename)
+
+    def close(self):
+        for run in self._runs:
+            run.close()
+        self._runs = []
+
+
+class IDSet:
+    '''
+    Compact set of app ids
+
+    The ids are kept in a sorted array and can be saved to and loaded (or memory-mapped) from a binary file.
+    Added ids are buffered and sorted into the array when needed.
+    '''
+
+    def __init__(self, ids=()):
+        self._ids = array(TYPECODE)
+        self._pending = array(TYPECODE)
+        self.update(ids)
+
+    @classmethod
+    def from_sorted(cls, ids):
+        '''
+        Create a set from an iterable that is already sorted and unique
+        '''
+        s = cls()
+        s._ids = ids if isinstance(ids, (array, memoryview)) else array(TYPECODE, ids)
+        return s
+
+    @classmethod
+    def from_text(cls, filename):
+        '''
+        Read a file with one id per line
+        '''
+        with open(filename) as f:
+            return cls(int(line) for line in f if line.strip())
+
+    @classmethod
+    def load(cls, filename, use_mmap=False):
+        '''
+        Load a set saved with save(). With use_mmap the file gets mapped instead of read.
+        '''
+        with open(filename, 'rb') as f:
+            if not use_mmap:
+                ids = array(TYPECODE)
+                ids.frombytes(f.read())
+                return cls.from_sorted(ids)
+            try:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty file
+                return cls()
+        return cls.from_sorted(memoryview(m).cast(TYPECODE))
+
+    def save(self, filename):
+        self._flush()
+        with open(filename, 'wb') as f:
+            f.write(self._ids)
+
+    def write_text(self, filename):
+        '''
+        Write one id per line
+        '''
+        self._flush()
+        return write_text(self._ids, filename)
+
+    def add(self, app_id):
+        self._pending.append(app_id)
+        if len(self._pending) >= CHUNK_SIZE:
+            self._flush()
+
+    def update(self, ids):
+        it = iter(ids)
+        while True:
+            chunk = array(TYPECODE, islice(it, CHUNK_SIZE))
+            if len(chunk) == 0:
+                break
+            self._pending.extend(chunk)
+            if len(self._pending) >= CHUNK_SIZE:
+                self._flush()
+
+    def difference(self, other):
+        self._flush()
+        other = other if isinstance(other, IDSet) else IDSet(other)
+        other._flush()
+        return IDSet.from_sorted(array(TYPECODE, difference(self._ids, other._ids)))
+
+    def union(self, other):
+        self._flush()
+        other = other if isinstance(other, IDSet) else IDSet(other)
+        other._flush()
+        return IDSet.from_sorted(array(TYPECODE, unique(merge(self._ids, other._ids))))
+
+    __sub__ = difference
+    __or__ = union
+
+    def _flush(self):
+        if len(self._pending) == 0:
+            return
+        pending = sorted(self._pending)
+        self._pending = array(TYPECODE)
+        self._ids = array(TYPECODE, unique(merge(self._ids, pending)))
+
+    def __contains__(self, app_id):
+        self._flush()
+        i = bisect_left(self._ids, app_id)
+        return i < len(self._ids) and self._ids[i] == app_id
+
+    def __len__(self):
+        self._flush()
+        return len(self._ids)
+
+    def __iter__(self):
+        self._flush()
+        return iter(self._ids)
@@ -10,3 +10,18 @@ class AppstoreItem(scrapy.Item):
     # define the fields for your item here like:
     # name = scrapy.Field()
     pass
+
+
+class AppItem(scrapy.Item):
+    # metadata (or only the crawl status) of an app, saved by the AppstorePipeline
+    endpoint = scrapy.Field()
+    storefront = scrapy.Field()
+    app_id = scrapy.Field()
+    # done, failed or missing (see appstore.state)
+    status = scrapy.Field()
+    # raw json, None if there is nothing to save
+    data = scrapy.Field()
+    # release date of the latest version (unix time), if known
+    modified = scrapy.Field()
+    # raw response of the ua endpoint, saved compressed if the spider keeps it (ua_raw)
+    raw = scrapy.Field()
@@ -0,0 +1,194 @@
+'''
+Metrics of a crawl: counters, gauges and histograms per endpoint (requests, 429s, apps per response, writes, queues)
+
+Updating a metric is a dict lookup and an addition, so it is done for every response and item.
+Gauges like queue lengths are functions that are only called when the metrics are rendered.
+The CrawlMetrics extension (appstore/extensions.py) logs a summary and writes them to a file on a timer,
+in the Prometheus text format or as JSON.
+'''
+
+from bisect import bisect_left
+from collections import namedtuple
+import json
+import os
+from time import time
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# amp batches have up to 100 apps, genre pages up to about 200
+APPS_BUCKETS = (0, 1, 10, 25, 50, 75, 100, 200)
+WRITE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+Metric = namedtuple('Metric', 'kind labels help buckets', defaults=(None,))
+
+# the endpoint of responses is their download slot (amp, amp_single, ua, genre), the one of apps amp, ua or genre
+METRICS = {
+    'appstore_responses_total': Metric(COUNTER, ('endpoint', 'status'), 'Downloaded responses by HTTP status'),
+    'appstore_response_bytes_total': Metric(COUNTER, ('endpoint',), 'Size of the downloaded responses'),
+    'appstore_response_seconds': Metric(HISTOGRAM, ('endpoint',), 'Download latency', LATENCY_BUCKETS),
+    'appstore_apps_per_response': Metric(HISTOGRAM, ('endpoint',), 'Apps in a response', APPS_BUCKETS),
+    'appstore_apps_total': Metric(COUNTER, ('endpoint', 'status'), 'Crawled apps by status (app ids of genre pages)'),
+    'appstore_apps_done': Metric(GAUGE, ('endpoint',), 'Apps that are done, including the ones done before'),
+    'appstore_apps_input': Metric(GAUGE, ('endpoint',), 'Apps to crawl'),
+    'appstore_written_apps_total': Metric(COUNTER, ('endpoint',), 'Apps that were written (new or changed)'),
+    'appstore_written_bytes_total': Metric(COUNTER, ('endpoint',), 'Size of the metadata that was written'),
+    'appstore_write_seconds': Metric(HISTOGRAM, (), 'Time to write a batch', WRITE_BUCKETS),
+    'appstore_write_queue': Metric(GAUGE, (), 'Batches that wait to be written'),
+    'appstore_scheduler_queue': Metric(GAUGE, (), 'Requests in the scheduler'),
+    'appstore_downloader_active': Metric(GAUGE, (), 'Requests that are downloading'),
+    'appstore_download_delay_seconds': Metric(GAUGE, ('endpoint',), 'Delay of the download slot'),
+    'appstore_page_cache_total': Metric(COUNTER, ('result',), 'Cached pages: fresh, revalidated (304) or downloaded'),
+}
+
+
+def num_fmt(num):
+    '''
+    Format big numbers human readable
+    '''
+    num = float('{:.3g}'.format(num))
+    magnitude = 0
+    while abs(num) >= 1000:
+        magnitude += 1
+        num /= 1000.0
+    return '{}{}'.format('{:f}'.format(num).rstrip('0').rstrip('.'), ['', 'K', 'M', 'B', 'T'][magnitude])
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # the last count is for values above the last bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        '''
+        (upper bound, count of values <= bound) per bucket, the last bound is '+Inf'
+        '''
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            yield bound, total
+
+
+class Metrics:
+    '''
+    The metrics of METRICS, the label values are tuples in the order of the label names
+    '''
+
+    def __init__(self):
+        # name: {label values: number or Histogram}
+        self.values = {name: {} for name in METRICS}
+        # name: {label values: function}
+        self.functions = {name: {} for name, metric in METRICS.items() if metric.kind == GAUGE}
+        self.started = time()
+
+    def inc(self, name, labels=(), value=1):
+        values = self.values[name]
+        values[labels] = values.get(labels, 0) + value
+
+    def set(self, name, labels, value):
+        self.values[name][labels] = value
+
+    def observe(self, name, labels, value):
+        histogram = self.values[name].get(labels)
+        if histogram is None:
+            histogram = self.values[name][labels] = Histogram(METRICS[name].buckets)
+        histogram.observe(value)
+
+    def track(self, name, labels, function):
+        '''
+        The gauge gets the value of function() when the metrics are collected
+        '''
+        self.functions[name][labels] = function
+
+    def collect(self):
+        '''
+        Update the gauges with functions
+        '''
+        for name, functions in self.functions.items():
+            for labels, function in functions.items():
+                self.values[name][labels] = function()
+
+    def totals(self, name, where=None):
+        '''
+        Sums of a counter per endpoint (the first label), optionally only where the second label has that value
+        '''
+        sums = {}
+        for labels, value in self.values[name].items():
+            if where is None or labels[1] == where:
+                sums[labels[0]] = sums.get(labels[0], 0) + value
+        return sums
+
+    def prometheus(self):
+        '''
+        The metrics in the Prometheus text format
+        '''
+        lines = []
+        for name, metric in METRICS.items():
+            values = self.values[name]
+            if len(values) == 0:
+                continue
+            lines.append(f'# HELP {name} {metric.help}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            for labels, value in sorted(values.items(), key=lambda item: str(item[0])):
+                pairs = [f'{label}={json.dumps(str(v))}' for label, v in zip(metric.labels, labels)]
+                if metric.kind != HISTOGRAM:
+                    lines.append(f'{name}{{{",".join(pairs)}}} {value}' if pairs else f'{name} {value}')
+                    continue
+                for bound, count in value.cumulative():
+                    lines.append(f'{name}_bucket{{{",".join(pairs + [f"le={json.dumps(str(bound))}"])}}} {count}')
+                suffix = f'{{{",".join(pairs)}}}' if pairs else ''
+                lines.append(f'{name}_sum{suffix} {value.sum}')
+                lines.append(f'{name}_count{suffix} {value.count}')
+        return '\n'.join(lines) + '\n'
+
+    def as_dict(self):
+        '''
+        The metrics for a JSON dump: {name: [{"labels": {...}, "value": ...}]}, histograms with buckets, sum and count
+        '''
+        metrics = {}
+        for name, metric in METRICS.items():
+            entries = []
+            for labels, value in self.values[name].items():
+                entry = {'labels': {label: str(v) for label, v in zip(metric.labels, labels)}}
+                if metric.kind == HISTOGRAM:
+                    entry['buckets'] = {str(bound): count for bound, count in value.cumulative()}
+                    entry['sum'] = value.sum
+                    entry['count'] = value.count
+                else:
+                    entry['value'] = value
+                entries.append(entry)
+            if entries:
+                metrics[name] = entries
+        return {'time': time(), 'started': self.started, 'metrics': metrics}
+
+    def write(self, filename):
+        '''
+        Write the metrics to filename (JSON if it ends with .json, else Prometheus text), replaced at once
+        '''
+        data = json.dumps(self.as_dict()) if filename.endswith('.json') else self.prometheus()
+        tmp = f'{filename}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.replace(tmp, filename)
+
+
+def crawler_metrics(crawler):
+    '''
+    The Metrics of a crawler, shared by the extension, the pipeline and the spiders
+    '''
+    metrics = getattr(crawler, 'appstore_metrics', None)
+    if metrics is None:
+        metrics = crawler.appstore_metrics = Metrics()
+    return metrics
@@ -0,0 +1,116 @@
+'''
+Cache of pages for conditional requests (used by the PageCacheMiddleware and the appstore_ids spider)
+
+Every page is kept by url with its ETag and Last-Modified and either its body (kind 'body')
+or the data the spider extracted from it (e.g. kind 'ids': the app ids and page numbers of a letter page),
+compressed with zlib in a SQLite file. A page that did not change is then answered from the cache
+and the spider reuses its data instead of parsing it again.
+'''
+
+from collections import namedtuple
+from time import time
+import json
+import os
+import sqlite3
+import zlib
+
+BODY = 'body'
+
+# payload: the body (bytes) or the extracted data (decoded json)
+Entry = namedtuple('Entry', 'url fetched etag last_modified content_type kind payload')
+
+
+class PageCache:
+    '''
+    SQLite file of the cached pages, changes are committed in batches of commit_every and on close()
+    '''
+
+    def __init__(self, filename, commit_every=500):
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.filename = filename
+        self._commit_every = commit_every
+        self._uncommitted = 0
+        self._db = sqlite3.connect(filename)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            '''CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                fetched REAL NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                content_type TEXT,
+                kind TEXT NOT NULL,
+                payload BLOB NOT NULL
+            ) WITHOUT ROWID'''
+        )
+        self._db.commit()
+
+    def get(self, url):
+        '''
+        The Entry of url (None if it is not cached)
+        '''
+        row = self._db.execute('SELECT * FROM pages WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return None
+        url, fetched, etag, last_modified, content_type, kind, payload = row
+        payload = zlib.decompress(payload)
+        if kind != BODY:
+            payload = json.loads(payload)
+        return Entry(url, fetched, etag, last_modified, content_type, kind, payload)
+
+    def put(self, url, kind, payload, etag=None, last_modified=None, content_type=None, fetched=None):
+        '''
+        Cache a page with its body (kind BODY) or the data extracted from it (any other kind, json serializable)
+        '''
+        data = payload if kind == BODY else json.dumps(payload, separators=(',', ':')).encode()
+        row = (url, fetched or time(), etag, last_modified, content_type, kind, zlib.compress(data))
+        self._db.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)', row)
+        self._changed()
+
+    def save(self, response, kind=BODY, data=None):
+        '''
+        Cache a downloaded page with its validators, the body or the data extracted from it
+        '''
+        headers = response.headers
+
+        def header(name):
+            value = headers.get(name)
+            return value.decode('latin-1') if value is not None else None
+
+        payload = response.body if kind == BODY else data
+        self.put(response.url, kind, payload, header('ETag'), header('Last-Modified'), header('Content-Type'))
+
+    def touch(self, url):
+        '''
+        The page was revalidated (it did not change)
+        '''
+        self._db.execute('UPDATE pages SET fetched = ? WHERE url = ?', (time(), url))
+        self._changed()
+
+    def _changed(self):
+        self._uncommitted += 1
+        if self._uncommitted >= self._commit_every:
+            self.commit()
+
+    def commit(self):
+        self._db.commit()
+        self._uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self._db.close()
+
+
+def crawler_page_cache(crawler):
+    '''
+    The PageCache of a crawler, shared by the PageCacheMiddleware and the spider
+    (None without APPSTORE_PAGE_CACHE or APPSTORE_PAGE_CACHE_TTL)
+    '''
+    cache = getattr(crawler, 'appstore_page_cache', None)
+    filename = crawler.settings.get('APPSTORE_PAGE_CACHE')
+    if cache is None and filename and crawler.settings.getdict('APPSTORE_PAGE_CACHE_TTL'):
+        cache = crawler.appstore_page_cache = PageCache(filename)
+    return cache
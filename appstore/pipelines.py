@@ -3,11 +3,241 @@
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 
+from concurrent.futures import ProcessPoolExecutor
+from time import time
+
+from twisted.internet import defer, reactor, task, threads
+from twisted.python.threadpool import ThreadPool
 
 # useful for handling different item types with a single interface
 from itemadapter import ItemAdapter
 
+from appstore.items import AppItem
+from appstore.metrics import crawler_metrics
+from appstore.state import content_hash, CHANGED, FAILED, MISSING, NEW, REMOVED
+from appstore.ua import extract_ua
+
+# sent with the items of every batch that got written
+items_written = object()
+
+
+def deferred_from_future(future):
+    '''
+    Deferred that fires in the reactor thread with the result of a concurrent.futures.Future
+    '''
+    d = defer.Deferred()
+
+    def done(future):
+        error = future.exception()
+        if error is not None:
+            reactor.callFromThread(d.errback, error)
+        else:
+            reactor.callFromThread(d.callback, future.result())
+
+    future.add_done_callback(done)
+    return d
+
+
+class UAExtractPipeline:
+    '''
+    Replaces the responses of the UA endpoint in AppItems (endpoint ua) with the metadata of the app
+    in the schema of the amp api (see appstore/ua.py), before the AppstorePipeline saves them.
+
+    The extraction runs in APPSTORE_UA_WORKERS processes (0: in the reactor thread),
+    so parsing the big responses does not block the crawl.
+    With spider.raw_storages the raw response is kept as well (item raw), the AppstorePipeline saves it compressed.
+    Responses without the app are saved as failed, they are crawled again by the next run.
+    '''
+
+    def __init__(self, crawler):
+        self.workers = crawler.settings.getint('APPSTORE_UA_WORKERS')
+        self._pool = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def open_spider(self, spider):
+        if self.workers > 0:
+            self._pool = ProcessPoolExecutor(self.workers)
+
+    def close_spider(self, spider):
+        if self._pool is not None:
+            self._pool.shutdown()
+
+    def process_item(self, item, spider):
+        if not isinstance(item, AppItem) or item['endpoint'] != 'ua' or item['data'] is None:
+            return item
+        sf = spider.storefronts[item['storefront']]
+        if item['storefront'] in getattr(spider, 'raw_storages', {}):
+            item['raw'] = item['data']
+        args = (item['data'], item['app_id'], sf.country, sf.platform)
+        if self._pool is None:
+            try:
+                return self._extracted(extract_ua(*args), item)
+            except ValueError as e:
+                return self._failed(e, item, spider)
+        d = deferred_from_future(self._pool.submit(extract_ua, *args))
+        d.addCallback(self._extracted, item)
+        d.addErrback(lambda f: self._failed(f.value, item, spider))
+        return d
+
+    def _extracted(self, result, item):
+        item['data'], item['modified'] = result
+        return item
+
+    def _failed(self, error, item, spider):
+        app_id, storefront = item['app_id'], item['storefront']
+        spider.logger.warning(f'Could not extract app {app_id} of the ua response ({storefront}): {error}')
+        item['status'] = FAILED
+        item['data'] = None
+        item['raw'] = None
+        return item
+
 
 class AppstorePipeline:
+    '''
+    Saves AppItems to the storage of their storefront and the crawl state of the spider
+    (spider.storages[storefront], spider.crawl_state).
+    Apps that did not change since the last crawl (same hash) are not written again,
+    new, changed and removed apps are logged in spider.change_log.
+
+    Items are collected in batches that get written by a single background thread,
+    so the reactor never waits for the disk. When too many batches are waiting to be written
+    process_item returns a deferred, which makes scrapy slow down (backpressure).
+    All items are written before the spider is closed.
+    The storages are flushed before the items of a batch are set in the crawl state, so apps that are done are stored.
+    After every written batch the items_written signal is sent.
+    Other items are passed through.
+    The raw responses of items with raw (see UAExtractPipeline) are saved to spider.raw_storages (endpoint ua_raw).
+    The apps, written bytes, write latency and the batches that wait are counted in the metrics of the crawl.
+    '''
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        settings = crawler.settings
+        self.batch_size = settings.getint('APPSTORE_WRITE_BATCH_SIZE')
+        self.batch_bytes = settings.getint('APPSTORE_WRITE_BATCH_BYTES')
+        self.max_pending = settings.getint('APPSTORE_WRITE_QUEUE_SIZE')
+        self.interval = settings.getfloat('APPSTORE_WRITE_INTERVAL')
+        self.metrics = crawler_metrics(crawler)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def open_spider(self, spider):
+        self._batch = []
+        self._bytes = 0
+        self._writes = set()
+        self._waiting = []
+        self._pool = ThreadPool(1, 1, name='appstore-writer')
+        self._pool.start()
+        self._loop = task.LoopingCall(self.flush, spider)
+        self._loop.start(self.interval, now=False)
+        self.metrics.track('appstore_write_queue', (), lambda: len(self._writes))
+
     def process_item(self, item, spider):
+        if not isinstance(item, AppItem):
+            return item
+        self.metrics.inc('appstore_apps_total', (item['endpoint'], item['status']))
+        self._batch.append(item)
+        if item['data'] is not None:
+            self._bytes += len(item['data'])
+        if len(self._batch) >= self.batch_size or self._bytes >= self.batch_bytes:
+            return self.flush(spider).addCallback(lambda _: item)
         return item
+
+    def flush(self, spider):
+        '''
+        Hand the current batch to the writer thread.
+        The returned deferred fires when there is room for more batches.
+        '''
+        if len(self._batch) > 0:
+            batch, self._batch, self._bytes = self._batch, [], 0
+            d = threads.deferToThreadPool(reactor, self._pool, self._write, spider, batch)
+            d.addCallback(self._count_written)
+            d.addCallback(lambda _: self.crawler.signals.send_catch_log(items_written, items=batch, spider=spider))
+            d.addErrback(lambda f: spider.logger.error(f'Writing {len(batch)} items failed: {f.getTraceback()}'))
+            d.addBoth(self._written, d)
+            self._writes.add(d)
+        if len(self._writes) <= self.max_pending:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._waiting.append(d)
+        return d
+
+    def _written(self, _, d):
+        self._writes.discard(d)
+        if len(self._writes) <= self.max_pending:
+            waiting, self._waiting = self._waiting, []
+            for w in waiting:
+                w.callback(None)
+
+    def _count_written(self, result):
+        written, seconds = result
+        for endpoint, (count, size) in written.items():
+            self.metrics.inc('appstore_written_apps_total', (endpoint,), count)
+            self.metrics.inc('appstore_written_bytes_total', (endpoint,), size)
+        self.metrics.observe('appstore_write_seconds', (), seconds)
+
+    def _write(self, spider, batch):
+        # runs in the writer thread, returns the apps and bytes written per endpoint and the time it took
+        start = time()
+        written = {}
+        groups = {}
+        for item in batch:
+            groups.setdefault((item['endpoint'], item['storefront']), []).append(item)
+
+        # storages that got written and the states per group: the storages are flushed
+        # before the crawl state is changed (a resume skips the apps that are done, so they have to be stored)
+        flush = {}
+        updates = []
+        for (endpoint, storefront), items in groups.items():
+            storage = spider.storages[storefront]
+            old_hashes = spider.crawl_state.hashes(endpoint, storefront, [item['app_id'] for item in items])
+            states = {}
+            for item in items:
+                app_id = item['app_id']
+                h = None
+                if item['data'] is not None:
+                    h = content_hash(item['data'])
+                    old_hash = old_hashes.get(int(app_id), False)
+                    # unchanged apps are not written again
+                    if old_hash != h:
+                        storage.write(endpoint, app_id, item['data'])
+                        flush[id(storage)] = storage
+                        count, size = written.get(endpoint, (0, 0))
+                        written[endpoint] = (count + 1, size + len(item['data']))
+                        if item.get('raw') is not None:
+                            spider.raw_storages[storefront].write(f'{endpoint}_raw', app_id, item['raw'])
+                            flush[id(spider.raw_storages[storefront])] = spider.raw_storages[storefront]
+                            count, size = written.get(f'{endpoint}_raw', (0, 0))
+                            written[f'{endpoint}_raw'] = (count + 1, size + len(item['raw']))
+                        spider.change_log.write(endpoint, storefront, app_id, NEW if old_hash is False else CHANGED)
+                elif item['status'] == FAILED and int(app_id) in old_hashes:
+                    # a failed refresh keeps the metadata of the last crawl
+                    continue
+                elif item['status'] == MISSING and int(app_id) in old_hashes:
+                    spider.change_log.write(endpoint, storefront, app_id, REMOVED)
+                s = states.setdefault(item['status'], ([], [], []))
+                s[0].append(app_id)
+                s[1].append(h)
+                s[2].append(item.get('modified'))
+            updates.append((endpoint, storefront, states))
+        for storage in flush.values():
+            storage.flush()
+        for endpoint, storefront, states in updates:
+            for status, (app_ids, hashes, modified) in states.items():
+                spider.crawl_state.set(endpoint, storefront, app_ids, status, hashes, modified)
+        spider.crawl_state.commit()
+        spider.change_log.flush()
+        return written, time() - start
+
+    @defer.inlineCallbacks
+    def close_spider(self, spider):
+        if self._loop.running:
+            self._loop.stop()
+        self.flush(spider)
+        yield defer.DeferredList(list(self._writes))
+        self._pool.stop()
@@ -0,0 +1,95 @@
+from array import array
+import json
+
+from appstore.idset import IDSet, TYPECODE
+
+# number of different request priorities (scrapy has a queue for each of them)
+LEVELS = 10
+
+
+def read_scores(filename):
+    '''
+    Read a file with an app id and an optional score (default: 1) per line, e.g. "310633997 12.5"
+    A file with ids only (like US_popular_ids) gives all of them the same priority.
+    '''
+    with open(filename) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 0:
+                continue
+            yield int(parts[0]), float(parts[1]) if len(parts) > 1 else 1.0
+
+
+def category_scores(filename, categories):
+    '''
+    Scores of the apps of categories from the json file of collect.py.
+    The first category gets the highest score, popular apps of a category get 0.5 more.
+    '''
+    with open(filename) as f:
+        data = json.load(f)
+    scores = {}
+    for i, category_id in enumerate(categories):
+        score = len(categories) - i
+        category = data.get(str(category_id), {})
+        for app_id in category.get('apps', []):
+            scores[app_id] = max(scores.get(app_id, 0), score)
+        for app_id in category.get('popular-apps', []):
+            scores[app_id] = max(scores.get(app_id, 0), score + 0.5)
+    return scores.items()
+
+
+class Priorities:
+    '''
+    App ids ordered by their score (highest first) and their request priority
+
+    The ids are split into LEVELS groups of the same size,
+    the request priority of the first group is LEVELS and of the last one 1.
+    Ids without a score have priority 0.
+    '''
+
+    def __init__(self, scores):
+        order = sorted(scores, key=scores.__getitem__, reverse=True)
+        self.ids = array(TYPECODE, order)
+        self.id_set = IDSet(order)
+
+    def restrict(self, ids):
+        '''
+        Drop the ids that are not in ids (an IDSet)
+        '''
+        self.ids = array(TYPECODE, (app_id for app_id in self.ids if app_id in ids))
+        self.id_set = IDSet(self.ids)
+
+    def priority(self, rank):
+        '''
+        Request priority of the id at position rank
+        '''
+        return LEVELS - rank * LEVELS // max(len(self.ids), 1)
+
+    def __iter__(self):
+        '''
+        Iterate over (app id, request priority)
+        '''
+        for rank, app_id in enumerate(self.ids):
+            yield app_id, self.priority(rank)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def load_priorities(priority_file=None, categories_file=None, categories=None):
+    '''
+    Priorities from a score file and/or categories of a json file of collect.py (scores are added up).
+    Returns None when there is nothing to prioritize.
+    '''
+    scores = {}
+    if priority_file is not None:
+        for app_id, score in read_scores(priority_file):
+            scores[app_id] = scores.get(app_id, 0) + score
+    if categories is not None:
+        if categories_file is None:
+            raise ValueError('Prioritizing categories needs the json file of collect.py (categories_file=...)')
+        for app_id, score in category_scores(categories_file, categories):
+            scores[app_id] = scores.get(app_id, 0) + score
+    if len(scores) == 0:
+        return None
+    return Priorities(scores)
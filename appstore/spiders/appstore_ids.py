@@ -1,25 +1,32 @@
 import scrapy
 import json
+from urllib.parse import parse_qs, urlsplit
 
+from appstore.frontier import Frontier
+from appstore.genre import app_ids, app_links, letter_links, page_numbers
+from appstore.metrics import crawler_metrics
+from appstore.middlewares import download_slots
+from appstore.pagecache import crawler_page_cache
 
-def num_fmt(num):
-    '''
-    Format big numbers human readable
-    '''
-    num = float('{:.3g}'.format(num))
-    magnitude = 0
-    while abs(num) >= 1000:
-        magnitude += 1
-        num /= 1000.0
-    return '{}{}'.format('{:f}'.format(num).rstrip('0').rstrip('.'), ['', 'K', 'M', 'B', 'T'][magnitude])
+# meta of the requests of the pages of a letter
+LETTER_META = ('download_slot', 'page_cache_data', 'country', 'category_id', 'letter', 'letter_url')
 
 
 class AppstoreIDsSpider(scrapy.Spider):
     name = "appstore_ids"
 
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        # delay and concurrency of the genre slot (APPSTORE_DOWNLOAD_SLOTS)
+        crawler.settings.set('DOWNLOAD_SLOTS', download_slots(crawler.settings), 'spider')
+        return spider
+
     def start_requests(self):
         print('\nStarting')
         self.country = getattr(self, 'country', 'us')
+        # multiple countries are crawled in parallel, the items have the country
+        self._countries = list(dict.fromkeys(c.strip() for c in self.country.split(',')))
         saveurls = getattr(self, 'saveurls', None)
         if saveurls is None or saveurls.lower() == 'false':
             self._saveurls = False
@@ -30,20 +37,31 @@ class AppstoreIDsSpider(scrapy.Spider):
             return
 
         self._level = int(getattr(self, 'level', 0))
-        self._apps = 0
-        self._pages = 0
-
-        self.logger.info(f'Crawling the appstore for country "{self.country}"')
+        # pages and app ids of the letters (the CrawlMetrics extension logs them)
+        self.metrics = crawler_metrics(self.crawler)
+        # pages that are requested before they are linked (0: only linked pages)
+        self._frontier = Frontier(int(getattr(self, 'prefetch', self.settings.getint('APPSTORE_IDS_PREFETCH'))))
+        # the app ids (or links with saveurls) of unchanged pages are reused (PageCacheMiddleware)
+        self._page_cache = crawler_page_cache(self.crawler)
+        self._page_data = 'links' if self._saveurls else 'ids'
+
+        self.logger.info(f'Crawling the appstore for countries "{", ".join(self._countries)}"')
         self.logger.info(f'saveurls is set to {self._saveurls}')
         explanation = '(0: max (default), 1: categories only, 2: also popular apps, 3+: also all apps)'
         self.logger.info(f'level is set to {self._level} {explanation}')
+        self.logger.info(f'prefetch is set to {self._frontier.prefetch} pages')
+        if self._page_cache is not None:
+            self.logger.info(f'Using the page cache {self._page_cache.filename}')
 
         self.download_delay = self.settings['DOWNLOAD_DELAY_IDS']
         self.logger.info(f'Download delay is {self.download_delay} seconds')
-        url = f'https://apps.apple.com/{self.country}/genre/ios/id36'
-        yield scrapy.Request(url, self.parse_main)
+        for country in self._countries:
+            url = f'https://apps.apple.com/{country}/genre/ios/id36'
+            yield scrapy.Request(url, self.parse_main, meta={'download_slot': 'genre', 'country': country})
 
     def parse_main(self, response):
+        country = response.meta['country']
+        meta = {'download_slot': 'genre', 'page_cache_data': self._page_data, 'country': country}
 
         categories = []
         # main categorie that has no subcategories
@@ -82,78 +100,100 @@ class AppstoreIDsSpider(scrapy.Spider):
                     'subcategories': subcategories,
                 }
             )
-        with open(f'categories_{self.country}.json', 'w') as f:
+        with open(f'categories_{country}.json', 'w') as f:
             json.dump(categories, f, indent=2)
 
         if self._level != 1:
             for url in main_categories_without_sub_urls:
                 url = response.urljoin(url)
-                yield scrapy.Request(url, callback=self.parse_categorie)
+                yield scrapy.Request(url, callback=self.parse_categorie, meta=meta)
             for url in sub_categories_urls:
                 url = response.urljoin(url)
-                yield scrapy.Request(url, callback=self.parse_categorie)
+                yield scrapy.Request(url, callback=self.parse_categorie, meta=meta)
             for url in main_categories_with_sub:
                 url = response.urljoin(url)
-                yield scrapy.Request(url, callback=self.parse_categorie)
+                yield scrapy.Request(url, callback=self.parse_categorie, meta=meta)
 
     def parse_categorie(self, response):
+        country = response.meta['country']
         cat_id = response.url.split('/id')[1]
-        apps = []
-        for url in response.css('.grid3-column a::attr(href)').getall():
-            app_id = int(url.split('/')[-1].lstrip('id').split('?')[0])
-            if self._saveurls:
-                apps.append({'id': app_id, 'url': url})
-            else:
-                apps.append(app_id)
-
+        data = self.page_data(response, lambda: {'apps': self.apps(response), 'letters': letter_links(response)})
         yield {
+            'country': country,
             'category_id': cat_id,
-            'popular-apps': apps,
+            'popular-apps': data['apps'],
         }
 
         # get letters
         if self._level >= 3 or self._level == 0:
-            for url in response.css('ul.alpha li a::attr(href)').getall():
-                url = response.urljoin(url)
-                yield scrapy.Request(url, callback=self.parse_categorie_letter)
+            for url in data['letters']:
+                letter = parse_qs(urlsplit(url).query)['letter'][0]
+                meta = {
+                    'download_slot': 'genre',
+                    'page_cache_data': self._page_data,
+                    'country': country,
+                    'category_id': cat_id,
+                    'letter': letter,
+                    'letter_url': url,
+                }
+                # the first page of a letter is the same as page 1
+                yield from self.letter_requests(meta, self._frontier.start((country, cat_id, letter)))
+
+    def apps(self, response):
+        if self._saveurls:
+            return [{'id': app_id, 'url': url} for app_id, url in app_links(response)]
+        return app_ids(response)
+
+    def page_data(self, response, extract):
+        '''
+        The data of a page: the data extracted before if the page did not change (answered from the page cache),
+        else extract(), which gets cached
+        '''
+        if response.meta.get('cached_data') is not None:
+            return response.meta['cached_data']
+        data = extract()
+        if self._page_cache is not None:
+            self._page_cache.save(response, self._page_data, data)
+        return data
+
+    def letter_requests(self, meta, pages):
+        for page in pages:
+            yield scrapy.Request(
+                f'{meta["letter_url"]}&page={page}',
+                callback=self.parse_categorie_letter,
+                errback=self.errback_letter,
+                meta=dict(meta, page=page),
+                # the frontier requests every page once, the dupefilter does not need to remember them
+                dont_filter=True,
+            )
 
     def parse_categorie_letter(self, response):
-        cat_id, end = response.url.split('/id')[-1].split('?letter=')
-        if len(end) == 1:
-            letter = end
-            page = '0'
-        else:
-            letter, page = end.split('&page=')
-
-        print(f'Parsing {cat_id} {letter} {page:>3};', end=' ')
-        print(
-            f'Done {num_fmt(self._pages):>4}/~20k pages, {num_fmt(self._apps):>5}/~2.3M apps   ',
-            end='\r',
-        )
-
-        # skip initial page as it would create dupicates
-        if page != '0':
-            self._pages += 1
-            apps = []
-
-            # yes, there are duplicates...
-            urls_unique = set(response.css('.grid3-column a::attr(href)').getall())
-            for url in urls_unique:
-                app_id = int(url.split('/')[-1].lstrip('id').split('?')[0])
-                self._apps += 1
-                if self._saveurls:
-                    apps.append({'id': app_id, 'url': url})
-                else:
-                    apps.append(app_id)
-
+        meta = {key: response.meta[key] for key in LETTER_META}
+        country, cat_id, letter, page = meta['country'], meta['category_id'], meta['letter'], response.meta['page']
+
+        # yes, there are duplicates... (app_links drops them)
+        data = self.page_data(response, lambda: {'apps': self.apps(response), 'pages': sorted(page_numbers(response))})
+        apps = data['apps']
+        key = (country, cat_id, letter)
+        pages, after_last = self._frontier.parsed(key, page, data['pages'], len(apps) == 0)
+        # a prefetched page after the last page
+        if not after_last:
+            self.metrics.observe('appstore_apps_per_response', ('genre',), len(apps))
+            self.metrics.inc('appstore_apps_total', ('genre', 'done'), len(apps))
             yield {
+                'country': country,
                 'category_id': cat_id,
                 'letter': letter,
-                'page': page,
+                'page': str(page),
                 'apps': apps,
             }
 
         # get pages
-        for url in response.css('ul.paginate a::attr(href)').getall():
-            url = response.urljoin(url)
-            yield scrapy.Request(url, callback=self.parse_categorie_letter)
+        yield from self.letter_requests(meta, pages)
+
+    def errback_letter(self, failure):
+        meta = {key: failure.request.meta[key] for key in LETTER_META}
+        key = (meta['country'], meta['category_id'], meta['letter'])
+        page = failure.request.meta['page']
+        self.logger.warning(f'Page {page} of {" ".join(key)} failed: {failure.value}')
+        yield from self.letter_requests(meta, self._frontier.failed(key, page))
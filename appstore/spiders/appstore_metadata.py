@@ -1,176 +1,524 @@
 import scrapy
+from scrapy.spidermiddlewares.httperror import HttpError
 import json
 from urllib.parse import unquote, urlencode, parse_qs, urlsplit
+from array import array
 from time import time
+from twisted.internet import reactor, task
 import os
+import socket
 
+from appstore.idset import IDSet, TYPECODE
+from appstore.amptoken import Token, load_token, save_token
+from appstore.middlewares import NoToken, download_slots, slot_endpoint, token_expired, token_received
+from appstore.amp import AmpBatcher, last_modified, split_apps
+from appstore.items import AppItem
+from appstore.metrics import crawler_metrics
+from appstore.pipelines import items_written
+from appstore.priority import load_priorities
+from appstore.state import ChangeLog, CrawlState, DONE, FAILED, MISSING
+from appstore.storage import open_storage
+from appstore.workqueue import Lease, open_queue
 
-def num_fmt(num):
+
+# seconds until a token is requested again after a failure, an expired token or another 401
+TOKEN_RETRY_DELAY = 60
+
+
+def count_lines(filename):
+    '''
+    Count the lines of a file without decoding it
+    '''
+    with open(filename, 'rb') as f:
+        return sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(1 << 20), b''))
+
+
+PLATFORMS = ['appletv', 'ipad', 'mac', 'watch', 'iphone']
+
+
+def parse_storefronts(storefronts, countries, platforms, locales):
+    '''
+    List of (country, platform, locale) tuples.
+    Either from storefronts ("us/iphone/en-US,de/iphone/de-DE")
+    or every combination of the comma separated countries, platforms and locales.
+    '''
+    if storefronts is not None:
+        result = []
+        for sf in storefronts.split(','):
+            parts = sf.strip().split('/')
+            if len(parts) != 3:
+                raise ValueError(f'Storefront "{sf}" is not in the format country/platform/locale')
+            result.append(tuple(parts))
+    else:
+        result = [
+            (country.strip(), platform.strip(), locale.strip())
+            for country in countries.split(',')
+            for platform in platforms.split(',')
+            for locale in locales.split(',')
+        ]
+    for _, platform, _ in result:
+        if platform not in PLATFORMS:
+            raise ValueError(f'Unknown platform "{platform}" (one of: {", ".join(PLATFORMS)})')
+    # drop duplicates, keep the order
+    return list(dict.fromkeys(result))
+
+
+class Storefront:
     '''
-    Format big numbers human readable
+    Country, platform and locale of a crawl and what is already done for it
     '''
-    num = float('{:.3g}'.format(num))
-    magnitude = 0
-    while abs(num) >= 1000:
-        magnitude += 1
-        num /= 1000.0
-    return '{}{}'.format('{:f}'.format(num).rstrip('0').rstrip('.'), ['', 'K', 'M', 'B', 'T'][magnitude])
+
+    def __init__(self, country, platform, locale):
+        self.country = country
+        self.platform = platform
+        self.locale = locale
+        self.key = f'{country}/{platform}/{locale}'
+        self.ids_amp_done = None
+        self.ids_ua_done = None
+        # refresh: ids that are done but outdated, the most outdated first
+        self.stale = None
+        self.stale_set = None
+        self.base_url_amp = None
+        self.meta_amp = None
+        self.batcher = None
 
 
 class AppstoreMetaSpider(scrapy.Spider):
     name = "appstore_meta"
 
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        # delay and concurrency per endpoint, the defaults are in APPSTORE_DOWNLOAD_SLOTS
+        # (amp_* is for the slot of the amp method in use: amp or amp_single)
+        spider.download_slots = {}
+        for slots, prefix in [(['amp', 'amp_single'], 'amp'), (['ua'], 'ua')]:
+            conf = {}
+            delay = getattr(spider, prefix + '_delay', None)
+            if delay is not None:
+                conf['delay'] = float(delay)
+            concurrency = getattr(spider, prefix + '_concurrency', None)
+            if concurrency is not None:
+                conf['concurrency'] = int(concurrency)
+            if conf:
+                spider.download_slots.update({slot: conf for slot in slots})
+        crawler.settings.set('DOWNLOAD_SLOTS', download_slots(crawler.settings, spider.download_slots), 'spider')
+        return spider
+
     def start_requests(self):
         print('\nStarting')
 
-        # load input file
         inputfile = getattr(self, 'inputfile', None)
-        if inputfile is None:
-            self.logger.error('An input file with app ids is needed (add inputfile=filename)')
+        queue = getattr(self, 'queue', None)
+        if inputfile is None and queue is None:
+            self.logger.error('An input file with app ids or a work queue is needed (add inputfile=... or queue=...)')
             return
-        ids_in = set()
-        with open(inputfile) as f:
-            for line in f:
-                try:
-                    ids_in.add(int(line.strip()))
-                except ValueError:
-                    self.logger.error('line is not an int:', line.strip())
-                    return
+        self._inputfile = inputfile
         self._outputdir = getattr(self, 'outputdir', 'output')
-        self._amp_dir = os.path.join(self._outputdir, 'amp')
-        self._ua_dir = os.path.join(self._outputdir, 'ua')
-
-        # load ids that are already done via amp
-        try:
-            (_, _, filenames_amp) = next(os.walk(self._amp_dir))
-        except StopIteration:
-            filenames_amp = []
-
-        ids_amp_done = set()
-        for file in set(filenames_amp):
-            try:
-                ids_amp_done.add(int(file.rstrip('.json')))
-            except ValueError:
-                # invalid id (not an int)
-                pass
-        self._ids_amp = ids_in - ids_amp_done
-        self._num_ids_amp = len(self._ids_amp)
-        self._num_ids_amp_done = 0
-
-        # load ids that are already done via ua
-        try:
-            (_, _, filenames_ua) = next(os.walk(self._ua_dir))
-        except StopIteration:
-            filenames_ua = []
-
-        ids_ua_done = set()
-        for file in set(filenames_ua):
-            try:
-                ids_ua_done.add(int(file.rstrip('.json')))
-            except ValueError:
-                # invalid id (not an int)
-                pass
-        self._ids_ua = ids_in - ids_ua_done
-        self._num_ids_ua = len(self._ids_ua)
-        self._num_ids_ua_done = 0
-
-        self._last_ids = {}
-        self._last_status_time = 0
-        self.logger.info(f'Loaded {len(ids_in)} ids from input file.')
-        self.logger.info(f'{len(ids_amp_done)} ids got already crawled via the amp api. Remaining: {self._num_ids_amp}')
-        self.logger.info(f'{len(ids_ua_done)} ids got already crawled via the ua api. Remaining: {self._num_ids_ua}')
 
         self._UA = self.settings['APPSTORE_USER_AGENT']
-        self._country = getattr(self, 'country', 'us')
-        self._platform = getattr(self, 'platform', 'iphone')
-        self._locale = getattr(self, 'locale', 'en-US')
         use_UA = getattr(self, 'use_UA', False)
         if use_UA is False or use_UA.lower() == 'false':
             self._use_UA = False
         elif use_UA.lower() == 'true':
             self._use_UA = True
 
+        ua_raw = getattr(self, 'ua_raw', self.settings.getbool('APPSTORE_UA_RAW'))
+        self._ua_raw = ua_raw is True or str(ua_raw).lower() == 'true'
+
         amp_single = getattr(self, 'amp_single', False)
         if amp_single is False or amp_single.lower() == 'false':
             self._amp_single = False
         elif amp_single.lower() == 'true':
             self._amp_single = True
-            self.download_delay = self.settings['DOWNLOAD_DELAY_AMP_SINGLE']
-            self.logger.info(f'Download delay is {self.download_delay} seconds')
+
+        refresh = getattr(self, 'refresh', False)
+        if refresh is False or refresh.lower() == 'false':
+            self._refresh = False
+        elif refresh.lower() == 'true':
+            self._refresh = True
+        min_days = getattr(self, 'refresh_min_days', self.settings.getfloat('APPSTORE_REFRESH_MIN_DAYS'))
+        max_days = getattr(self, 'refresh_max_days', self.settings.getfloat('APPSTORE_REFRESH_MAX_DAYS'))
+        self._refresh_min_age = float(min_days) * 86400
+        self._refresh_max_age = float(max_days) * 86400
+
+        try:
+            storefronts = parse_storefronts(
+                getattr(self, 'storefronts', None),
+                getattr(self, 'country', 'us'),
+                getattr(self, 'platform', 'iphone'),
+                getattr(self, 'locale', 'en-US'),
+            )
+        except ValueError as e:
+            self.logger.error(e)
+            return
 
         self.logger.info(f'User-Agent is "{self._UA}"')
-        self.logger.info(f'Parameters: country: {self._country}, platform: {self._platform}, locale: {self._locale}')
-        self.logger.info(f'Parameters: use_UA: {self._use_UA}, amp_single: {self._amp_single}')
+        if queue is None:
+            self.logger.info(f'Parameters: storefronts: {", ".join("/".join(sf) for sf in storefronts)}')
+        self.logger.info(f'Parameters: use_UA: {self._use_UA}, ua_raw: {self._ua_raw}, amp_single: {self._amp_single}')
+        self.logger.info(f'Parameters: refresh: {self._refresh} ({min_days} - {max_days} days)')
+        self.logger.info(f'Parameters: download_slots: {self.download_slots}')
 
         # get token for amp api
+        # one token works for all storefronts
         # app_id doesn't matter but has to be valid (using id of WhatsApp now)
+        # amp requests wait in the AmpTokenMiddleware until the token is there
         app_id = '310633997'
-        url = 'https://apps.apple.com/' + self._country + '/app/id' + app_id
+        self._token_url = 'https://apps.apple.com/' + storefronts[0][0] + '/app/id' + app_id
+        self._token_cache = getattr(self, 'token_cache', self.settings['APPSTORE_TOKEN_CACHE'])
+        self._token_refresh_before = self.settings.getint('APPSTORE_TOKEN_REFRESH_BEFORE')
         self._token = None
-        yield scrapy.Request(url, self.start_first_run)
+        self._token_call = None
+        self._refreshing_token = False
+        # time of the last refresh because of a 401
+        self._token_rejected = 0
+        self.crawler.signals.connect(self.token_expired, signal=token_expired)
+        token = load_token(self._token_cache) if self._token_cache else None
+        refresh_at = token.refresh_at(self._token_refresh_before) if token is not None else None
+        if token is not None and (refresh_at is None or time() < refresh_at):
+            self.logger.info(f'Using the cached token of {self._token_cache}')
+            self.use_token(token)
+        else:
+            self.refresh_token()
 
-    def start_first_run(self, response):
-        self.parseJWT(response)
-        return self.scrape_metadata()
+        # every storefront has its own storage, with multiple storefronts in {outputdir}/{country}/{platform}/{locale}
+        # the state index of all storefronts is shared
+        # (it gets built from the storages on the first run or with rebuild_state=true)
+        os.makedirs(self._outputdir, exist_ok=True)
+        self._storage = getattr(self, 'storage', self.settings['APPSTORE_STORAGE'])
+        self.crawl_state = CrawlState(getattr(self, 'statefile', os.path.join(self._outputdir, 'state.sqlite')))
+        rebuild_state = getattr(self, 'rebuild_state', False)
+        rebuild_state = rebuild_state is not False and rebuild_state.lower() == 'true'
+        self._rebuild_state = self.crawl_state.created or rebuild_state
+        self.change_log = ChangeLog(os.path.join(self._outputdir, 'changes.jsonl'))
+
+        self.storefronts = {}
+        self.storages = {}
+        # raw responses of the ua endpoint (ua_raw)
+        self.raw_storages = {}
+        self._work_queue = None
+        self._priorities = None
+        if queue is None:
+            for country, platform, locale in storefronts:
+                self.open_storefront(country, platform, locale, partition=len(storefronts) > 1)
+            self._num_ids_in = count_lines(self._inputfile)
+            self._num_ids_amp = self._num_ids_in * len(storefronts)
+            self._num_ids_ua = self._num_ids_in * len(storefronts)
+            self.logger.info(f'Input file has {self._num_ids_in} ids.')
+
+            # ids of a score file or categories are requested first
+            categories = getattr(self, 'priority_categories', None)
+            try:
+                self._priorities = load_priorities(
+                    getattr(self, 'priority_file', None),
+                    getattr(self, 'categories_file', None),
+                    None if categories is None else categories.split(','),
+                )
+            except (OSError, ValueError) as e:
+                self.logger.error(f'Could not load the priorities: {e}')
+                return
+            if self._priorities is not None:
+                self._priorities.restrict(IDSet(self.read_ids()))
+                self.logger.info(f'{len(self._priorities)} ids of the input file are prioritized.')
+        else:
+            # the storefronts come with the leased batches
+            self._work_queue = open_queue(queue)
+            self._worker = getattr(self, 'worker', f'{socket.gethostname()}-{os.getpid()}')
+            self._lease_time = float(getattr(self, 'lease_time', self.settings.getfloat('APPSTORE_QUEUE_LEASE_TIME')))
+            self._endpoints = ['amp', 'ua'] if self._use_UA else ['amp']
+            # batch id: Lease and (storefront, app id): Lease
+            self._leases = {}
+            self._leased = {}
+            self.crawler.signals.connect(self.items_written, signal=items_written)
+            self._renew_loop = task.LoopingCall(self.renew_leases)
+            self._renew_loop.start(self._lease_time / 3, now=False)
+            self._num_ids_in = self._work_queue.stats()['ids']['total']
+            self._num_ids_amp = self._num_ids_in
+            self._num_ids_ua = self._num_ids_in
+            self.logger.info(f'Worker {self._worker} uses the work queue {queue} with {self._num_ids_in} ids.')
+        self._num_ids_amp_done = 0
+        self._num_ids_ua_done = 0
+
+        # progress in the metrics of the crawl (the CrawlMetrics extension logs it)
+        self.metrics = crawler_metrics(self.crawler)
+        self.metrics.track('appstore_apps_done', ('amp',), lambda: self._num_ids_amp_done)
+        self.metrics.track('appstore_apps_input', ('amp',), lambda: self._num_ids_amp)
+        if self._use_UA:
+            self.metrics.track('appstore_apps_done', ('ua',), lambda: self._num_ids_ua_done)
+            self.metrics.track('appstore_apps_input', ('ua',), lambda: self._num_ids_ua)
+
+        # the engine only pulls start requests when the downloader has room,
+        # so the input file is streamed instead of loaded at once
+        yield from self.scrape_metadata()
+
+    def open_storefront(self, country, platform, locale, partition):
+        '''
+        Open the storage of a storefront and load the ids that are already done
+        '''
+        sf = Storefront(country, platform, locale)
+        outputdir = os.path.join(self._outputdir, sf.key) if partition else self._outputdir
+        self.storages[sf.key] = open_storage(
+            self._storage,
+            outputdir,
+            compression=self.settings['APPSTORE_STORAGE_COMPRESSION'],
+            shard_size=self.settings.getint('APPSTORE_STORAGE_SHARD_SIZE'),
+        )
+        self.logger.info(f'Saving metadata of {sf.key} to {outputdir} using the {self._storage} storage')
+        if self._use_UA and self._ua_raw:
+            # always compressed, whatever the storage of the metadata
+            compression = self.settings['APPSTORE_STORAGE_COMPRESSION']
+            self.raw_storages[sf.key] = open_storage(
+                'jsonl',
+                outputdir,
+                compression='gzip' if compression == 'none' else compression,
+                shard_size=self.settings.getint('APPSTORE_STORAGE_SHARD_SIZE'),
+            )
+        if self._rebuild_state:
+            for endpoint in ['amp', 'ua']:
+                num = self.crawl_state.rebuild(endpoint, sf.key, self.storages[sf.key].ids(endpoint))
+                self.logger.info(f'Rebuilt state index for {endpoint} of {sf.key} from storage: {num} ids')
+        sf.ids_amp_done = self.crawl_state.ids('amp', sf.key)
+        sf.ids_ua_done = self.crawl_state.ids('ua', sf.key)
+        self.logger.info(f'{sf.key}: {len(sf.ids_amp_done)} ids got already crawled via the amp api.')
+        self.logger.info(f'{sf.key}: {len(sf.ids_ua_done)} ids got already crawled via the ua api.')
+        if self._refresh:
+            stale_amp = self.crawl_state.stale('amp', sf.key, self._refresh_min_age, self._refresh_max_age)
+            stale_ua = array(TYPECODE)
+            if self._use_UA:
+                stale_ua = self.crawl_state.stale('ua', sf.key, self._refresh_min_age, self._refresh_max_age)
+            sf.ids_amp_done = sf.ids_amp_done - stale_amp
+            sf.ids_ua_done = sf.ids_ua_done - stale_ua
+            # ordered by the amp staleness
+            stale_amp_set = IDSet(stale_amp)
+            sf.stale = stale_amp + array(TYPECODE, (app_id for app_id in stale_ua if app_id not in stale_amp_set))
+            sf.stale_set = IDSet(sf.stale)
+            self.logger.info(f'{sf.key}: refreshing {len(stale_amp)} amp and {len(stale_ua)} ua ids.')
+
+        sf.base_url_amp = f'https://amp-api.apps.apple.com/v1/catalog/{sf.country}/apps'
+        amp_slot = 'amp_single' if self._amp_single else 'amp'
+        sf.meta_amp = {'download_slot': amp_slot, 'amp_auth': True, 'storefront': sf.key}
+        sf.batcher = AmpBatcher(lambda ids: sf.base_url_amp + '?' + self.get_params(sf, ids=ids))
+        self.storefronts[sf.key] = sf
+        return sf
+
+    def read_ids(self):
+        '''
+        Stream the app ids from the input file
+        '''
+        with open(self._inputfile) as f:
+            for line in f:
+                try:
+                    yield int(line.strip())
+                except ValueError:
+                    self.logger.error(f'line is not an int: {line.strip()}')
+
+    def read_work(self):
+        '''
+        Stream (storefront, app id, request priority) from the input file or from batches leased from the work queue
+        '''
+        priorities = self._priorities
+        if self._work_queue is None:
+            # prioritized apps first, then outdated apps (refresh) and then the rest of the input file
+            if priorities is not None:
+                for app_id, priority in priorities:
+                    for sf in self.storefronts.values():
+                        yield sf, app_id, priority
+            if self._refresh:
+                for sf in self.storefronts.values():
+                    for app_id in sf.stale:
+                        if priorities is None or app_id not in priorities.id_set:
+                            yield sf, app_id, 0
+            # every id is requested for all storefronts before the next one is read
+            for app_id in self.read_ids():
+                if priorities is not None and app_id in priorities.id_set:
+                    continue
+                for sf in self.storefronts.values():
+                    if sf.stale_set is None or app_id not in sf.stale_set:
+                        yield sf, app_id, 0
+            return
+
+        while True:
+            batch = self._work_queue.lease(self._worker, self._lease_time)
+            if batch is None:
+                self.logger.info('The work queue is empty')
+                return
+            sf = self.storefronts.get(batch.storefront)
+            if sf is None:
+                sf = self.open_storefront(*batch.storefront.split('/'), partition=True)
+            self.logger.info(f'Leased batch {batch.id} with {len(batch.app_ids)} ids of {sf.key}')
+            lease = Lease(batch, self._endpoints)
+            self._leases[batch.id] = lease
+            for app_id in batch.app_ids:
+                self._leased[(sf.key, str(app_id))] = lease
+            for app_id in batch.app_ids:
+                yield sf, app_id, 0
 
     def scrape_metadata(self):
-        base_url_amp = f'https://amp-api.apps.apple.com/v1/catalog/{self._country}/apps'
-        header_auth = {'Authorization': 'Bearer ' + self._token}
+        self._input_done = False
 
         # curl https://apps.apple.com/us/app/whatsapp-messenger/id310633997
         #  --user-agent 'AppStore/2.0 iOS/14.4.2 model/iPhone11,2 (6; dt:185)' | jq -S > wa_ua.json
-        base_url_ua = f'https://apps.apple.com/{self._country}/app/'
         header_ua = {'User-Agent': self._UA}
 
-        while len(self._ids_amp) > 0 or (self._use_UA and len(self._ids_ua) > 0):
-            if self._use_UA and len(self._ids_ua) > 0:
-                app_id = self._ids_ua.pop()
-                url_ua = base_url_ua + 'id' + str(app_id) + '?l=' + self._locale
-                yield scrapy.Request(url_ua, self.parse_ua, headers=header_ua)
-
-            elif len(self._ids_amp) > 0:
-                if self._amp_single:
-                    app_id = self._ids_amp.pop()
-                    url_amp = base_url_amp + '/' + str(app_id) + '?' + self.get_params()
+        for sf, app_id, priority in self.read_work():
+            if self._use_UA:
+                if app_id in sf.ids_ua_done:
+                    self._num_ids_ua_done += 1
+                    self.lease_done(sf.key, 'ua', app_id, DONE)
                 else:
-                    app_ids = set()
-                    # get 100 ids
-                    for ids in range(0, 100):
-                        try:
-                            app_ids.add(str(self._ids_amp.pop()))
-                        except KeyError:
-                            pass
-                    url_amp = base_url_amp + '?' + self.get_params(ids=app_ids)
-                yield scrapy.Request(url_amp, self.parse_amp, headers=header_auth)
-
-            # self.logger.debug(f'Added {done}/{len(self._ids)} requests to queue')
+                    url_ua = f'https://apps.apple.com/{sf.country}/app/id{app_id}?l={sf.locale}'
+                    meta_ua = {'download_slot': 'ua', 'storefront': sf.key}
+                    yield scrapy.Request(
+                        url_ua,
+                        self.parse_ua,
+                        errback=self.errback_app,
+                        headers=header_ua,
+                        meta=meta_ua,
+                        priority=priority,
+                    )
+
+            if app_id in sf.ids_amp_done:
+                self._num_ids_amp_done += 1
+                self.lease_done(sf.key, 'amp', app_id, DONE)
+            elif self._amp_single:
+                url_amp = sf.base_url_amp + '/' + str(app_id) + '?' + self.get_params(sf)
+                yield scrapy.Request(
+                    url_amp, self.parse_amp, errback=self.errback_app, meta=sf.meta_amp, priority=priority
+                )
+            else:
+                # a batch gets the priority of the id that filled it
+                batch = sf.batcher.add(app_id)
+                if batch is not None:
+                    yield self.amp_request(sf, batch, priority)
+
+        # from now on parse_amp requests the apps that were missing in a response
+        self._input_done = True
+        for sf in self.storefronts.values():
+            for batch in sf.batcher.flush():
+                yield self.amp_request(sf, batch)
         print('\n\nAll requests added to queue!\n\n')
 
+    def amp_request(self, sf, batch, priority=0):
+        url, _ = batch
+        return scrapy.Request(url, self.parse_amp, errback=self.errback_app, meta=sf.meta_amp, priority=priority)
+
+    def items_written(self, items, spider):
+        # results of leased batches are reported when they are on disk
+        for item in items:
+            self.lease_done(item['storefront'], item['endpoint'], item['app_id'], item['status'])
+
+    def lease_done(self, storefront, endpoint, app_id, status):
+        '''
+        Record the result of an app id, a leased batch is completed when all of its app ids are done
+        '''
+        if self._work_queue is None:
+            return
+        lease = self._leased.get((storefront, str(app_id)))
+        if lease is None or not lease.done(endpoint, app_id, status):
+            return
+        batch = lease.batch
+        for app_id in batch.app_ids:
+            self._leased.pop((batch.storefront, str(app_id)), None)
+        del self._leases[batch.id]
+        self._work_queue.complete(batch.id, self._worker, lease.results)
+        self.logger.info(f'Completed batch {batch.id}: {lease.results}')
+
+    def renew_leases(self):
+        if len(self._leases) == 0:
+            return
+        renewed = set(self._work_queue.renew(self._worker, list(self._leases), self._lease_time))
+        lost = [batch_id for batch_id in self._leases if batch_id not in renewed]
+        if len(lost) > 0:
+            self.logger.warning(f'Leases of batches {lost} expired, other workers may crawl them too')
+
+    def token_request(self):
+        self._refreshing_token = True
+        return scrapy.Request(self._token_url, dont_filter=True)
+
+    def download_token(self):
+        '''
+        Download the token request past the scheduler: amp requests that wait for the token in the AmpTokenMiddleware
+        count as active in the downloader, so the engine would not take it from the scheduler while they fill it
+        '''
+        d = self.crawler.engine.download(self.token_request())
+        d.addCallback(self.token_response)
+        d.addErrback(self.errback_JWT)
+
+    def token_response(self, response):
+        # the spider middlewares (HttpErrorMiddleware) are not run for engine.download
+        if response.status != 200:
+            raise HttpError(response, f'Ignoring non-200 response ({response.status}) of the token request')
+        self.parseJWT(response)
+
+    def refresh_token(self, delay=0):
+        '''
+        Get a new token (after delay seconds), the current one is used until it is there (or until it expires)
+        '''
+        if self._token_call is not None and self._token_call.active():
+            self._token_call.cancel()
+        self._token_call = None
+        if self._refreshing_token:
+            return
+        if delay > 0:
+            self._token_call = reactor.callLater(delay, self.refresh_token)
+            return
+        self.logger.info('Getting a new token for the amp api')
+        self.download_token()
+
+    def use_token(self, token):
+        self._token = token
+        if token.expires is None:
+            self.logger.info(f'Using token "{token}" (expiry unknown)')
+        else:
+            self.logger.info(f'Using token "{token}" (expires in {(token.expires - time()) / 3600:.1f} hours)')
+        self.crawler.signals.send_catch_log(signal=token_received, token=token.value, expires=token.expires)
+        refresh_at = token.refresh_at(self._token_refresh_before)
+        if self._token_call is not None and self._token_call.active():
+            self._token_call.cancel()
+        if refresh_at is not None:
+            self._token_call = reactor.callLater(max(refresh_at - time(), 0), self.refresh_token)
+
+    def token_expired(self, token):
+        # sent by the AmpTokenMiddleware on a 401 or when the token expired
+        if self._token is not None and token == self._token.value:
+            # no loop of requests if Apple hands out tokens that get a 401
+            refresh_at = max(time(), self._token_rejected + TOKEN_RETRY_DELAY)
+            self._token_rejected = refresh_at
+            self.refresh_token(refresh_at - time())
+
     def parseJWT(self, response):
+        self._refreshing_token = False
         content = response.xpath("//meta[@name='web-experience-app/config/environment']/@content").get()
         j = json.loads(unquote(content))
-        self._token = j['MEDIA_API']['token']
-        self.logger.info(f'Using token "{self._token}"')
+        token = Token(j['MEDIA_API']['token'])
+        if token.expired():
+            self.logger.warning(f'Got an expired token, trying again in {TOKEN_RETRY_DELAY} seconds')
+            self.refresh_token(TOKEN_RETRY_DELAY)
+            return
+        if self._token_cache:
+            save_token(self._token_cache, token)
+        self.use_token(token)
+
+    def errback_JWT(self, failure):
+        self._refreshing_token = False
+        if self._token is None:
+            self.logger.error(f'Could not get a token for the amp api: {failure.value}')
+            self.crawler.engine.close_spider(self, 'no_token')
+            return
+        # the current token may still work
+        self.logger.warning(f'Could not get a new token for the amp api: {failure.value}')
+        self.refresh_token(TOKEN_RETRY_DELAY)
 
     def parse_ua(self, response):
-        try:
-            _ = self._ua_dir_exists
-        except AttributeError:
-            os.makedirs(self._ua_dir, exist_ok=True)
-            self._ua_dir_exists = True
+        sf = self.storefronts[response.meta['storefront']]
         app_id = response.url.split('/')[-1].lstrip('id').split('?')[0]
-        filename = os.path.join(self._ua_dir, app_id + '.json')
-        with open(filename, 'wb') as f:
-            f.write(response.body)
+        yield AppItem(endpoint='ua', storefront=sf.key, app_id=app_id, status=DONE, data=response.body)
         self._num_ids_ua_done += 1
-        self.status(app_id, 'UA')
+        self.metrics.observe('appstore_apps_per_response', ('ua',), 1)
 
     def parse_amp(self, response):
-        try:
-            _ = self._amp_dir_exists
-        except AttributeError:
-            os.makedirs(self._amp_dir, exist_ok=True)
-            self._amp_dir_exists = True
+        sf = self.storefronts[response.meta['storefront']]
         u = urlsplit(response.url)
         app_id = u.path.split('/')[-1]
         # app_id = response.url.split('/')[-1].split('?')[0]
@@ -178,50 +526,84 @@ class AppstoreMetaSpider(scrapy.Spider):
             # multiple ids
             app_ids_req = set(parse_qs(u.query)['ids'][0].split(','))
             app_ids_res = set()
-            j = json.loads(response.body)
 
-            for app in j['data']:
-                app_ids_res.add(app['id'])
-                filename = os.path.join(self._amp_dir, app['id'] + '.json')
-                with open(filename, 'w') as f:
-                    json.dump({'data': [app]}, f)
+            for app_id, data, app in split_apps(response.body):
+                app_ids_res.add(app_id)
+                modified = last_modified(app)
+                yield AppItem(
+                    endpoint='amp', storefront=sf.key, app_id=app_id, status=DONE, data=data, modified=modified
+                )
                 self._num_ids_amp_done += 1
-                self.status(app['id'], 'amp')
-            diff = app_ids_req - app_ids_res
-            if len(diff) > 0:
-                self.logger.warning(f'Apps got requested but are not in response: {diff}')
+            self.metrics.observe('appstore_apps_per_response', ('amp',), len(app_ids_res))
+
+            # missing apps get requested again with one of the next batches
+            latency = response.meta.get('download_latency', 0)
+            gave_up = sf.batcher.response(app_ids_req, app_ids_res, latency, len(response.body))
+            if len(gave_up) > 0:
+                self.logger.warning(f'Apps got requested but are not in response ({sf.key}): {gave_up}')
+                for app_id in gave_up:
+                    yield AppItem(endpoint='amp', storefront=sf.key, app_id=app_id, status=MISSING, data=None)
+            if self._input_done:
+                for batch in sf.batcher.flush():
+                    yield self.amp_request(sf, batch)
 
         else:
-            filename = os.path.join(self._amp_dir, app_id + '.json')
-            with open(filename, 'wb') as f:
-                f.write(response.body)
+            modified = last_modified(json.loads(response.body)['data'][0])
+            yield AppItem(
+                endpoint='amp', storefront=sf.key, app_id=app_id, status=DONE, data=response.body, modified=modified
+            )
             self._num_ids_amp_done += 1
-            self.status(app_id, 'amp')
-
-    def status(self, app_id, api):
-        self._last_ids[api] = app_id
-        id_fmt = ''
-        for api in self._last_ids:
-            id_fmt += f'{api:>3}: {self._last_ids[api]:>12}; '
-
-        amp_done = num_fmt(self._num_ids_amp_done)
-        amp_total = num_fmt(self._num_ids_amp)
-        ua_done = num_fmt(self._num_ids_ua_done)
-        ua_total = num_fmt(self._num_ids_ua)
-        status = f'{id_fmt}Amp: {amp_done:>4}/{amp_total:>4} apps; UA: {ua_done:>4}/{ua_total:>4} apps'
-        # log every 30 seconds
-        if (time() - self._last_status_time) >= 30:
-            self.logger.info(status)
-            self._last_status_time = time()
-        print(status + '        ', end='\r')
-
-    def get_params(self, ids={}):
+            self.metrics.observe('appstore_apps_per_response', ('amp_single',), 1)
+
+    def errback_app(self, failure):
+        if failure.check(NoToken):
+            # not sent, the apps are still due
+            return
+        request = failure.request
+        sf = self.storefronts[request.meta['storefront']]
+        u = urlsplit(request.url)
+        app_id = u.path.split('/')[-1]
+        if app_id == 'apps':
+            app_ids = parse_qs(u.query)['ids'][0].split(',')
+        else:
+            app_ids = [app_id.lstrip('id')]
+        endpoint = 'ua' if slot_endpoint(request.meta.get('download_slot')) == 'ua' else 'amp'
+        if len(app_ids) > 1:
+            sf.batcher.shrink()
+
+        if failure.check(HttpError) and failure.value.response.status == 404:
+            status = MISSING
+        else:
+            status = FAILED
+        self.logger.warning(
+            f'Request for {len(app_ids)} apps via {endpoint} ({sf.key}) failed ({status}): {failure.value}'
+        )
+        for app_id in app_ids:
+            yield AppItem(endpoint=endpoint, storefront=sf.key, app_id=app_id, status=status, data=None)
+
+    def closed(self, reason):
+        if getattr(self, '_token_call', None) is not None and self._token_call.active():
+            self._token_call.cancel()
+        # the AppstorePipeline has written everything at this point
+        # (unfinished leases expire and are handed out again)
+        if getattr(self, '_work_queue', None) is not None:
+            if self._renew_loop.running:
+                self._renew_loop.stop()
+            self._work_queue.close()
+        for storage in list(getattr(self, 'storages', {}).values()) + list(getattr(self, 'raw_storages', {}).values()):
+            storage.close()
+        if hasattr(self, 'crawl_state'):
+            self.crawl_state.close()
+        if hasattr(self, 'change_log'):
+            self.change_log.close()
+
+    def get_params(self, sf, ids={}):
         '''
         Multiple app ids can be requested but without the include param.
-        Maximum is 100 ids
+        Maximum is 100 ids (see AmpBatcher)
         '''
-        platforms = ['appletv', 'ipad', 'mac', 'watch', 'iphone']
-        platforms.remove(self._platform)
+        platforms = list(PLATFORMS)
+        platforms.remove(sf.platform)
         extend = [
             'description',
             'editorialVideo',
@@ -256,12 +638,12 @@ class AppstoreMetaSpider(scrapy.Spider):
         ]
         params = {
             'ids': ','.join(ids),
-            'platform': self._platform,
+            'platform': sf.platform,
             'additionalPlatforms': ','.join(platforms),
             'extend': ','.join(extend),
             'include': ','.join(include),
             'limit[reviews]': 20,
-            'l': self._locale,
+            'l': sf.locale,
         }
         if ids == {}:
             del params['ids']
@@ -0,0 +1,198 @@
+from array import array
+from threading import RLock
+from time import time
+import hashlib
+import json
+import os
+import sqlite3
+
+from appstore.idset import IDSet, TYPECODE
+
+DONE = 'done'
+FAILED = 'failed'
+MISSING = 'missing'
+
+# changes in the change log
+NEW = 'new'
+CHANGED = 'changed'
+REMOVED = 'removed'
+
+
+def content_hash(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class CrawlState:
+    '''
+    SQLite index of the crawl state (done, failed, missing) of every app id
+    per endpoint (amp, ua) and storefront (country/platform/locale)
+
+    For apps that are done it also has the hash of the saved json, the release date of the latest version (modified)
+    and when it was crawled (updated), which tells when an app should be refreshed (see stale()).
+
+    Changes are committed in batches of commit_every and on close().
+    It can be used from multiple threads (e.g. the writer of the AppstorePipeline).
+    '''
+
+    def __init__(self, filename, commit_every=1000):
+        self.filename = filename
+        self.created = not os.path.exists(filename)
+        self._commit_every = commit_every
+        self._uncommitted = 0
+        self._lock = RLock()
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            '''CREATE TABLE IF NOT EXISTS state (
+                endpoint TEXT NOT NULL,
+                storefront TEXT NOT NULL,
+                app_id INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                updated REAL NOT NULL,
+                hash BLOB,
+                modified REAL,
+                PRIMARY KEY (endpoint, storefront, app_id)
+            ) WITHOUT ROWID'''
+        )
+        # state files of older versions
+        columns = [row[1] for row in self._db.execute('PRAGMA table_info(state)')]
+        for column, kind in [('hash', 'BLOB'), ('modified', 'REAL')]:
+            if column not in columns:
+                self._db.execute(f'ALTER TABLE state ADD COLUMN {column} {kind}')
+        self._db.commit()
+
+    def set(self, endpoint, storefront, app_ids, status=DONE, hashes=None, modified=None):
+        '''
+        Set the status of one or more app ids,
+        optionally with the hashes and modified times (lists in the same order as app_ids)
+        '''
+        if isinstance(app_ids, (int, str)):
+            app_ids = [app_ids]
+        now = time()
+        hashes = hashes or [None] * len(app_ids)
+        modified = modified or [None] * len(app_ids)
+        rows = [
+            (endpoint, storefront, int(app_id), status, now, h, m) for app_id, h, m in zip(app_ids, hashes, modified)
+        ]
+        with self._lock:
+            self._db.executemany('INSERT OR REPLACE INTO state VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            self._uncommitted += len(rows)
+            if self._uncommitted >= self._commit_every:
+                self.commit()
+
+    def ids(self, endpoint, storefront, status=DONE):
+        '''
+        All app ids with status as IDSet
+        '''
+        with self._lock:
+            cur = self._db.execute(
+                'SELECT app_id FROM state WHERE endpoint = ? AND storefront = ? AND status = ? ORDER BY app_id',
+                (endpoint, storefront, status),
+            )
+            return IDSet.from_sorted(array(TYPECODE, (row[0] for row in cur)))
+
+    def hashes(self, endpoint, storefront, app_ids):
+        '''
+        Hashes of the app ids that are done: {app id: hash (None if unknown)}
+        '''
+        app_ids = [int(app_id) for app_id in app_ids]
+        result = {}
+        with self._lock:
+            # stay below the maximum number of sql variables
+            for i in range(0, len(app_ids), 500):
+                chunk = app_ids[i : i + 500]
+                cur = self._db.execute(
+                    f'''SELECT app_id, hash FROM state WHERE endpoint = ? AND storefront = ? AND status = ?
+                    AND app_id IN ({",".join("?" * len(chunk))})''',
+                    [endpoint, storefront, DONE] + chunk,
+                )
+                result.update(cur.fetchall())
+        return result
+
+    def stale(self, endpoint, storefront, min_age, max_age):
+        '''
+        App ids that are done but should be crawled again, the most outdated first (as array)
+
+        The time between the release of the latest version and the last crawl is used as the expected
+        update interval of an app (at least min_age and at most max_age seconds).
+        An app is stale when its last crawl is older than that interval.
+        '''
+        with self._lock:
+            cur = self._db.execute(
+                '''SELECT app_id,
+                    (:now - updated) / MIN(MAX(updated - COALESCE(modified, 0), :min_age), :max_age) AS staleness
+                FROM state WHERE endpoint = :endpoint AND storefront = :storefront AND status = :status
+                AND staleness >= 1 ORDER BY staleness DESC''',
+                {
+                    'now': time(),
+                    'min_age': min_age,
+                    'max_age': max_age,
+                    'endpoint': endpoint,
+                    'storefront': storefront,
+                    'status': DONE,
+                },
+            )
+            return array(TYPECODE, (row[0] for row in cur))
+
+    def count(self, endpoint, storefront, status=DONE):
+        with self._lock:
+            cur = self._db.execute(
+                'SELECT COUNT(*) FROM state WHERE endpoint = ? AND storefront = ? AND status = ?',
+                (endpoint, storefront, status),
+            )
+            return cur.fetchone()[0]
+
+    def rebuild(self, endpoint, storefront, app_ids):
+        '''
+        Mark all app_ids (e.g. from a storage backend) as done.
+        Returns the number of ids.
+        '''
+        num = 0
+        batch = []
+        for app_id in app_ids:
+            batch.append(app_id)
+            if len(batch) >= self._commit_every:
+                self.set(endpoint, storefront, batch)
+                num += len(batch)
+                batch = []
+        self.set(endpoint, storefront, batch)
+        self.commit()
+        return num + len(batch)
+
+    def commit(self):
+        with self._lock:
+            self._db.commit()
+            self._uncommitted = 0
+
+    def close(self):
+        with self._lock:
+            self.commit()
+            self._db.close()
+
+
+class ChangeLog:
+    '''
+    Json lines of new, changed and removed apps:
+    {"time": 1618000000, "endpoint": "amp", "storefront": "us/iphone/en-US", "id": 310633997, "change": "changed"}
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._f = open(filename, 'a')
+
+    def write(self, endpoint, storefront, app_id, change):
+        line = {
+            'time': int(time()),
+            'endpoint': endpoint,
+            'storefront': storefront,
+            'id': int(app_id),
+            'change': change,
+        }
+        self._f.write(json.dumps(line, separators=(',', ':')) + '\n')
+
+    def flush(self):
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
@@ -0,0 +1,227 @@
+import gzip
+import json
+import os
+import re
+import sqlite3
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# errors when reading a shard that was not closed properly
+TRUNCATED_ERRORS = (EOFError, zstandard.ZstdError) if zstandard else (EOFError,)
+
+
+def open_storage(kind, outputdir, **options):
+    '''
+    Open one of the storage backends: files, jsonl or sqlite
+    '''
+    backends = {
+        'files': FileStorage,
+        'jsonl': ShardStorage,
+        'sqlite': SqliteStorage,
+    }
+    try:
+        backend = backends[kind]
+    except KeyError:
+        raise ValueError(f'Unknown storage "{kind}" (one of: {", ".join(backends)})')
+    return backend(outputdir, **options)
+
+
+class FileStorage:
+    '''
+    One file per app: {outputdir}/{endpoint}/{id}.json
+    '''
+
+    def __init__(self, outputdir, **options):
+        self.outputdir = outputdir
+        self._dirs = set()
+
+    def write(self, endpoint, app_id, data):
+        directory = os.path.join(self.outputdir, endpoint)
+        if endpoint not in self._dirs:
+            os.makedirs(directory, exist_ok=True)
+            self._dirs.add(endpoint)
+        with open(os.path.join(directory, f'{app_id}.json'), 'wb') as f:
+            f.write(data)
+
+    def ids(self, endpoint):
+        try:
+            entries = os.scandir(os.path.join(self.outputdir, endpoint))
+        except FileNotFoundError:
+            return
+        with entries:
+            for entry in entries:
+                if not entry.name.endswith('.json'):
+                    continue
+                try:
+                    yield int(entry.name[: -len('.json')])
+                except ValueError:
+                    # invalid id (not an int)
+                    pass
+
+    def items(self, endpoint):
+        for app_id in self.ids(endpoint):
+            with open(os.path.join(self.outputdir, endpoint, f'{app_id}.json'), 'rb') as f:
+                yield app_id, f.read()
+
+    def flush(self):
+        # every file is closed after it is written
+        pass
+
+    def close(self):
+        pass
+
+
+class ShardStorage:
+    '''
+    Size-rotated, compressed JSON line shards: {outputdir}/{endpoint}/{endpoint}-{n:05d}.jsonl.gz (or .zst)
+
+    Every line is {"id": <app id>, "data": <json of the app>}.
+    Every run starts a new shard, so existing shards are never modified.
+    '''
+
+    def __init__(self, outputdir, compression='gzip', shard_size=256 * 1024 * 1024, **options):
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError('zstd compression needs the zstandard package (pip install zstandard)')
+        self.outputdir = outputdir
+        self.compression = compression
+        self.shard_size = shard_size
+        self.suffix = {'gzip': '.jsonl.gz', 'zstd': '.jsonl.zst', 'none': '.jsonl'}[compression]
+        # endpoint: [file, uncompressed bytes written]
+        self._shards = {}
+
+    def _shard_files(self, endpoint):
+        directory = os.path.join(self.outputdir, endpoint)
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return []
+        pattern = re.compile(re.escape(endpoint) + r'-(\d+)\.jsonl(\.gz|\.zst)?$')
+        shards = sorted((int(m.group(1)), name) for name in names for m in [pattern.match(name)] if m)
+        return [os.path.join(directory, name) for _, name in shards]
+
+    def _open_shard(self, endpoint):
+        directory = os.path.join(self.outputdir, endpoint)
+        os.makedirs(directory, exist_ok=True)
+        shards = self._shard_files(endpoint)
+        n = int(re.search(r'-(\d+)\.jsonl', shards[-1]).group(1)) + 1 if shards else 0
+        filename = os.path.join(directory, f'{endpoint}-{n:05d}{self.suffix}')
+        if self.compression == 'gzip':
+            f = gzip.open(filename, 'wb', compresslevel=6)
+        elif self.compression == 'zstd':
+            f = zstandard.ZstdCompressor().stream_writer(open(filename, 'wb'))
+        else:
+            f = open(filename, 'wb')
+        self._shards[endpoint] = [f, 0]
+        return self._shards[endpoint]
+
+    def write(self, endpoint, app_id, data):
+        shard = self._shards.get(endpoint) or self._open_shard(endpoint)
+        if b'\n' in data:
+            # keep one app per line
+            data = json.dumps(json.loads(data), separators=(',', ':')).encode()
+        line = b'{"id":%d,"data":%s}\n' % (int(app_id), data)
+        shard[0].write(line)
+        shard[1] += len(line)
+        if shard[1] >= self.shard_size:
+            shard[0].close()
+            del self._shards[endpoint]
+
+    @staticmethod
+    def _read_lines(filename, f):
+        # lines of the shard filename (f: the file opened in binary mode)
+        if filename.endswith('.gz'):
+            yield from gzip.GzipFile(fileobj=f)
+        elif filename.endswith('.zst'):
+            if zstandard is None:
+                raise ValueError(f'Reading {filename} needs the zstandard package (pip install zstandard)')
+            # read_to_iter also reads a frame that is not finished, the stream_reader stops early
+            rest = b''
+            for chunk in zstandard.ZstdDecompressor().read_to_iter(f):
+                lines = (rest + chunk).split(b'\n')
+                rest = lines.pop()
+                for line in lines:
+                    yield line + b'\n'
+            if rest:
+                yield rest
+        else:
+            yield from f
+
+    def _lines(self, endpoint):
+        for filename in self._shard_files(endpoint):
+            with open(filename, 'rb') as f:
+                try:
+                    for line in self._read_lines(filename, f):
+                        if line.endswith(b'\n'):
+                            yield line
+                except TRUNCATED_ERRORS:
+                    # shard of a crawl that got killed
+                    pass
+
+    def ids(self, endpoint):
+        for line in self._lines(endpoint):
+            # lines start with {"id":<app id>,
+            yield int(line[6 : line.index(b',')])
+
+    def items(self, endpoint):
+        for line in self._lines(endpoint):
+            j = json.loads(line)
+            yield j['id'], json.dumps(j['data']).encode()
+
+    def flush(self):
+        '''
+        Write what is buffered in the compressors to the shards (a complete block, readable after a crash)
+        '''
+        for f, _ in self._shards.values():
+            f.flush()
+
+    def close(self):
+        for f, _ in self._shards.values():
+            f.close()
+        self._shards = {}
+
+
+class SqliteStorage:
+    '''
+    Key-value store in {outputdir}/metadata.sqlite with the app id as key
+    '''
+
+    def __init__(self, outputdir, commit_every=1000, **options):
+        os.makedirs(outputdir, exist_ok=True)
+        self._commit_every = commit_every
+        self._uncommitted = 0
+        self._db = sqlite3.connect(os.path.join(outputdir, 'metadata.sqlite'), check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            '''CREATE TABLE IF NOT EXISTS metadata (
+                endpoint TEXT NOT NULL,
+                app_id INTEGER NOT NULL,
+                data BLOB NOT NULL,
+                PRIMARY KEY (endpoint, app_id)
+            ) WITHOUT ROWID'''
+        )
+
+    def write(self, endpoint, app_id, data):
+        self._db.execute('INSERT OR REPLACE INTO metadata VALUES (?, ?, ?)', (endpoint, int(app_id), data))
+        self._uncommitted += 1
+        if self._uncommitted >= self._commit_every:
+            self.flush()
+
+    def flush(self):
+        self._db.commit()
+        self._uncommitted = 0
+
+    def ids(self, endpoint):
+        for row in self._db.execute('SELECT app_id FROM metadata WHERE endpoint = ? ORDER BY app_id', (endpoint,)):
+            yield row[0]
+
+    def items(self, endpoint):
+        for row in self._db.execute('SELECT app_id, data FROM metadata WHERE endpoint = ? ORDER BY app_id', (endpoint,)):
+            yield row[0], row[1]
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
@@ -0,0 +1,120 @@
+'''
+Extraction of the metadata of an app from a response of the UA endpoint (apps.apple.com with the AppStore user agent)
+
+The app is in storePlatformData/product-dv/results/{id}, next to a lot of page data (reviews, related apps, ...).
+Only the fields of the app are kept, in the schema of the amp api, so that ua and amp metadata are read the same way:
+{"data": [{"id", "type": "apps", "href", "attributes": {..., "platformAttributes": {platform: {...}}},
+"relationships"}]}
+
+Runs in the worker processes of the UAExtractPipeline.
+'''
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from appstore.amp import last_modified
+
+# key of the platform of a storefront in platformAttributes
+PLATFORM_KEYS = {'iphone': 'ios', 'ipad': 'ios', 'mac': 'osx', 'appletv': 'appletvos', 'watch': 'watchos'}
+
+# name in the amp api: name in the ua response
+ATTRIBUTES = {
+    'name': 'name',
+    'artistName': 'artistName',
+    'url': 'url',
+    'userRating': 'userRating',
+    'contentRatingsBySystem': 'contentRatingsBySystem',
+    'deviceFamilies': 'deviceFamilies',
+    'releaseDate': 'releaseDate',
+}
+PLATFORM_ATTRIBUTES = {
+    'bundleId': 'bundleId',
+    'artwork': 'artwork',
+    'description': 'description',
+    'subtitle': 'subtitle',
+    'copyright': 'copyright',
+    'offers': 'offers',
+    'screenshotsByType': 'screenshotsByType',
+    'editorialArtwork': 'editorialArtwork',
+    'minimumOSVersion': 'minimumOSVersion',
+}
+# in softwareInfo of the ua response
+SOFTWARE_INFO = {
+    'seller': 'seller',
+    'requirementsString': 'requirementsString',
+    'privacyPolicyUrl': 'privacyPolicyUrl',
+    'supportURLForLanguage': 'supportUrl',
+    'hasInAppPurchases': 'hasInAppPurchases',
+}
+
+
+def _copy(target, source, fields):
+    for amp_name, ua_name in fields.items():
+        if source.get(ua_name) is not None:
+            target[amp_name] = source[ua_name]
+
+
+def normalize(app, country, platform='iphone'):
+    '''
+    An app of the ua response (product-dv result) as app of the amp api
+    '''
+    attributes = {}
+    _copy(attributes, app, ATTRIBUTES)
+    if app.get('genreNames'):
+        attributes['genreDisplayName'] = app['genreNames'][0]
+
+    platform_attributes = {}
+    _copy(platform_attributes, app, PLATFORM_ATTRIBUTES)
+    _copy(platform_attributes, app.get('softwareInfo') or {}, SOFTWARE_INFO)
+    if 'versionHistory' in app:
+        platform_attributes['versionHistory'] = [
+            {
+                'versionDisplay': version.get('versionString'),
+                'releaseNotes': version.get('releaseNotes'),
+                'releaseDate': version.get('releaseDate'),
+            }
+            for version in app['versionHistory']
+        ]
+    attributes['platformAttributes'] = {PLATFORM_KEYS.get(platform, 'ios'): platform_attributes}
+
+    relationships = {}
+    if app.get('artistId') is not None:
+        developer = {'id': str(app['artistId']), 'type': 'developers'}
+        relationships['developer'] = {'data': [developer]}
+    if app.get('genres'):
+        genres = [
+            {'id': str(genre.get('genreId')), 'type': 'genres', 'attributes': {'name': genre.get('name')}}
+            for genre in app['genres']
+        ]
+        relationships['genres'] = {'data': genres}
+
+    app_id = str(app['id'])
+    return {
+        'id': app_id,
+        'type': 'apps',
+        'href': f'/v1/catalog/{country}/apps/{app_id}',
+        'attributes': attributes,
+        'relationships': relationships,
+    }
+
+
+def extract_ua(body, app_id, country, platform='iphone'):
+    '''
+    The app of a ua response in the schema of the amp api: (json of {"data": [app]}, release date of the latest version)
+    Raises ValueError if the response has no app with app_id.
+    '''
+    response = orjson.loads(body) if orjson is not None else json.loads(body)
+    results = (response.get('storePlatformData') or {}).get('product-dv', {}).get('results') or {}
+    app = results.get(str(app_id))
+    if app is None:
+        raise ValueError(f'The ua response has no app {app_id}')
+    app = normalize(app, country, platform)
+    if orjson is not None:
+        data = orjson.dumps({'data': [app]})
+    else:
+        data = json.dumps({'data': [app]}, ensure_ascii=False, separators=(',', ':')).encode()
+    return data, last_modified(app)
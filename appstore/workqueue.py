@@ -0,0 +1,303 @@
+from collections import namedtuple
+from threading import Lock
+from time import time
+import json
+import sqlite3
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# a batch of app ids of one storefront (country/platform/locale)
+Batch = namedtuple('Batch', ['id', 'storefront', 'app_ids'])
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+
+
+def open_queue(url):
+    '''
+    Open a work queue: redis://host:port/db or sqlite:///path/to/queue.sqlite (or just a path)
+    '''
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisQueue(url)
+    if url.startswith('sqlite://'):
+        url = url[len('sqlite://') :]
+    return SqliteQueue(url)
+
+
+class Lease:
+    '''
+    A leased batch and the results of the app ids that are done
+    '''
+
+    def __init__(self, batch, endpoints):
+        self.batch = batch
+        self.remaining = {(endpoint, str(app_id)) for app_id in batch.app_ids for endpoint in endpoints}
+        self.results = {}
+
+    def done(self, endpoint, app_id, status):
+        '''
+        Record the status of an app id, returns True when the whole batch is done
+        '''
+        key = (endpoint, str(app_id))
+        if key in self.remaining:
+            self.remaining.discard(key)
+            result = f'{endpoint}/{status}'
+            self.results[result] = self.results.get(result, 0) + 1
+        return len(self.remaining) == 0
+
+
+class SqliteQueue:
+    '''
+    Work queue in a SQLite file that can be shared by multiple workers (also over NFS)
+
+    A leased batch that is not renewed or completed until its lease expires
+    is handed out again by the next call of lease().
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = Lock()
+        # no WAL: it needs shared memory, which does not work over NFS
+        self._db = sqlite3.connect(filename, timeout=60, isolation_level=None, check_same_thread=False)
+        self._db.execute(
+            '''CREATE TABLE IF NOT EXISTS batches (
+                id INTEGER PRIMARY KEY,
+                storefront TEXT NOT NULL,
+                app_ids TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                worker TEXT,
+                expires REAL,
+                leases INTEGER NOT NULL DEFAULT 0,
+                results TEXT
+            )'''
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS batches_status ON batches (status, expires)')
+
+    def _transaction(self, func, *args):
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                result = func(*args)
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+            return result
+
+    def fill(self, storefront, batches):
+        '''
+        Add batches (lists of app ids) of a storefront, returns the number of batches
+        '''
+
+        def insert():
+            num = 0
+            for app_ids in batches:
+                self._db.execute(
+                    'INSERT INTO batches (storefront, app_ids, size, status) VALUES (?, ?, ?, ?)',
+                    (storefront, ','.join(str(app_id) for app_id in app_ids), len(app_ids), PENDING),
+                )
+                num += 1
+            return num
+
+        return self._transaction(insert)
+
+    def lease(self, worker, ttl):
+        '''
+        Lease the next pending or expired batch for ttl seconds, returns None when there is none
+        '''
+
+        def take():
+            now = time()
+            # in the order they were added (pending batches have no expiry, so the index is sorted by id)
+            row = self._db.execute(
+                'SELECT id, storefront, app_ids FROM batches WHERE status = ? AND expires IS NULL ORDER BY id LIMIT 1',
+                (PENDING,),
+            ).fetchone()
+            if row is None:
+                # lease of a worker that died
+                row = self._db.execute(
+                    'SELECT id, storefront, app_ids FROM batches WHERE status = ? AND expires < ? LIMIT 1',
+                    (LEASED, now),
+                ).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                'UPDATE batches SET status = ?, worker = ?, expires = ?, leases = leases + 1 WHERE id = ?',
+                (LEASED, worker, now + ttl, row[0]),
+            )
+            return Batch(row[0], row[1], [int(app_id) for app_id in row[2].split(',')])
+
+        return self._transaction(take)
+
+    def renew(self, worker, batch_ids, ttl):
+        '''
+        Extend the leases of a worker, returns the ids of the batches it still has
+        '''
+
+        def update():
+            renewed = []
+            for batch_id in batch_ids:
+                cur = self._db.execute(
+                    'UPDATE batches SET expires = ? WHERE id = ? AND worker = ? AND status = ?',
+                    (time() + ttl, batch_id, worker, LEASED),
+                )
+                if cur.rowcount > 0:
+                    renewed.append(batch_id)
+            return renewed
+
+        return self._transaction(update)
+
+    def complete(self, batch_id, worker, results):
+        '''
+        Mark a batch as done and store the results ({"amp/done": 98, "amp/missing": 2})
+        '''
+
+        def update():
+            self._db.execute(
+                'UPDATE batches SET status = ?, worker = ?, results = ? WHERE id = ? AND status != ?',
+                (DONE, worker, json.dumps(results), batch_id, DONE),
+            )
+
+        self._transaction(update)
+
+    def stats(self):
+        '''
+        Progress of the crawl: batches and ids per status, the summed results and the batches done per worker
+        '''
+        with self._lock:
+            now = time()
+            stats = {'batches': {}, 'ids': {}, 'expired': 0, 'results': {}, 'workers': {}}
+            for status, batches, ids in self._db.execute(
+                'SELECT status, COUNT(*), SUM(size) FROM batches GROUP BY status'
+            ):
+                stats['batches'][status] = batches
+                stats['ids'][status] = ids
+            stats['ids']['total'] = sum(stats['ids'].values())
+            stats['expired'] = self._db.execute(
+                'SELECT COUNT(*) FROM batches WHERE status = ? AND expires < ?', (LEASED, now)
+            ).fetchone()[0]
+            for worker, status, results in self._db.execute(
+                'SELECT worker, status, results FROM batches WHERE worker IS NOT NULL'
+            ):
+                w = stats['workers'].setdefault(worker, {LEASED: 0, DONE: 0})
+                w[status] += 1
+                for result, num in json.loads(results or '{}').items():
+                    stats['results'][result] = stats['results'].get(result, 0) + num
+            return stats
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+# Lease of RedisQueue in one step, so a worker that dies in between does not lose a batch:
+# expired batches go back to pending, the first pending batch gets leased until now + ttl
+# KEYS: pending, leased; ARGV: now, ttl, worker, prefix; returns [id, storefront, app_ids] or nil
+LEASE_SCRIPT = '''
+for _, id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])) do
+    redis.call('ZREM', KEYS[2], id)
+    redis.call('RPUSH', KEYS[1], id)
+end
+local id = redis.call('LPOP', KEYS[1])
+if not id then
+    return nil
+end
+redis.call('ZADD', KEYS[2], tonumber(ARGV[1]) + tonumber(ARGV[2]), id)
+local key = ARGV[4] .. ':batch:' .. id
+redis.call('HSET', key, 'worker', ARGV[3])
+redis.call('HINCRBY', key, 'leases', 1)
+return {id, redis.call('HGET', key, 'storefront'), redis.call('HGET', key, 'app_ids')}
+'''
+
+
+class RedisQueue:
+    '''
+    Work queue in redis (or anything that speaks its protocol and runs Lua scripts)
+
+    Keys (with the prefix):
+    - batch:{id}: hash with storefront, app_ids, worker, leases
+    - pending: list of batch ids
+    - leased: sorted set of batch ids with the expiry time as score
+    - done: set of batch ids
+    - ids: number of all ids
+    - results, workers:done: hashes with counters
+    '''
+
+    def __init__(self, url, prefix='appstore'):
+        if redis is None:
+            raise ValueError('The redis work queue needs the redis package (pip install redis)')
+        self._r = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self._lease = self._r.register_script(LEASE_SCRIPT)
+
+    def _key(self, *parts):
+        return ':'.join((self.prefix,) + parts)
+
+    def fill(self, storefront, batches):
+        num = 0
+        pipe = self._r.pipeline(transaction=False)
+        for app_ids in batches:
+            batch_id = self._r.incr(self._key('next_id'))
+            pipe.hset(
+                self._key('batch', str(batch_id)),
+                mapping={'storefront': storefront, 'app_ids': ','.join(str(app_id) for app_id in app_ids), 'leases': 0},
+            )
+            pipe.rpush(self._key('pending'), batch_id)
+            pipe.incrby(self._key('ids'), len(app_ids))
+            num += 1
+            if num % 1000 == 0:
+                pipe.execute()
+        pipe.execute()
+        return num
+
+    def lease(self, worker, ttl):
+        batch = self._lease(keys=[self._key('pending'), self._key('leased')], args=[time(), ttl, worker, self.prefix])
+        if batch is None:
+            return None
+        batch_id, storefront, app_ids = batch
+        return Batch(int(batch_id), storefront.decode(), [int(app_id) for app_id in app_ids.split(b',')])
+
+    def renew(self, worker, batch_ids, ttl):
+        renewed = []
+        for batch_id in batch_ids:
+            owner = self._r.hget(self._key('batch', str(batch_id)), 'worker')
+            if owner is None or owner.decode() != worker:
+                continue
+            # only batches that are still leased (xx), an expired lease may have been reclaimed
+            if self._r.zscore(self._key('leased'), batch_id) is not None:
+                self._r.zadd(self._key('leased'), {batch_id: time() + ttl}, xx=True)
+                renewed.append(batch_id)
+        return renewed
+
+    def complete(self, batch_id, worker, results):
+        self._r.zrem(self._key('leased'), batch_id)
+        if not self._r.sadd(self._key('done'), batch_id):
+            # another worker finished it after the lease expired
+            return
+        pipe = self._r.pipeline()
+        pipe.hset(self._key('batch', str(batch_id)), 'worker', worker)
+        pipe.hincrby(self._key('workers', DONE), worker, 1)
+        for result, num in results.items():
+            pipe.hincrby(self._key('results'), result, num)
+        pipe.execute()
+
+    def stats(self):
+        num_done = self._r.scard(self._key('done'))
+        num_leased = self._r.zcard(self._key('leased'))
+        num_pending = self._r.llen(self._key('pending'))
+        stats = {
+            'batches': {PENDING: num_pending, LEASED: num_leased, DONE: num_done},
+            'ids': {'total': int(self._r.get(self._key('ids')) or 0)},
+            'expired': self._r.zcount(self._key('leased'), '-inf', time()),
+            'results': {k.decode(): int(v) for k, v in self._r.hgetall(self._key('results')).items()},
+            'workers': {k.decode(): {DONE: int(v)} for k, v in self._r.hgetall(self._key('workers', DONE)).items()},
+        }
+        return stats
+
+    def close(self):
+        self._r.close()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+'''
+Benchmark splitting amp responses with 100 apps into one json per app
+
+Run from the repository root: python -m benchmarks.amp_split
+'''
+
+import argparse
+import json
+from time import perf_counter, process_time
+
+from appstore import amp
+from benchmarks.fixtures import amp_response
+
+
+def split_json(body):
+    # the way parse_amp did it before appstore.amp.split_apps
+    for app in json.loads(body)['data']:
+        yield app['id'], json.dumps({'data': [app]}).encode()
+
+
+def split_apps_stdlib(body):
+    orjson, amp.orjson = amp.orjson, None
+    try:
+        yield from amp.split_apps(body)
+    finally:
+        amp.orjson = orjson
+
+
+def bench(name, split, body, seconds):
+    responses = 0
+    start, start_cpu = perf_counter(), process_time()
+    while perf_counter() - start < seconds:
+        for _ in split(body):
+            pass
+        responses += 1
+    cpu = process_time() - start_cpu
+    print(f'{name:>24}: {responses / cpu:8.1f} responses/s per core ({responses * 100 / cpu:8.0f} apps/s)')
+
+
+parser = argparse.ArgumentParser(description='Benchmark splitting amp responses')
+parser.add_argument('--seconds', help='run every variant this long (default: 3)', type=float, default=3)
+args = parser.parse_args()
+
+body = amp_response(range(300000000, 300000100))
+print(f'Response with 100 apps: {len(body) / 1e6:.1f} MB')
+bench('json (before)', split_json, body, args.seconds)
+bench('split_apps (json)', split_apps_stdlib, body, args.seconds)
+if amp.orjson is not None:
+    bench('split_apps (orjson)', amp.split_apps, body, args.seconds)
+else:
+    print('orjson is not installed')
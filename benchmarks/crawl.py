@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+'''
+Benchmark the spiders end to end against a local mock App Store (benchmarks/mockstore.py)
+
+- ids: the appstore_ids spider crawls the synthetic catalog (with --page_cache a second time with the page cache)
+- meta: the appstore_meta spider crawls --apps synthetic app ids
+- all: ids, collect.py on its output and meta with the collected ids
+
+Every step runs in its own process, reported are pages/s, apps/s, the CPU time and the peak RSS of the process.
+The CPU time of the mock server is reported as well, it should stay well below the one of the crawl.
+
+Run from the repository root:
+python -m benchmarks.crawl all
+python -m benchmarks.crawl meta --apps 20000 --amp_single --rate_limit 200
+python -m benchmarks.crawl meta --apps 20000 --amp_single --rate_limit 50 --exits 4
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+from appstore.metrics import num_fmt
+from benchmarks.mockstore import FIRST_APP, add_arguments
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def wait(process):
+    '''
+    Wait for a process, returns its exit code, CPU seconds and peak RSS in MB
+    '''
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, usage.ru_utime + usage.ru_stime, usage.ru_maxrss / 1024
+
+
+def run(name, command, workdir):
+    '''
+    Run a step, returns its wall time, CPU seconds and peak RSS in MB
+    '''
+    env = dict(os.environ, PYTHONPATH=ROOT, SCRAPY_SETTINGS_MODULE='benchmarks.settings')
+    with open(os.path.join(workdir, f'{name}.log'), 'w') as log:
+        start = perf_counter()
+        process = subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        code, cpu, rss = wait(process)
+        seconds = perf_counter() - start
+    if code != 0:
+        sys.exit(f'{name} failed with exit code {code}, see {os.path.join(workdir, name + ".log")}')
+    return seconds, cpu, rss
+
+
+def crawl(name, spider, arguments, settings, workdir):
+    metrics = os.path.join(workdir, f'{name}_metrics.json')
+    command = [sys.executable, '-m', 'scrapy', 'crawl', spider]
+    for key, value in arguments.items():
+        command += ['-a', f'{key}={value}']
+    for key, value in dict(settings, APPSTORE_METRICS_FILE=metrics).items():
+        command += ['-s', f'{key}={value}']
+    seconds, cpu, rss = run(name, command, workdir)
+    with open(metrics) as f:
+        values = json.load(f)['metrics']
+    pages = sum(entry['value'] for entry in values.get('appstore_responses_total', []))
+    apps = sum(entry['value'] for entry in values.get('appstore_apps_total', []))
+    report(name, seconds, cpu, rss, apps, pages)
+
+
+def report(name, seconds, cpu, rss, apps, pages=None):
+    line = f'{name:>7}: {seconds:6.1f} s, '
+    if pages is not None:
+        line += f'{num_fmt(pages):>5} pages ({pages / seconds:7.1f}/s), '
+    line += f'{num_fmt(apps):>5} apps ({num_fmt(apps / seconds):>5}/s); '
+    line += f'CPU {cpu:6.1f} s ({cpu / seconds:4.0%}), peak RSS {rss:6.1f} MB'
+    print(line, flush=True)
+
+
+def main(args, workdir):
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'benchmarks.mockstore'] + mock_arguments(args),
+        cwd=ROOT,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    mock_url, *proxies = server.stdout.readline().split()
+    settings = {
+        'APPSTORE_MOCK_URL': mock_url,
+        'CONCURRENT_REQUESTS': args.concurrency * max(args.exits, 1),
+        'CONCURRENT_REQUESTS_PER_DOMAIN': args.concurrency,
+        'APPSTORE_UA_WORKERS': args.ua_workers,
+    }
+    if args.page_cache:
+        settings['APPSTORE_PAGE_CACHE'] = os.path.join(workdir, 'pages.sqlite')
+    if args.exits > 0:
+        # the loopback addresses are all local on linux, the mock rate limits every client address on its own
+        addresses = [f'127.0.0.{k + 1}' for k in range(args.exits)]
+        settings['APPSTORE_EGRESS'] = ','.join(proxies if args.exit_type == 'proxy' else addresses)
+        settings['APPSTORE_EGRESS_PENDING'] = args.concurrency
+    try:
+        inputfile = os.path.join(workdir, 'input_ids')
+        if args.steps in ('ids', 'all'):
+            output = os.path.join(workdir, f'ids.{args.format}')
+            crawl('ids', 'appstore_ids', {'country': args.countries}, dict(settings, FEEDS=feed(output)), workdir)
+            if args.page_cache:
+                # the pages did not change: revalidated (304) or fresh, the app ids come from the cache
+                cached = os.path.join(workdir, f'ids_cached.{args.format}')
+                arguments = {'country': args.countries}
+                crawl('cached', 'appstore_ids', arguments, dict(settings, FEEDS=feed(cached)), workdir)
+        if args.steps == 'all':
+            command = [sys.executable, os.path.join(ROOT, 'collect.py'), output, 'C', '--all']
+            seconds, cpu, rss = run('collect', command, workdir)
+            inputfile = os.path.join(workdir, 'C_all_ids')
+            with open(inputfile) as f:
+                apps = sum(1 for _ in f)
+            report('collect', seconds, cpu, rss, apps)
+        elif args.steps == 'meta':
+            with open(inputfile, 'w') as f:
+                f.writelines(f'{app_id}\n' for app_id in range(FIRST_APP, FIRST_APP + args.apps))
+        if args.steps in ('meta', 'all'):
+            arguments = {
+                'inputfile': inputfile,
+                'outputdir': os.path.join(workdir, 'output'),
+                'storage': args.storage,
+                'amp_single': args.amp_single,
+                'use_UA': args.use_UA,
+                'ua_raw': args.ua_raw,
+                'token_cache': '',
+            }
+            crawl('meta', 'appstore_meta', arguments, settings, workdir)
+    finally:
+        server.terminate()
+        stats = server.stdout.read().strip()
+        _, cpu, rss = wait(server)
+        print(f'   mock: CPU {cpu:6.1f} s, peak RSS {rss:6.1f} MB, requests: {stats}')
+
+
+def feed(output):
+    # FEEDS as json for -s
+    return json.dumps({output: {'format': 'ids' if output.endswith('.ids') else 'jsonlines'}})
+
+
+def mock_arguments(args):
+    # the options of add_arguments
+    arguments = ['--exits', str(args.exits if args.exit_type == 'proxy' else 0)]
+    names = ['categories', 'subcategories', 'max_pages', 'page_apps', 'missing', 'rate_limit', 'retry_after']
+    for name in names + ['token_life', 'latency', 'recorded']:
+        if getattr(args, name) is not None:
+            arguments += [f'--{name}', str(getattr(args, name))]
+    return arguments
+
+
+parser = argparse.ArgumentParser(description='Benchmark the spiders against a local mock App Store')
+parser.add_argument(
+    'steps', help='what to run (default: all)', nargs='?', choices=['ids', 'meta', 'all'], default='all'
+)
+parser.add_argument('--countries', help='countries of the ids crawl (default: us)', default='us')
+parser.add_argument('--format', help='output of the ids crawl (default: jl)', choices=['jl', 'ids'], default='jl')
+parser.add_argument('--page_cache', help='run the ids crawl twice, the second with the page cache', action='store_true')
+parser.add_argument('--apps', help='app ids of the meta step alone (default: 10000)', type=int, default=10000)
+parser.add_argument('--amp_single', help='one app per amp request', action='store_true')
+parser.add_argument('--use_UA', help='also crawl the UA endpoint', action='store_true')
+parser.add_argument('--ua_raw', help='keep the raw UA responses', action='store_true')
+parser.add_argument('--ua_workers', help='processes of the UA extraction (default: 2)', type=int, default=2)
+parser.add_argument('--storage', help='storage of the metadata (default: jsonl)', default='jsonl')
+parser.add_argument('--concurrency', help='concurrent requests (default: 8)', type=int, default=8)
+parser.add_argument(
+    '--exit_type',
+    help='exits with --exits: proxy stand-ins of the mock or loopback source addresses (default: proxy)',
+    choices=['proxy', 'bind'],
+    default='proxy',
+)
+parser.add_argument('--workdir', help='keep the outputs and logs in this directory (default: temporary directory)')
+add_arguments(parser)
+args = parser.parse_args()
+
+if args.workdir is not None:
+    os.makedirs(args.workdir, exist_ok=True)
+    main(args, os.path.abspath(args.workdir))
+else:
+    with tempfile.TemporaryDirectory() as workdir:
+        main(args, workdir)
@@ -0,0 +1,161 @@
+'''
+Synthetic App Store data for the benchmarks
+'''
+
+import json
+
+
+def amp_app(app_id):
+    '''
+    An app like in the data list of an amp api response
+    '''
+    platform = {
+        'bundleId': f'com.example.app{app_id}',
+        'description': {'standard': 'Lorem ipsum dolor sit amet, “consectetur” adipiscing {elit} [x].\n' * 30},
+        'artwork': {'width': 1024, 'height': 1024, 'url': 'https://is1-ssl.mzstatic.com/image/thumb/{w}x{h}bb.{f}'},
+        'versionHistory': [
+            {'versionDisplay': f'1.{k}', 'releaseNotes': 'Fixes [bugs] and {stuff}\n' * 5, 'releaseDate': '2021-01-01'}
+            for k in range(20)
+        ],
+        'screenshotsByType': {
+            'iphone6+': [{'url': 'https://is1-ssl.mzstatic.com/{w}x{h}.{f}', 'width': 1242, 'height': 2208}] * 8
+        },
+        'requirementsByDeviceFamily': {
+            'iphone': {'deviceFamily': 'iphone', 'requirementString': 'Requires iOS 12.0 or later.'}
+        },
+    }
+    return {
+        'id': str(app_id),
+        'type': 'apps',
+        'href': f'/v1/catalog/us/apps/{app_id}',
+        'attributes': {
+            'name': f'App “{app_id}” \\ "quoted"',
+            'artistName': 'Example Developer',
+            'userRating': {'value': 4.5, 'ratingCount': 1234, 'ratingCountList': [1, 2, 3, 4, 5]},
+            'platformAttributes': {'ios': platform, 'appletvos': platform},
+        },
+        'relationships': {
+            'developer': {'href': '/v1/catalog/us/apps/{app_id}/developer', 'data': [{'id': '1', 'type': 'developers'}]}
+        },
+    }
+
+
+def ua_response(app_id):
+    '''
+    Body of a response of the UA endpoint: the app (storePlatformData) and the data of its page
+    (reviews, related apps), which is most of the response
+    '''
+    platform = amp_app(app_id)['attributes']['platformAttributes']['ios']
+    app = {
+        'id': str(app_id),
+        'kind': 'iosSoftware',
+        'name': f'App “{app_id}” \\ "quoted"',
+        'artistName': 'Example Developer',
+        'artistId': '1',
+        'url': f'https://apps.apple.com/us/app/app/id{app_id}',
+        'bundleId': platform['bundleId'],
+        'description': platform['description'],
+        'artwork': platform['artwork'],
+        'screenshotsByType': platform['screenshotsByType'],
+        'userRating': {'value': 4.5, 'ratingCount': 1234, 'ratingCountList': [1, 2, 3, 4, 5]},
+        'genreNames': ['Books', 'Reference'],
+        'genres': [{'genreId': '6018', 'name': 'Books', 'url': 'https://apps.apple.com/us/genre/id6018'}],
+        'releaseDate': '2015-06-01',
+        'versionHistory': [
+            {'versionString': v['versionDisplay'], 'releaseNotes': v['releaseNotes'], 'releaseDate': v['releaseDate']}
+            for v in platform['versionHistory']
+        ],
+        'offers': [{'type': 'get', 'price': 0.0, 'priceFormatted': '$0.00'}],
+        'softwareInfo': {'seller': 'Example Inc.', 'requirementsString': 'Requires iOS 12.0 or later.'},
+    }
+    review = {'userName': 'someone', 'rating': 5, 'title': 'Great', 'body': 'Works {well} “enough”.\n' * 10}
+    lockup = {'id': '1', 'name': 'Related app', 'artwork': platform['artwork'], 'userRating': app['userRating']}
+    page = {'reviews': [review] * 20, 'customersAlsoBoughtApps': [lockup] * 20, 'moreByThisDeveloper': [lockup] * 10}
+    response = {'storePlatformData': {'product-dv': {'results': {str(app_id): app}}}, 'pageData': page}
+    return json.dumps(response, ensure_ascii=False).encode()
+
+
+def amp_response(app_ids):
+    '''
+    Body of an amp api response for app_ids
+    '''
+    return json.dumps({'data': [amp_app(app_id) for app_id in app_ids]}, ensure_ascii=False).encode()
+
+
+
+def genre_url(country, category_id, letter=None, page=None):
+    url = f'https://apps.apple.com/{country}/genre/ios-books/id{category_id}'
+    if letter is not None:
+        url += f'?letter={letter}'
+        if page is not None:
+            url += f'&page={page}'
+    return url
+
+
+def letter_page(country, category_id, letter, page, app_ids, pages=18, window=None):
+    '''
+    Body of a page of a letter of a category like https://apps.apple.com/us/genre/ios-books/id6018?letter=A&page=2
+    (the app links are in 3 columns, with navigation around them).
+    The pagination links to all pages or only to the pages within window of the page.
+    '''
+
+    def link(url, text, selected=False):
+        attr = ' class="selected"' if selected else ''
+        return f'<li><a href="{url}"{attr}>{text}</a></li>\n'
+
+    nav = ''.join(
+        link(f'https://www.apple.com/{country}/{name}/', name.title())
+        for name in ['mac', 'ipad', 'iphone', 'watch', 'tv', 'music', 'support'] * 6
+    )
+    footer = ''.join(link(f'https://www.apple.com/{country}/legal/{k}/', f'Legal {k}') for k in range(60))
+    letters = ''.join(link(genre_url(country, category_id, c), c, c == letter) for c in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ*')
+    paginate = ''.join(
+        link(genre_url(country, category_id, letter, k) + '#page', k, k == page)
+        for k in range(1, pages + 1)
+        if window is None or abs(k - page) <= window
+    )
+    if page < pages:
+        paginate += link(genre_url(country, category_id, letter, page + 1) + '#page', 'Next')
+    paginate = paginate.replace('&', '&amp;')
+    columns = ''
+    column_size = (len(app_ids) + 2) // 3
+    for c, name in enumerate(['column first', 'column', 'column last']):
+        links = ''.join(
+            link(f'https://apps.apple.com/{country}/app/app-name-{app_id}/id{app_id}', f'App &amp; {app_id}')
+            for app_id in app_ids[c * column_size : (c + 1) * column_size]
+        )
+        columns += f'<div class="{name}">\n<ul>\n{links}</ul>\n</div>\n'
+    return f'''<!DOCTYPE html>
+<html lang="en-{country}">
+<head>
+<meta charset="utf-8">
+<title>Books Apps - App Store Downloads on iTunes</title>
+<link rel="stylesheet" href="https://apps.apple.com/htmlResources/web-storefront.css">
+<script>var its = {{"storefront": "{country}", "genre": {category_id}, "html": "<a href=\\"#\\">"}};</script>
+</head>
+<body>
+<nav id="globalheader"><ul class="gn-list">
+{nav}</ul></nav>
+<div id="main">
+<div id="genre-nav" class="main nav">
+<ul class="list top-level-genres">
+<li><a href="{genre_url(country, category_id)}" class="top-level-genre" title="Books - App Store">Books</a></li>
+</ul>
+</div>
+<div id="selectedgenre">
+<h4>Books</h4>
+<ul class="list alpha">
+{letters}</ul>
+<ul class="list paginate">
+{paginate}</ul>
+<div id="selectedcontent" class="grid3-column">
+{columns}</div>
+<ul class="list paginate">
+{paginate}</ul>
+</div>
+</div>
+<footer id="globalfooter"><ul>
+{footer}</ul></footer>
+</body>
+</html>
+'''.encode()
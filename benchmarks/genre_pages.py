@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+'''
+Benchmark the link extraction of the letter pages of the appstore_ids spider
+
+Run from the repository root: python -m benchmarks.genre_pages [--pages DIR]
+Saved pages (e.g. scrapy fetch --nolog "https://apps.apple.com/us/genre/ios-books/id6018?letter=A&page=2" > A2.html)
+are used instead of the synthetic ones with --pages.
+'''
+
+import argparse
+import glob
+import os
+from time import perf_counter, process_time
+
+from lxml import etree
+from scrapy.http import HtmlResponse
+
+from appstore.genre import app_ids, app_links, page_links, page_numbers
+from benchmarks.fixtures import genre_url, letter_page
+
+
+def extract_css(response):
+    # the way parse_categorie_letter did it before appstore.genre
+    apps = {}
+    for url in set(response.css('.grid3-column a::attr(href)').getall()):
+        apps[url] = int(url.split('/')[-1].lstrip('id').split('?')[0])
+    pages = {response.urljoin(url) for url in response.css('ul.paginate a::attr(href)').getall()}
+    return apps, pages
+
+
+APPS_XPATH = etree.XPath(
+    "descendant-or-self::*[@class and contains(concat(' ', normalize-space(@class), ' '), ' grid3-column ')]"
+    "/descendant::a/@href"
+)
+PAGES_XPATH = etree.XPath(
+    "descendant-or-self::ul[@class and contains(concat(' ', normalize-space(@class), ' '), ' paginate ')]"
+    "/descendant::a/@href"
+)
+
+
+def extract_xpath(response):
+    # one lxml parse and precompiled xpath
+    root = response.selector.root
+    apps = {}
+    for url in set(APPS_XPATH(root)):
+        apps[url] = int(url.split('/')[-1].lstrip('id').split('?')[0])
+    pages = {response.urljoin(url) for url in dict.fromkeys(PAGES_XPATH(root))}
+    return apps, pages
+
+
+def extract_regex(response):
+    # like parse_categorie_letter (the frontier needs only the numbers of the pages)
+    return app_ids(response), page_numbers(response)
+
+
+def check(response):
+    # the app links that are not in an app list (e.g. of the letters) are no apps
+    apps, pages = extract_css(response)
+    apps = {url: app_id for url, app_id in apps.items() if '/app/' in url}
+    ids, _ = extract_regex(response)
+    links = {url: app_id for app_id, url in app_links(response)}
+    return apps == links and set(apps.values()) == set(ids) and pages == set(page_links(response))
+
+
+def load_pages(directory):
+    if directory is None:
+        pages = []
+        for k in range(20):
+            app_ids = list(range(1000000000 + k * 240, 1000000000 + (k + 1) * 240))
+            letter = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'[k % 26]
+            body = letter_page('us', 6018, letter, k + 1, app_ids)
+            pages.append(HtmlResponse(genre_url('us', 6018, letter, k + 1), body=body, encoding='utf-8'))
+        return pages
+    return [
+        HtmlResponse(genre_url('us', 6018, 'A', 2), body=open(filename, 'rb').read())
+        for filename in sorted(glob.glob(os.path.join(directory, '*.html')))
+    ]
+
+
+def bench(name, extract, pages, seconds):
+    num = 0
+    start, start_cpu = perf_counter(), process_time()
+    while perf_counter() - start < seconds:
+        for page in pages:
+            # a new response like in a crawl (the parsed document is cached by the response)
+            extract(page.replace())
+        num += len(pages)
+    cpu = process_time() - start_cpu
+    print(f'{name:>24}: {num / cpu:8.0f} pages/s per core')
+
+
+parser = argparse.ArgumentParser(description='Benchmark the link extraction of the letter pages')
+parser.add_argument('--pages', help='directory with saved letter pages (*.html), default: synthetic pages')
+parser.add_argument('--seconds', help='run every variant this long (default: 3)', type=float, default=3)
+args = parser.parse_args()
+
+pages = load_pages(args.pages)
+if len(pages) == 0:
+    parser.error(f'No *.html files in {args.pages}')
+print(f'{len(pages)} pages, {sum(len(page.body) for page in pages) / len(pages) / 1e3:.0f} KB each')
+for page in pages:
+    if not check(page):
+        print(f'Different links in {page.url}')
+bench('css (before)', extract_css, pages, args.seconds)
+bench('xpath (precompiled)', extract_xpath, pages, args.seconds)
+bench('regex (appstore.genre)', extract_regex, pages, args.seconds)
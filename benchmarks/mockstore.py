@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+'''
+Local stand-in for the App Store, used by benchmarks.crawl
+
+It serves a synthetic catalog (or recorded responses):
+- the genre pages: /{country}/genre/ios/id36, categories with their popular apps and letters, pages of the letters
+- the app page with the token of the amp api: /{country}/app/id{id} (UA json with an AppStore user agent)
+- the amp api: /v1/catalog/{country}/apps?ids=... and /v1/catalog/{country}/apps/{id} (401 without a valid token)
+The genre pages have an ETag and are answered with a 304 when they did not change (If-None-Match).
+Every endpoint can be rate limited (429 with Retry-After), per client address.
+
+With --exits it also listens on more ports that stand in for proxies of an egress pool (APPSTORE_EGRESS):
+they take proxy requests (absolute urls) and answer them from the same catalog,
+with rate limits of their own like separate exits to Apple.
+
+The crawl reaches it through the MockDownloadHandler (benchmarks/settings.py),
+which sends the https requests to the mock server and keeps their urls.
+
+Run from the repository root: python -m benchmarks.mockstore --port 8765
+'''
+
+import argparse
+import base64
+import hashlib
+import json
+import os
+import signal
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep, time
+from urllib.parse import parse_qs, quote, urlsplit
+
+from scrapy.core.downloader.handlers.http11 import HTTP11DownloadHandler
+
+from benchmarks.fixtures import amp_app, genre_url, letter_page, ua_response
+
+LETTERS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ*'
+FIRST_CATEGORY = 6000
+FIRST_APP = 300000000
+# id in the template of an app, replaced by the id of every app
+TEMPLATE_ID = '999999999'
+
+
+class Catalog:
+    '''
+    A synthetic catalog: categories with letters, every letter has 1 to max_pages pages of apps (different per letter)
+    The app ids are unique per page, the popular apps of a category are the first apps of its letters.
+    '''
+
+    def __init__(self, categories=10, subcategories=3, max_pages=20, page_apps=150, missing=0.0):
+        self.categories = [FIRST_CATEGORY + k for k in range(categories)]
+        # the last category has subcategories (they have all letters as well)
+        self.subcategories = [FIRST_CATEGORY + categories + k for k in range(subcategories)]
+        self.max_pages = max_pages
+        self.page_apps = page_apps
+        # every 1/missing-th app is not in the amp api
+        self.missing_every = round(1 / missing) if missing > 0 else 0
+        self._app = json.dumps(amp_app(int(TEMPLATE_ID)), ensure_ascii=False)
+        self._ua = ua_response(int(TEMPLATE_ID)).decode()
+
+    def pages(self, category_id, letter):
+        return 1 + (category_id * 7 + LETTERS.index(letter) * 13) % self.max_pages
+
+    def app_ids(self, category_id, letter, page):
+        if page < 1 or page > self.pages(category_id, letter):
+            return []
+        index = (category_id - FIRST_CATEGORY) * len(LETTERS) + LETTERS.index(letter)
+        first = FIRST_APP + (index * self.max_pages + page - 1) * self.page_apps
+        return list(range(first, first + self.page_apps))
+
+    def app_count(self):
+        return sum(
+            self.pages(category_id, letter) * self.page_apps
+            for category_id in self.categories + self.subcategories
+            for letter in LETTERS
+        )
+
+    def exists(self, app_id):
+        return not (self.missing_every and app_id % self.missing_every == 0)
+
+    def main_page(self, country):
+        def link(category_id, title, attrs=''):
+            return f'<a href="{genre_url(country, category_id)}"{attrs} title="{title} - App Store">{title}</a>'
+
+        top = ' class="top-level-genre"'
+        items = [f'<li>{link(c, f"Category {c}", top)}</li>' for c in self.categories[:-1]]
+        subgenres = ''.join(f'<li>{link(c, f"Subcategory {c}")}</li>' for c in self.subcategories)
+        parent = link(self.categories[-1], f'Category {self.categories[-1]}', top)
+        items.append(f'<li>{parent}<ul class="list top-level-subgenres">{subgenres}</ul></li>')
+        items = '\n'.join(items)
+        nav = f'<div id="genre-nav"><ul class="list column first">\n{items}\n</ul></div>'
+        return f'<html><body>{nav}</body></html>'.encode()
+
+    def genre_page(self, country, category_id, letter, page):
+        if letter is None:
+            # the category: its popular apps (the first apps of the letters) and the letters, no pages
+            popular = [self.app_ids(category_id, c, 1)[0] for c in LETTERS]
+            return letter_page(country, category_id, None, 1, popular, pages=0)
+        pages = self.pages(category_id, letter)
+        return letter_page(country, category_id, letter, page, self.app_ids(category_id, letter, page), pages, window=5)
+
+    def amp_apps(self, app_ids):
+        apps = ','.join(self._app.replace(TEMPLATE_ID, str(app_id)) for app_id in app_ids if self.exists(app_id))
+        return f'{{"data":[{apps}]}}'.encode()
+
+    def ua_app(self, app_id):
+        return self._ua.replace(TEMPLATE_ID, str(app_id)).encode()
+
+
+def b64(data):
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).rstrip(b'=').decode()
+
+
+class RateLimit:
+    '''
+    Token bucket of rate requests per second (burst of one second)
+    '''
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._tokens = rate
+        self._time = time()
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            now = time()
+            self._tokens = min(self.rate, self._tokens + (now - self._time) * self.rate)
+            self._time = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class MockAppStore(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, catalog, rate_limit=0, retry_after=1, token_life=3600, latency=0, recorded=None):
+        super().__init__(address, MockHandler)
+        self.catalog = catalog
+        self.rate_limits = {}
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.token_life = token_life
+        self.latency = latency
+        self.recorded = recorded
+        # token: expiry
+        self.tokens = {}
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+    def share(self, server):
+        '''
+        Use the tokens and stats of another server (a proxy stand-in of the main server)
+        '''
+        self.tokens = server.tokens
+        self.lock = server.lock
+        self.stats = server.stats
+
+    def allow(self, endpoint, client):
+        if self.rate_limit <= 0:
+            return True
+        key = (client, endpoint)
+        with self.lock:
+            if key not in self.rate_limits:
+                self.rate_limits[key] = RateLimit(self.rate_limit)
+        return self.rate_limits[key].allow()
+
+    def new_token(self):
+        now = time()
+        token = b64({'alg': 'ES256', 'typ': 'JWT'}) + '.'
+        token += b64({'iss': 'mockstore', 'iat': int(now), 'exp': int(now + self.token_life)}) + '.'
+        token += b64({'n': len(self.tokens)})
+        with self.lock:
+            self.tokens[token] = now + self.token_life
+        return token
+
+    def valid_token(self, token):
+        expires = self.tokens.get(token)
+        return expires is not None and time() < expires
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    # keep-alive like the App Store
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, body=b'', content_type='text/html; charset=utf-8', headers={}):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_page(self, body):
+        # conditional requests get a 304 for the same page
+        etag = '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.server.count('304')
+            self.send(304, headers={'ETag': etag})
+        else:
+            self.send(200, body, headers={'ETag': etag})
+
+    def do_GET(self):
+        server = self.server
+        u = urlsplit(self.path)
+        # proxy requests have absolute urls
+        path = u.path + ('?' + u.query if u.query else '')
+        query = parse_qs(u.query)
+        parts = u.path.strip('/').split('/')
+        if u.path.startswith('/v1/catalog/'):
+            endpoint = 'amp'
+        elif 'AppStore' in self.headers.get('User-Agent', ''):
+            endpoint = 'ua'
+        elif len(parts) > 1 and parts[1] == 'genre':
+            endpoint = 'genre'
+        else:
+            endpoint = 'token'
+        server.count(endpoint)
+        if server.latency > 0:
+            sleep(server.latency)
+        if not server.allow(endpoint, self.client_address[0]):
+            server.count('429')
+            self.send(429, headers={'Retry-After': str(server.retry_after)})
+            return
+
+        if server.recorded is not None:
+            path = os.path.join(server.recorded, quote(path, safe=''))
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    self.send(200, f.read())
+                return
+
+        catalog = server.catalog
+        country = parts[0]
+        if endpoint == 'amp':
+            token = self.headers.get('Authorization', '')[len('Bearer ') :]
+            if not server.valid_token(token):
+                server.count('401')
+                self.send(401)
+            elif parts[-1] == 'apps':
+                app_ids = [int(app_id) for app_id in query['ids'][0].split(',')]
+                self.send(200, catalog.amp_apps(app_ids), 'application/json')
+            elif catalog.exists(int(parts[-1])):
+                self.send(200, catalog.amp_apps([int(parts[-1])]), 'application/json')
+            else:
+                self.send(404, b'{"errors":[{"status":"404"}]}', 'application/json')
+        elif endpoint == 'ua':
+            self.send(200, catalog.ua_app(int(parts[-1].lstrip('id'))), 'application/json')
+        elif endpoint == 'genre':
+            category_id = int(parts[-1].lstrip('id'))
+            if category_id == 36:
+                self.send_page(catalog.main_page(country))
+                return
+            letter = query.get('letter', [None])[0]
+            self.send_page(catalog.genre_page(country, category_id, letter, int(query.get('page', ['1'])[0])))
+        else:
+            config = quote(json.dumps({'MEDIA_API': {'token': server.new_token()}}))
+            meta = f'<meta name="web-experience-app/config/environment" content="{config}">'
+            self.send(200, f'<html><head>{meta}</head><body></body></html>'.encode())
+
+
+class MockDownloadHandler(HTTP11DownloadHandler):
+    '''
+    Download handler (for https) that sends every request to the mock server at APPSTORE_MOCK_URL.
+    The responses get the url of the request, so the spiders see the urls of the App Store.
+    '''
+
+    def __init__(self, settings, crawler=None):
+        super().__init__(settings, crawler)
+        self.mock_url = settings['APPSTORE_MOCK_URL'].rstrip('/')
+
+    def download_request(self, request, spider):
+        u = urlsplit(request.url)
+        mocked = request.replace(url=self.mock_url + u.path + ('?' + u.query if u.query else ''))
+
+        def restore(response):
+            request.meta['download_latency'] = mocked.meta.get('download_latency')
+            return response.replace(url=request.url, request=request)
+
+        return super().download_request(mocked, spider).addCallback(restore)
+
+
+def add_arguments(parser):
+    parser.add_argument('--categories', help='categories (default: 4)', type=int, default=4)
+    parser.add_argument('--subcategories', help='subcategories of the last category (default: 2)', type=int, default=2)
+    parser.add_argument('--max_pages', help='maximum pages of a letter (default: 10)', type=int, default=10)
+    parser.add_argument('--page_apps', help='apps per page of a letter (default: 100)', type=int, default=100)
+    parser.add_argument('--missing', help='fraction of the apps that are not in the amp api (default: 0)', type=float)
+    parser.add_argument('--rate_limit', help='requests per second of an endpoint until 429 (default: none)', type=float)
+    parser.add_argument('--retry_after', help='Retry-After of a 429 in seconds (default: 1)', type=int, default=1)
+    parser.add_argument('--token_life', help='seconds until a token expires (default: 3600)', type=int, default=3600)
+    parser.add_argument('--latency', help='seconds until a response is sent (default: 0)', type=float, default=0)
+    parser.add_argument('--recorded', help='directory with recorded responses (file names: url encoded path + query)')
+    parser.add_argument('--exits', help='proxy stand-ins with their own rate limits (default: 0)', type=int, default=0)
+
+
+def create_server(args, port=0, catalog=None):
+    if catalog is None:
+        catalog = Catalog(args.categories, args.subcategories, args.max_pages, args.page_apps, args.missing or 0)
+    return MockAppStore(
+        ('127.0.0.1', port),
+        catalog,
+        rate_limit=args.rate_limit or 0,
+        retry_after=args.retry_after,
+        token_life=args.token_life,
+        latency=args.latency,
+        recorded=args.recorded,
+    )
+
+
+def start_exits(server, args):
+    '''
+    Start the proxy stand-ins of server in threads, returns them
+    '''
+    exits = []
+    for _ in range(args.exits):
+        exit_server = create_server(args, catalog=server.catalog)
+        exit_server.share(server)
+        threading.Thread(target=exit_server.serve_forever, daemon=True).start()
+        exits.append(exit_server)
+    return exits
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the App Store')
+    parser.add_argument('--port', help='port (default: 0, any free port)', type=int, default=0)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = create_server(args, args.port)
+    exits = start_exits(server, args)
+    # benchmarks.crawl stops it with SIGTERM
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    # the first line tells benchmarks.crawl where the server and the proxy stand-ins are
+    urls = [f'http://127.0.0.1:{s.server_address[1]}' for s in [server] + exits]
+    print(' '.join(urls), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(server.stats), flush=True)
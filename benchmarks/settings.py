@@ -0,0 +1,22 @@
+'''
+Settings of the crawls of benchmarks.crawl: the settings of the project,
+but every https request is sent to the mock server (benchmarks/mockstore.py) without delays
+'''
+
+from appstore.settings import *  # noqa: F401,F403
+
+DOWNLOAD_HANDLERS = {'https': 'benchmarks.mockstore.MockDownloadHandler'}
+# set by benchmarks.crawl
+APPSTORE_MOCK_URL = 'http://127.0.0.1:8765'
+
+# the throughput of the crawler is measured, not the rate Apple allows
+APPSTORE_DOWNLOAD_SLOTS = {
+    'amp': {'delay': 0},
+    'amp_single': {'delay': 0},
+    'ua': {'delay': 0},
+    'genre': {'delay': 0},
+}
+APPSTORE_TOKEN_CACHE = ''
+# set by benchmarks.crawl with --page_cache
+APPSTORE_PAGE_CACHE = ''
+LOG_LEVEL = 'INFO'
@@ -1,79 +1,70 @@
 #!/usr/bin/env python
 
-import json
 import argparse
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
 
-parser = argparse.ArgumentParser(description='Process appstore jl file')
-parser.add_argument('input', help='the input file')
+from appstore.collector import Collector, collect_chunk, split_files
+
+parser = argparse.ArgumentParser(description='Process appstore jl files')
+parser.add_argument('input', help='the input files (or glob patterns like "out_*.jl")', nargs='+')
 parser.add_argument('output', help='base name of the output files')
 
 parser.add_argument('--all', help='save all files', action='store_true')
 parser.add_argument('--json', help='save json file', action='store_true')
 parser.add_argument('--all_ids', help='save all_ids file', action='store_true')
 parser.add_argument('--popular_ids', help='save popular_ids file', action='store_true')
-parser.add_argument('--sort', help='sort ids', action='store_true')
-
-args = parser.parse_args()
-
-if not (args.all or args.json or args.all_ids or args.popular_ids):
-    parser.error('No file will be saved. Add at least one file type')
-
-data = {}
-all_popular_apps_ids = set()
-all_apps_ids = set()
-
-print('Reading input...')
-with open(args.input) as f:
-    for line in f:
-        jl = json.loads(line)
-        category_id = jl['category_id']
-
-        if category_id not in data:
-            data[category_id] = {}
-
-        if 'apps' in jl:
-            all_apps_ids.update(jl['apps'])
-            if 'apps' not in data[category_id]:
-                data[category_id]['apps'] = set()
-            data[category_id]['apps'].update(jl['apps'])
-
-        elif 'popular-apps' in jl:
-            all_popular_apps_ids.update(jl['popular-apps'])
-            data[category_id]['popular-apps'] = list(set(jl['popular-apps']))
-
-            # add popular apps also to all apps
-            all_apps_ids.update(jl['popular-apps'])
-            if 'apps' not in data[category_id]:
-                data[category_id]['apps'] = set()
-            data[category_id]['apps'].update(jl['popular-apps'])
-        else:
-            print('Unknown data:', jl)
-
-# convert set to list
-for category_id in data:
-    try:
-        s = data[category_id]['apps']
-        data[category_id]['apps'] = list(s)
-    except KeyError:
-        pass
-
-if args.sort:
-    print('Sort...')
-    all_popular_apps_ids = sorted(all_popular_apps_ids)
-    all_apps_ids = sorted(all_apps_ids)
-
-
-print('Writing to files...')
-if args.json or args.all:
-    with open(args.output + '.json', 'w') as f:
-        json.dump(data, f, indent=2)
-
-if args.popular_ids or args.all:
-    with open(args.output + '_popular_ids', 'w') as f:
-        for app_id in all_popular_apps_ids:
-            f.write(str(app_id) + '\n')
-
-if args.all_ids or args.all:
-    with open(args.output + '_all_ids', 'w') as f:
-        for app_id in all_apps_ids:
-            f.write(str(app_id) + '\n')
+parser.add_argument('--countries', help='save countries file (which app is in which country)', action='store_true')
+parser.add_argument('--country', help='only use the ids of this country (for crawls of multiple countries)')
+parser.add_argument('--sort', help='sort ids (ids are always sorted now)', action='store_true')
+parser.add_argument(
+    '--processes', help='number of processes (default: number of cpus)', type=int, default=os.cpu_count()
+)
+parser.add_argument('--chunk_size', help='MB of input per task (default: 16)', type=float, default=16)
+parser.add_argument('--tmpdir', help='directory for the temporary files of the sort (default: system temp dir)')
+
+
+def main():
+    args = parser.parse_args()
+
+    if not (args.all or args.json or args.all_ids or args.popular_ids or args.countries):
+        parser.error('No file will be saved. Add at least one file type')
+
+    filenames = []
+    for pattern in args.input:
+        matches = sorted(glob.glob(pattern))
+        if len(matches) == 0:
+            parser.error(f'No input file found for {pattern}')
+        filenames.extend(matches)
+
+    save_json = args.json or args.all
+    chunk_size = max(int(args.chunk_size * 1024 * 1024), 1)
+    tasks = [
+        (filename, start, end, args.country, save_json, args.tmpdir)
+        for filename, start, end in split_files(filenames, chunk_size)
+    ]
+
+    print(f'Reading {len(filenames)} input files ({len(tasks)} chunks)...')
+    collector = Collector(args.tmpdir)
+    if args.processes > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(args.processes) as pool:
+            for result in pool.map(collect_chunk, tasks):
+                collector.add(result)
+    else:
+        for result in map(collect_chunk, tasks):
+            collector.add(result)
+    print(f'Countries: {", ".join(collector.countries)}')
+
+    print('Writing to files...')
+    collector.write(
+        args.output,
+        all_ids=args.all_ids or args.all,
+        popular_ids=args.popular_ids or args.all,
+        save_json=save_json,
+        matrix=args.countries or args.all,
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+from itertools import chain, islice
+from time import sleep
+
+from appstore.idset import IDSet
+from appstore.priority import load_priorities
+from appstore.workqueue import open_queue
+
+parser = argparse.ArgumentParser(description='Fill and watch the work queue of a distributed metadata crawl')
+subparsers = parser.add_subparsers(dest='command', required=True)
+
+parser_fill = subparsers.add_parser('fill', help='add the ids of a file to the queue')
+parser_fill.add_argument('queue', help='redis://host:port/db or sqlite:///path/to/queue.sqlite')
+parser_fill.add_argument('input', help='file with one id per line')
+parser_fill.add_argument(
+    '--storefronts',
+    help='comma separated country/platform/locale (default: us/iphone/en-US)',
+    default='us/iphone/en-US',
+)
+parser_fill.add_argument('--exclude', help='file with ids that should not be added')
+parser_fill.add_argument('--batch_size', help='ids per batch (default: 1000)', type=int, default=1000)
+parser_fill.add_argument('--priority_file', help='file with ids (and scores) that are added first')
+parser_fill.add_argument('--categories_file', help='json file of collect.py for --priority_categories')
+parser_fill.add_argument('--priority_categories', help='comma separated ids of categories that are added first')
+
+parser_status = subparsers.add_parser('status', help='show the progress of the crawl')
+parser_status.add_argument('queue', help='redis://host:port/db or sqlite:///path/to/queue.sqlite')
+parser_status.add_argument('--watch', help='show the progress every WATCH seconds', type=float)
+parser_status.add_argument('--json', help='print json', action='store_true')
+
+args = parser.parse_args()
+queue = open_queue(args.queue)
+
+
+def batches(ids, size):
+    it = iter(ids)
+    while True:
+        batch = list(islice(it, size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+
+def print_status(stats):
+    if args.json:
+        print(json.dumps(stats))
+        return
+    print('Batches:', ', '.join(f'{status}: {num}' for status, num in sorted(stats['batches'].items())))
+    print(f'Expired leases: {stats["expired"]}')
+    print(f'Ids: {stats["ids"]["total"]}')
+    print('Results:', ', '.join(f'{result}: {num}' for result, num in sorted(stats['results'].items())))
+    for worker, batches in sorted(stats['workers'].items()):
+        print(f'  {worker}:', ', '.join(f'{status}: {num}' for status, num in sorted(batches.items())))
+
+
+if args.command == 'fill':
+    print('Reading input...')
+    ids = IDSet.from_text(args.input)
+    if args.exclude is not None:
+        ids = ids - IDSet.from_text(args.exclude)
+    categories = None if args.priority_categories is None else args.priority_categories.split(',')
+    try:
+        priorities = load_priorities(args.priority_file, args.categories_file, categories)
+    except ValueError as e:
+        parser.error(str(e))
+    order = [ids]
+    if priorities is not None:
+        # workers lease the batches in the order they were added
+        priorities.restrict(ids)
+        order = [priorities.ids, ids - priorities.id_set]
+        print(f'{len(priorities)} ids are prioritized')
+    for storefront in args.storefronts.split(','):
+        if len(storefront.strip().split('/')) != 3:
+            parser.error(f'Storefront "{storefront}" is not in the format country/platform/locale')
+        num = queue.fill(storefront.strip(), batches(chain(*order), args.batch_size))
+        print(f'Added {len(ids)} ids of {storefront} in {num} batches')
+
+elif args.command == 'status':
+    while True:
+        print_status(queue.stats())
+        if args.watch is None:
+            break
+        sleep(args.watch)
+        print()
+
+queue.close()
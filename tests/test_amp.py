@@ -0,0 +1,57 @@
+import json
+
+import pytest
+
+from appstore import amp as amp_module
+from appstore.amp import AmpBatcher, split_apps
+
+
+def batcher():
+    return AmpBatcher(lambda ids: 'https://amp-api.apps.apple.com/v1/catalog/us/apps?ids=' + ','.join(ids))
+
+
+def test_missing_apps_are_batched_again_without_shrinking():
+    amp = batcher()
+    for app_id in range(1, 100):
+        assert amp.add(app_id) is None
+    url, ids = amp.add(100)
+    assert len(ids) == 100
+
+    # most of the apps are missing, e.g. removed from the store
+    gave_up = amp.response(ids, set(ids[:10]), latency=1, size=1024)
+    assert gave_up == []
+    assert amp.size == 100
+    url, retry = next(amp.flush())
+    assert retry == ids[10:]
+
+    gave_up = amp.response(retry, set(), latency=1, size=1024)
+    assert gave_up == ids[10:]
+    assert amp.size == 100
+    assert list(amp.flush()) == []
+
+
+def test_slow_or_big_responses_shrink():
+    amp = batcher()
+    amp.response(['1'], {'1'}, latency=amp.max_latency + 1, size=1024)
+    assert amp.size == 50
+    amp.response(['1'], {'1'}, latency=1, size=amp.max_response_size + 1)
+    assert amp.size == 25
+    amp.response(['1'], {'1'}, latency=1, size=1024)
+    assert amp.size == 25 + amp.step
+
+
+@pytest.mark.parametrize('use_orjson', [False, True])
+def test_split_apps(monkeypatch, use_orjson):
+    if use_orjson:
+        pytest.importorskip('orjson')
+    else:
+        monkeypatch.setattr(amp_module, 'orjson', None)
+    apps = [{'id': '1', 'attributes': {'name': 'A “b” \\ [c]'}}, {'id': '2', 'data': [{'id': '3'}]}]
+    body = json.dumps({'meta': {'data': []}, 'data': apps, 'next': '/v1?offset=2'}, indent=1).encode()
+    split = list(split_apps(body))
+    assert [app_id for app_id, _, _ in split] == ['1', '2']
+    assert [app for _, _, app in split] == apps
+    assert [json.loads(data) for _, data, _ in split] == [{'data': [app]} for app in apps]
+
+    with pytest.raises(json.JSONDecodeError):
+        list(split_apps(body[:-10]))
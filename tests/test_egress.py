@@ -0,0 +1,52 @@
+from scrapy import Request, Spider
+from scrapy.http import Response
+from scrapy.utils.test import get_crawler
+
+from appstore.middlewares import EgressPoolMiddleware, TooManyRequestsRetryMiddleware
+
+URL = 'https://amp-api.apps.apple.com/v1/catalog/us/apps/284882215'
+
+
+def crawler_spider():
+    settings = {'APPSTORE_EGRESS': ['direct', 'http://127.0.0.1:3128'], 'APPSTORE_EGRESS_ENDPOINTS': ['amp']}
+    crawler = get_crawler(Spider, settings)
+    return crawler, crawler._create_spider('amp')
+
+
+def run(coroutine):
+    '''
+    Run a coroutine that does not wait
+    '''
+    try:
+        coroutine.send(None)
+    except StopIteration as stop:
+        return stop.value
+    raise AssertionError('the coroutine waits')
+
+
+def test_429_via_exit_does_not_pause():
+    crawler, spider = crawler_spider()
+    egress = EgressPoolMiddleware.from_crawler(crawler)
+    too_many = TooManyRequestsRetryMiddleware.from_crawler(crawler)
+    request = Request(URL, meta={'download_slot': 'amp'})
+    run(egress.process_request(request, spider))
+    response = Response(URL, status=429, headers={'Retry-After': '30'}, request=request)
+
+    # order of the downloader: response_downloaded, request_left_downloader, process_response
+    egress.response_downloaded(response, request, spider)
+    egress.request_left_downloader(request, spider)
+    retry = too_many.process_response(request, response, spider)
+
+    assert too_many._resume_call is None
+    assert egress._pending[(0, 'amp')] == 0
+    assert egress._ready_at[0] > egress._ready_at[1]
+    assert retry.meta['download_slot'] == 'amp@0'
+
+    # the retry goes through the other exit and is released again
+    egress.request_left_downloader(request, spider)
+    assert egress._pending[(0, 'amp')] == 0
+    run(egress.process_request(retry, spider))
+    assert retry.meta['egress'] == 1
+    assert 'egress_released' not in retry.meta
+    egress.request_left_downloader(retry, spider)
+    assert egress._pending[(1, 'amp')] == 0
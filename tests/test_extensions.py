@@ -0,0 +1,75 @@
+from types import SimpleNamespace
+
+import pytest
+from scrapy import Request, Spider
+from scrapy.core.downloader import Slot
+from scrapy.http import Response
+from scrapy.utils.test import get_crawler
+
+from appstore.extensions import AdaptiveThrottle
+
+URL = 'https://amp-api.apps.apple.com/v1/catalog/us/apps?ids=284882215'
+
+
+SETTINGS = {
+    'ADAPTIVE_THROTTLE_ENABLED': True,
+    'ADAPTIVE_THROTTLE_MIN_DELAY': 0.05,
+    'ADAPTIVE_THROTTLE_MAX_DELAY': 60,
+    'ADAPTIVE_THROTTLE_RATE_INCREASE': 0.02,
+    'ADAPTIVE_THROTTLE_RATE_DECREASE': 0.5,
+}
+
+
+def throttle(settings, delay=1.0):
+    crawler = get_crawler(Spider, settings)
+    spider = crawler._create_spider('amp')
+    # the downloader with the slot of the endpoint
+    slot = Slot(concurrency=1, delay=delay, randomize_delay=False)
+    crawler.engine = SimpleNamespace(downloader=SimpleNamespace(slots={'amp': slot}))
+    return AdaptiveThrottle.from_crawler(crawler), slot, spider
+
+
+def respond(extension, spider, status, latency=0.1):
+    request = Request(URL, meta={'download_slot': 'amp', 'download_latency': latency})
+    extension.request_reached_downloader(request, spider)
+    extension.response_downloaded(Response(URL, status=status, request=request), request, spider)
+
+
+def test_cut_and_recovery():
+    settings = dict(SETTINGS, APPSTORE_DOWNLOAD_SLOTS={'amp': {'delay': 1.0}})
+    extension, slot, spider = throttle(settings)
+
+    respond(extension, spider, 429)
+    assert slot.delay == pytest.approx(2.0)
+    # a 429 of a request that was sent before the cut does not cut again
+    respond(extension, spider, 429, latency=10)
+    assert slot.delay == pytest.approx(2.0)
+
+    # half of the configured rate comes back with 1 / (2 * 0.02) = 25 clean responses
+    for _ in range(24):
+        respond(extension, spider, 200)
+    assert slot.delay > 1.0
+    respond(extension, spider, 200)
+    assert slot.delay == pytest.approx(1.0)
+
+    # and keeps growing up to the minimum delay
+    for _ in range(1000):
+        respond(extension, spider, 200)
+    assert slot.delay == pytest.approx(0.05)
+
+
+def test_unthrottled_slot_recovers():
+    settings = dict(SETTINGS, APPSTORE_DOWNLOAD_SLOTS={'amp': {'delay': 0}})
+    extension, slot, spider = throttle(settings, delay=0)
+
+    respond(extension, spider, 429)
+    assert slot.delay == pytest.approx(0.1)
+    # the rate of the minimum delay (20/s) comes back after about 25 clean responses, then the slot is unthrottled
+    for _ in range(24):
+        respond(extension, spider, 200)
+    assert slot.delay > 0.05
+    for _ in range(2):
+        respond(extension, spider, 200)
+    assert slot.delay == 0
+    respond(extension, spider, 200)
+    assert slot.delay == 0
@@ -0,0 +1,41 @@
+from scrapy.http import HtmlResponse
+
+from appstore.genre import app_ids, app_links, page_numbers
+from benchmarks.fixtures import genre_url, letter_page
+
+URL = genre_url('us', 6018, 'A', 2)
+GRID_END = '</div>\n<ul class="list paginate">'
+
+
+def outside_links(page):
+    # links to app pages before and after the app list, e.g. of featured apps
+    featured = '<div class="featured"><div><a href="https://apps.apple.com/us/app/featured/id{}">Featured</a></div>'
+    featured += '</div>\n'
+    page = page.replace('<div id="main">', '<div id="main">\n' + featured.format(900000001), 1)
+    before, grid_end, after = page.partition(GRID_END)
+    assert grid_end
+    return before + grid_end.replace('</div>', '</div>\n' + featured.format(900000002), 1) + after
+
+
+def css_app_links(response):
+    # the css selector the spider used before appstore.genre
+    return [url for url in dict.fromkeys(response.css('.grid3-column a::attr(href)').getall()) if '/app/' in url]
+
+
+def test_app_links_stop_at_the_end_of_the_grid():
+    ids = list(range(300000000, 300000100))
+    body = outside_links(letter_page('us', 6018, 'A', 2, ids).decode()).encode()
+    response = HtmlResponse(URL, body=body, encoding='utf-8')
+    assert b'/id900000001' in body and b'/id900000002' in body
+
+    urls = css_app_links(response)
+    assert len(urls) == 100
+    assert app_links(response) == [(int(url.split('/id')[-1]), url) for url in urls]
+    assert app_ids(response) == ids
+    assert page_numbers(response) == set(range(1, 19))
+
+
+def test_page_without_app_list():
+    response = HtmlResponse(URL, body=b'<html><body><a href="/us/app/x/id1">x</a></body></html>', encoding='utf-8')
+    assert app_ids(response) == []
+    assert app_links(response) == []
@@ -0,0 +1,31 @@
+import pytest
+
+from appstore.idfile import IDFileWriter, read_blocks, read_index, split
+
+
+def write(filename, mode, ids, close=True):
+    with open(filename, mode) as f:
+        writer = IDFileWriter(f, block_ids=4)
+        for country, app_ids in ids.items():
+            writer.add(country, 6000, 0, app_ids)
+        if close:
+            writer.close()
+
+
+def read(filename):
+    ids = {}
+    for country, _, _, app_ids in read_blocks(filename):
+        ids.setdefault(country, []).extend(app_ids)
+    return {country: sorted(app_ids) for country, app_ids in ids.items()}
+
+
+@pytest.mark.parametrize('aborted', [False, True])
+def test_appended_segments(tmp_path, aborted):
+    filename = str(tmp_path / 'out_us.ids')
+    write(filename, 'ab', {'us': list(range(1, 11))}, close=not aborted)
+    write(filename, 'ab', {'us': list(range(100, 106)), 'de': [7]})
+    write(filename, 'ab', {})
+    assert read(filename) == {'us': list(range(1, 11)) + list(range(100, 106)), 'de': [7]}
+    chunks = list(split(filename, 5))
+    assert len(chunks) > 1
+    assert sum(len(list(read_blocks(*chunk))) for chunk in chunks) == len(read_index(filename))
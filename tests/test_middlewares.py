@@ -0,0 +1,81 @@
+from types import SimpleNamespace
+
+from scrapy import Request, Spider
+from scrapy.core.downloader import Downloader, Slot
+from scrapy.http import Response
+from scrapy.utils.test import get_crawler
+from twisted.internet import defer
+
+from appstore.middlewares import TooManyRequestsRetryMiddleware
+
+URL = 'https://amp-api.apps.apple.com/v1/catalog/us/apps/{}'
+
+
+class StubDownloader(Downloader):
+    '''
+    Downloader that records the requests it sends, which get their responses with respond()
+    '''
+
+    def __init__(self, crawler):
+        super().__init__(crawler)
+        self.sent = []
+        self._transfers = {}
+
+    def _download(self, slot, request, spider):
+        slot.transferring.add(request)
+        self.sent.append(request)
+        d = self._transfers[request] = defer.Deferred()
+        return d
+
+    def respond(self, request, status, spider):
+        slot = self.slots[request.meta['download_slot']]
+        slot.transferring.remove(request)
+        request.meta['download_latency'] = 0.5
+        self._transfers.pop(request).callback(Response(request.url, status=status, request=request))
+        self._process_queue(spider, slot)
+
+
+def crawler_spider():
+    crawler = get_crawler(Spider)
+    spider = crawler._create_spider('amp')
+    downloader = StubDownloader(crawler)
+    downloader.slots['amp'] = Slot(concurrency=2, delay=0, randomize_delay=False)
+    paused = []
+    crawler.engine = SimpleNamespace(
+        downloader=downloader, pause=lambda: paused.append(True), unpause=lambda: paused.append(False)
+    )
+    return crawler, spider, downloader, paused
+
+
+def test_nothing_is_sent_while_paused():
+    crawler, spider, downloader, paused = crawler_spider()
+    middleware = TooManyRequestsRetryMiddleware.from_crawler(crawler)
+    requests = [Request(URL.format(app_id), meta={'download_slot': 'amp'}) for app_id in range(6)]
+    for request in requests:
+        downloader._enqueue_request(request, spider)
+    assert downloader.sent == requests[:2]
+
+    # the first 429 pauses, the requests in the queue of the slot are held back
+    response = Response(requests[0].url, status=429, headers={'Retry-After': '10'}, request=requests[0])
+    retry = middleware.process_response(requests[0], response, spider)
+    assert paused == [True]
+    assert isinstance(retry, Request)
+    downloader.respond(requests[0], 429, spider)
+    resume_at = middleware._resume_at
+
+    # a 429 of a request in flight does not extend the pause and nothing else is sent
+    response = Response(requests[1].url, status=429, headers={'Retry-After': '10'}, request=requests[1])
+    requests[1].meta['download_latency'] = 5
+    middleware.process_response(requests[1], response, spider)
+    downloader.respond(requests[1], 429, spider)
+    assert middleware._resume_at == resume_at
+    assert downloader.sent == requests[:2]
+    assert not downloader.slots['amp'].queue
+
+    middleware._resume_call.cancel()
+    middleware.unpause(spider)
+    assert paused == [True, False]
+    assert downloader.sent == requests[:4]
+    downloader.respond(requests[2], 200, spider)
+    downloader.respond(requests[3], 200, spider)
+    assert downloader.sent == requests
@@ -0,0 +1,78 @@
+import gzip
+
+from scrapy import Request, Spider
+from scrapy.core.downloader.middleware import DownloaderMiddlewareManager
+from scrapy.http import HtmlResponse, Response
+from scrapy.settings import Settings
+from scrapy.utils.test import get_crawler
+
+from appstore import settings as project_settings
+
+URL = 'https://apps.apple.com/us/genre/ios/id36'
+PAGE = b'<html><body><a class="top-level-genre" href="https://apps.apple.com/us/genre/ios-books/id6018">Books</a>'
+
+
+class GenreSpider(Spider):
+    name = 'genre'
+
+    def parse_main(self, response):
+        pass
+
+
+def downloader_middlewares(tmp_path):
+    settings = Settings()
+    settings.setmodule(project_settings)
+    settings.set('APPSTORE_PAGE_CACHE', str(tmp_path / 'pages.sqlite'))
+    settings.set('APPSTORE_TOKEN_CACHE', '')
+    # the OffsiteMiddleware needs spider_opened, which is not sent here
+    settings['DOWNLOADER_MIDDLEWARES']['scrapy.downloadermiddlewares.offsite.OffsiteMiddleware'] = None
+    crawler = get_crawler(GenreSpider, settings.copy_to_dict())
+    crawler.spider = crawler._create_spider()
+    return crawler, DownloaderMiddlewareManager.from_crawler(crawler)
+
+
+def download(manager, spider, download_func):
+    request = Request(URL, spider.parse_main)
+    results = []
+    manager.download(download_func, request, spider).addBoth(results.append)
+    assert results, 'the download did not finish'
+    if isinstance(results[0], Exception) or hasattr(results[0], 'raiseException'):
+        results[0].raiseException()
+    return results[0]
+
+
+def test_gzip_page_is_cached_decoded(tmp_path):
+    crawler, manager = downloader_middlewares(tmp_path)
+    spider = crawler.spider
+
+    def gzip_page(request, spider):
+        headers = {'Content-Type': 'text/html; charset=utf-8', 'Content-Encoding': 'gzip', 'ETag': '"v1"'}
+        return HtmlResponse(request.url, body=gzip.compress(PAGE), headers=headers, request=request)
+
+    response = download(manager, spider, gzip_page)
+    assert response.body == PAGE
+    cache = crawler.appstore_page_cache
+    cache.commit()
+    assert cache.get(URL).payload == PAGE
+
+    def unreachable(request, spider):
+        raise AssertionError('a fresh page must be answered from the cache')
+
+    cached = download(manager, spider, unreachable)
+    assert 'cached' in cached.flags
+    assert cached.body == PAGE
+    assert cached.css('a.top-level-genre::text').get() == 'Books'
+
+
+def test_gzip_page_is_revalidated(tmp_path):
+    crawler, manager = downloader_middlewares(tmp_path)
+    spider = crawler.spider
+    crawler.appstore_page_cache.put(URL, 'body', PAGE, etag='"v1"', content_type='text/html', fetched=1)
+
+    def not_modified(request, spider):
+        assert request.headers['If-None-Match'] == b'"v1"'
+        return Response(request.url, status=304, headers={'Content-Encoding': 'gzip'}, request=request)
+
+    revalidated = download(manager, spider, not_modified)
+    assert 'revalidated' in revalidated.flags
+    assert revalidated.body == PAGE
@@ -0,0 +1,45 @@
+from scrapy import Request
+from scrapy.core.downloader import Downloader
+from scrapy.settings import Settings
+from scrapy.crawler import Crawler
+
+from appstore import settings as project_settings
+from appstore.spiders.appstore_ids import AppstoreIDsSpider
+from appstore.spiders.appstore_metadata import AppstoreMetaSpider
+
+
+def crawler_spider(spidercls, settings=None, **kwargs):
+    project = Settings()
+    project.setmodule(project_settings)
+    project.update(settings or {})
+    # the order of Crawler.crawl: the spider can change the settings before they are frozen
+    crawler = Crawler(spidercls, project)
+    crawler.spider = crawler._create_spider(**kwargs)
+    crawler._apply_settings()
+    return crawler, crawler.spider
+
+
+def slot(crawler, spider, key):
+    downloader = Downloader(crawler)
+    _, slot = downloader._get_slot(Request('https://amp-api.apps.apple.com/', meta={'download_slot': key}), spider)
+    downloader.close()
+    return slot
+
+
+def test_endpoint_slots():
+    crawler, spider = crawler_spider(AppstoreIDsSpider)
+    assert slot(crawler, spider, 'genre').delay == project_settings.DOWNLOAD_DELAY_IDS
+    assert slot(crawler, spider, 'amp_single').delay == project_settings.DOWNLOAD_DELAY_AMP_SINGLE
+
+
+def test_spider_arguments_and_exits():
+    settings = {'APPSTORE_EGRESS': ['direct', '10.0.0.2'], 'DOWNLOAD_SLOTS': {'ua': {'delay': 3.0}}}
+    crawler, spider = crawler_spider(AppstoreMetaSpider, settings, amp_delay='2', amp_concurrency='4', ua_delay='5')
+    slots = crawler.settings.getdict('DOWNLOAD_SLOTS')
+    exits = {f'{endpoint}@{index}' for endpoint in ['amp', 'amp_single', 'ua'] for index in [0, 1]}
+    assert set(slots) == {'amp', 'amp_single', 'ua', 'genre'} | exits
+    for key in ['amp', 'amp@1', 'amp_single@0']:
+        assert (slot(crawler, spider, key).delay, slot(crawler, spider, key).concurrency) == (2.0, 4)
+    # slots of DOWNLOAD_SLOTS are kept
+    assert slot(crawler, spider, 'ua').delay == 3.0
+    assert slot(crawler, spider, 'ua@1').delay == 5.0
@@ -0,0 +1,55 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+from scrapy import Spider
+from scrapy.utils.test import get_crawler
+
+from appstore.pipelines import AppstorePipeline
+from appstore.state import DONE, ChangeLog, CrawlState
+from appstore.storage import open_storage
+
+APPS = {app_id: b'{"id":"%d","attributes":{"name":"App %d"}}' % (app_id, app_id) for app_id in range(1, 2001)}
+
+
+@pytest.mark.parametrize('compression', ['gzip', 'zstd', 'none'])
+def test_shards(tmp_path, compression):
+    if compression == 'zstd':
+        pytest.importorskip('zstandard')
+    storage = open_storage('jsonl', str(tmp_path), compression=compression, shard_size=64 * 1024)
+    for app_id, data in APPS.items():
+        storage.write('amp', app_id, data)
+    storage.close()
+    assert len(list((tmp_path / 'amp').iterdir())) > 1
+    reader = open_storage('jsonl', str(tmp_path), compression=compression)
+    assert list(reader.ids('amp')) == list(APPS)
+    assert {app_id: json.loads(data) for app_id, data in reader.items('amp')} == {
+        app_id: json.loads(data) for app_id, data in APPS.items()
+    }
+
+
+@pytest.mark.parametrize('kind, compression', [('files', None), ('jsonl', 'gzip'), ('jsonl', 'zstd'), ('sqlite', None)])
+def test_done_apps_are_stored(tmp_path, kind, compression):
+    if compression == 'zstd':
+        pytest.importorskip('zstandard')
+    options = {'compression': compression} if compression else {}
+    storefront = 'us/iphone/en-US'
+    crawl_state = CrawlState(str(tmp_path / 'state.sqlite'))
+    spider = SimpleNamespace(
+        storages={storefront: open_storage(kind, str(tmp_path), **options)},
+        raw_storages={},
+        crawl_state=crawl_state,
+        change_log=ChangeLog(str(tmp_path / 'changes.jsonl')),
+    )
+    pipeline = AppstorePipeline.from_crawler(get_crawler(Spider))
+    batch = [
+        {'endpoint': 'amp', 'storefront': storefront, 'app_id': app_id, 'status': DONE, 'data': APPS[app_id]}
+        for app_id in range(1, 51)
+    ]
+    pipeline._write(spider, batch)
+
+    # the process gets killed here: nothing is closed, another process reads the state and the storage
+    done = set(CrawlState(str(tmp_path / 'state.sqlite')).ids('amp', storefront))
+    stored = set(open_storage(kind, str(tmp_path), **options).ids('amp'))
+    assert done == set(range(1, 51))
+    assert done <= stored
@@ -0,0 +1,81 @@
+from types import SimpleNamespace
+
+import pytest
+
+from appstore import workqueue
+from appstore.workqueue import DONE, LEASED, PENDING, RedisQueue, SqliteQueue
+
+STOREFRONT = 'us/iphone/en-us'
+
+
+@pytest.fixture(params=['sqlite', 'redis'])
+def queue(request, tmp_path, monkeypatch):
+    if request.param == 'sqlite':
+        queue = SqliteQueue(str(tmp_path / 'queue.sqlite'))
+    else:
+        fakeredis = pytest.importorskip('fakeredis')
+        pytest.importorskip('lupa')
+        monkeypatch.setattr(workqueue, 'redis', SimpleNamespace(Redis=fakeredis.FakeRedis))
+        queue = RedisQueue('redis://localhost:6379/0', prefix=f'test{id(tmp_path)}')
+    yield queue
+    queue.close()
+
+
+def test_lease_in_order(queue):
+    assert queue.fill(STOREFRONT, [[1, 2], [3], [4, 5, 6]]) == 3
+    first = queue.lease('a', 60)
+    second = queue.lease('b', 60)
+    assert first.storefront == STOREFRONT
+    assert first.app_ids == [1, 2]
+    assert second.app_ids == [3]
+    assert first.id != second.id
+    stats = queue.stats()
+    assert stats['batches'][PENDING] == 1
+    assert stats['batches'][LEASED] == 2
+    assert stats['ids']['total'] == 6
+    assert stats['expired'] == 0
+
+
+def test_empty(queue):
+    assert queue.lease('a', 60) is None
+    queue.fill(STOREFRONT, [[1]])
+    queue.lease('a', 60)
+    assert queue.lease('b', 60) is None
+
+
+def test_expired_lease_is_reclaimed(queue):
+    queue.fill(STOREFRONT, [[1, 2]])
+    lost = queue.lease('a', -1)
+    assert queue.stats()['expired'] == 1
+    reclaimed = queue.lease('b', 60)
+    assert reclaimed.id == lost.id
+    assert reclaimed.app_ids == [1, 2]
+    # the worker that lost its lease can not renew it
+    assert queue.renew('a', [lost.id], 60) == []
+    assert queue.renew('b', [reclaimed.id], 60) == [reclaimed.id]
+    assert queue.lease('c', 60) is None
+    stats = queue.stats()
+    assert stats['batches'][LEASED] == 1
+    assert stats['expired'] == 0
+
+
+def test_renewed_lease_is_kept(queue):
+    queue.fill(STOREFRONT, [[1]])
+    batch = queue.lease('a', 60)
+    assert queue.renew('a', [batch.id], 60) == [batch.id]
+    assert queue.lease('b', 60) is None
+
+
+def test_complete(queue):
+    queue.fill(STOREFRONT, [[1, 2], [3]])
+    batch = queue.lease('a', -1)
+    queue.complete(batch.id, 'a', {'amp/done': 2})
+    # done batches are not reclaimed
+    other = queue.lease('b', 60)
+    assert other.app_ids == [3]
+    assert queue.lease('c', 60) is None
+    queue.complete(batch.id, 'c', {'amp/done': 2})
+    stats = queue.stats()
+    assert stats['batches'][DONE] == 1
+    assert stats['results'] == {'amp/done': 2}
+    assert stats['workers']['a'][DONE] == 1